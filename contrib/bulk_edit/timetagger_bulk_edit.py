@@ -4,6 +4,9 @@
 With this little script there shall be some kind of bulk editing for
 records, as long as Timetagger does not impemented it natively.
 
+Run this while the server is not running, or restart the server
+afterwards, so that it rebuilds its stats for the modified records.
+
 So far this bulk editing options are available:
 - changing color for multiple tags in a bulk
 - changing priority of multiple tags in a bulk
@@ -73,10 +76,15 @@ from itemdb import ItemDB
 import json
 import logging
 import os
-import pathlib
 import time
 
-from timetagger.server._utils import user2filename, filename2user, ROOT_USER_DIR
+from timetagger.server._utils import (
+    user2filename,
+    filename2user,
+    list_user_filenames,
+    ROOT_USER_DIR,
+)
+from timetagger.server._apiserver import invalidate_derived_tables
 
 
 def setup_parser():
@@ -153,7 +161,7 @@ class BulkEditor:
         ignore_usernames = ["defaultuser"]
         if exclude_users:
             ignore_usernames += exclude_users
-        for filename in pathlib.Path(ROOT_USER_DIR).glob("*.db"):
+        for filename in list_user_filenames():
             try:
                 username = filename2user(filename)
                 if username in ignore_usernames:
@@ -385,6 +393,8 @@ class Records(BulkEditor):
                 now = int(time.time())
                 item["st"] = now
                 self.db.put(self.TABLE, item)
+            # Have the server rebuild its stats etc. (must be last)
+            invalidate_derived_tables(self.db)
 
 
 if __name__ == "__main__":
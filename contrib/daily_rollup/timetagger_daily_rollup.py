@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Check or rebuild the per-day rollup of the records of TimeTagger users.
+
+The server keeps the rollup up to date, and rebuilds it when the
+configured timezone changes. This script is for checking that the rollup
+is consistent with the records, and for fixing it if it is not.
+
+Examples:
+* timetagger_daily_rollup.py check
+  * checks the rollups of all users, and prints the differences.
+* timetagger_daily_rollup.py rebuild --user USERNAME
+  * rebuilds the rollup of the given user.
+
+Use the same config (e.g. TIMETAGGER_DATADIR and TIMETAGGER_ROLLUP_TIMEZONE)
+as the server. Best run this while the server is not running.
+"""
+
+import argparse
+import asyncio
+import sys
+
+from timetagger.server._utils import (
+    user2filename,
+    filename2user,
+    list_user_filenames,
+)
+from timetagger.server._apiserver import db_pool
+from timetagger.server._rollup import check_daily_rollup, rebuild_daily_rollup
+
+
+def setup_parser():
+    argparser = argparse.ArgumentParser(
+        description="Check or rebuild the per-day rollup of TimeTagger users.",
+    )
+    argparser.add_argument("command", choices=["check", "rebuild"])
+    argparser.add_argument(
+        "--user", action="append", help="the user(s) to process, default all"
+    )
+    return argparser
+
+
+def get_filenames(usernames):
+    if usernames:
+        return [user2filename(username) for username in usernames]
+    return list_user_filenames()
+
+
+async def main(args):
+    ok = True
+    for filename in get_filenames(args.user):
+        username = filename2user(filename)
+        # Opening the db via the pool also builds the rollup if needed
+        db = await db_pool.get(filename)
+        if args.command == "rebuild":
+            await rebuild_daily_rollup(db)
+            print(f"{username}: rebuilt")
+        problems = await check_daily_rollup(db)
+        if problems:
+            ok = False
+            print(f"{username}: {len(problems)} problems")
+            for problem in problems:
+                print("    " + problem)
+        else:
+            print(f"{username}: ok")
+    return ok
+
+
+if __name__ == "__main__":
+    args = setup_parser().parse_args()
+    ok = asyncio.run(main(args))
+    sys.exit(0 if ok else 1)
@@ -11,6 +11,9 @@ Examples:
 * multiuser_tweaks.py settings --settings settings.json
   * copy settings from a JSON file to the users settings database tables.
 
+Run this while the server is not running, or restart the server
+afterwards, so that it rebuilds its stats for the merged records.
+
 Author: joerg.steffens@bareos.com
 """
 
@@ -18,13 +21,18 @@ import argparse
 import binascii
 import json
 import logging
-import pathlib
 from pprint import pprint, pformat  # noqa
 import sys
 import time
 
 from itemdb import ItemDB
-from timetagger.server._utils import user2filename, filename2user, ROOT_USER_DIR
+from timetagger.server._utils import (
+    user2filename,
+    filename2user,
+    list_user_filenames,
+    ROOT_USER_DIR,
+)
+from timetagger.server._apiserver import invalidate_derived_tables
 
 
 def setup_parser():
@@ -143,7 +151,7 @@ class TimeTaggerDB:
         ignore_usernames = ["defaultuser"]
         if exclude_users:
             ignore_usernames += exclude_users
-        for filename in pathlib.Path(ROOT_USER_DIR).glob("*.db"):
+        for filename in list_user_filenames():
             try:
                 username = filename2user(filename)
                 if username in ignore_usernames:
@@ -295,6 +303,8 @@ class Records(TimeTaggerDB):
             if itemdb_exists(self.target_db, self.TABLE):
                 self.target_db.delete_table(self.TABLE)
             self.target_db.rename_table(self.TMP_TABLE, self.TABLE)
+            # Have the server rebuild its stats etc. (must be last)
+            invalidate_derived_tables(self.target_db)
 
 
 def handle_users_command(args):
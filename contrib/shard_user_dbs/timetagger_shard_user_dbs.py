@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+Move the user databases of a TimeTagger server to the sharded layout,
+in which they are in subdirectories based on a hash of the username
+(e.g. users/ab/cd/name.db). This can be done while the server is running.
+
+Steps:
+* Configure the server with TIMETAGGER_USER_DIR_LAYOUT=sharded and restart
+  it. New users get a db in the sharded layout, existing db's are still
+  found in the flat layout.
+* timetagger_shard_user_dbs.py migrate
+  * moves the db's that are in the flat layout. Each db is copied while
+    holding its write lock, after which writes to the old db fail. The
+    server uses the new db for new requests. A push that was in progress
+    for that user may fail, in which case the client tries again.
+* timetagger_shard_user_dbs.py cleanup
+  * removes the old db's that were moved. Best run after the server was
+    restarted, or when it ran for more than db_pool_idle seconds after the
+    migration, so that it no longer has the old db's open.
+
+Use the same config (e.g. TIMETAGGER_DATADIR) as the server.
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+
+from timetagger import config
+from timetagger.server._utils import user2filename, filename2user, ROOT_USER_DIR
+from timetagger.server._dbpool import move_user_db, is_moved_user_db
+
+
+def setup_parser():
+    argparser = argparse.ArgumentParser(
+        description="Move TimeTagger user db's to the sharded layout.",
+    )
+    argparser.add_argument("command", choices=["migrate", "cleanup"])
+    argparser.add_argument(
+        "--dry-run", action="store_true", help="only show what would be done"
+    )
+    return argparser
+
+
+def get_flat_filenames():
+    return sorted(glob.glob(os.path.join(ROOT_USER_DIR, "*.db")))
+
+
+def migrate(dry_run):
+    if config.user_dir_layout.lower() != "sharded":
+        # Otherwise the server would keep using the old db's
+        print("The user_dir_layout must be 'sharded' for the server and this script.")
+        return False
+    ok = True
+    for filename in get_flat_filenames():
+        username = filename2user(filename)
+        new_filename = user2filename(username, "sharded")
+        if os.path.isfile(new_filename):
+            print(f"{username}: already moved")
+        elif dry_run:
+            print(f"{username}: would move to {new_filename}")
+        else:
+            try:
+                move_user_db(filename, new_filename)
+            except Exception as err:
+                ok = False
+                print(f"{username}: failed: {err}")
+            else:
+                print(f"{username}: moved to {new_filename}")
+    return ok
+
+
+def cleanup(dry_run):
+    for filename in get_flat_filenames():
+        username = filename2user(filename)
+        if not os.path.isfile(user2filename(username, "sharded")):
+            continue
+        conn = sqlite3.connect(filename)
+        try:
+            moved = is_moved_user_db(conn)
+        finally:
+            conn.close()
+        if not moved:
+            # Both exist, but this one was not moved by us, leave it alone
+            print(f"{username}: not removing {filename}, it was not moved")
+        elif dry_run:
+            print(f"{username}: would remove {filename}")
+        else:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.isfile(filename + suffix):
+                    os.remove(filename + suffix)
+            print(f"{username}: removed {filename}")
+    return True
+
+
+if __name__ == "__main__":
+    args = setup_parser().parse_args()
+    if args.command == "migrate":
+        ok = migrate(args.dry_run)
+    else:
+        ok = cleanup(args.dry_run)
+    sys.exit(0 if ok else 1)
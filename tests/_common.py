@@ -1,3 +1,7 @@
+import os
+import asyncio
+
+
 def run_tests(scope):
     """Run all test functions in the given scope."""
     for func in list(scope.values()):
@@ -5,3 +9,19 @@ def run_tests(scope):
             print(f"Running {func.__name__} ...")
             func()
     print("Done")
+
+
+def remove_db(filename):
+    """Remove a database file, including its WAL and shared-memory files."""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.isfile(filename + suffix):
+            os.remove(filename + suffix)
+
+
+def run(co):
+    """Run the given coroutine in a new event loop, which is closed after."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(co)
+    finally:
+        loop.close()
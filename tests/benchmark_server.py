@@ -0,0 +1,255 @@
+"""
+Benchmarks for the server. These are not part of the test suite. Run
+this script to run all benchmarks, or give the name of one:
+
+    python tests/benchmark_server.py [name]
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import base64
+import asyncio
+import tempfile
+import threading
+import subprocess
+
+import itemdb
+
+from _common import run
+from timetagger import config
+from timetagger.server import _apiserver
+from timetagger.server._dbpool import apply_pragmas
+from timetagger.server import _metrics
+
+TEMP_DIR = tempfile.mkdtemp()
+
+
+async def get_db(name):
+    filename = os.path.join(TEMP_DIR, name + ".db")
+    if os.path.isfile(filename):
+        os.remove(filename)
+    return await _apiserver.db_pool.get(filename)
+
+
+def make_records(n, mt=100):
+    return [
+        dict(key=f"r{i}", mt=mt, t1=1000 * i, t2=1000 * i + 500, ds="#work #client")
+        for i in range(n)
+    ]
+
+
+def benchmark_push_items():
+    """Push new records, and then push updates for the same records."""
+
+    async def main(n):
+        db = await get_db(f"push{n}")
+        t0 = time.perf_counter()
+        await _apiserver._put_items(db, "records", make_records(n, 100))
+        t1 = time.perf_counter()
+        await _apiserver._put_items(db, "records", make_records(n, 110))
+        t2 = time.perf_counter()
+        return t1 - t0, t2 - t1
+
+    for n in (1_000, 10_000, 100_000):
+        t_new, t_update = run(main(n))
+        print(f"push {n:>7} records: new {t_new:7.3f}s  update {t_update:7.3f}s")
+
+
+def benchmark_concurrent_pushes():
+    """Push small batches of records concurrently, for one user."""
+
+    async def main(n):
+        db = await get_db(f"concurrent{n}")
+        pushes = []
+        for i in range(n):
+            records = make_records(10)
+            for r in records:
+                r["key"] += f"-{i}"
+            pushes.append(_apiserver._put_items(db, "records", records))
+        commits0 = _metrics.db_query_duration.get_count("commit")
+        t0 = time.perf_counter()
+        await asyncio.gather(*pushes)
+        t1 = time.perf_counter()
+        commits = _metrics.db_query_duration.get_count("commit") - commits0
+        return t1 - t0, commits
+
+    for n in (1, 10, 100):
+        t, commits = run(main(n))
+        print(f"{n:>4} concurrent pushes: {t:7.3f}s  {commits:>3} commits")
+
+
+def benchmark_read_write_concurrency():
+    """Read from a database while another connection writes to it, per
+    journal mode. With WAL, readers are not blocked by the writer.
+    """
+
+    def open_db(filename):
+        db = itemdb.ItemDB(filename)
+        apply_pragmas(db._conn)
+        return db
+
+    def writer(filename, n, done):
+        db = open_db(filename)
+        for i in range(n):
+            with db:
+                db.put("records", *make_records(10, 100 + i))
+        done.set()
+
+    ori_mode = config.db_journal_mode
+    try:
+        for mode in ("delete", "wal"):
+            config.db_journal_mode = mode
+            filename = os.path.join(TEMP_DIR, f"concurrency_{mode}.db")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.isfile(filename + suffix):
+                    os.remove(filename + suffix)
+            db = open_db(filename)
+            db.ensure_table("records", *_apiserver.INDICES["records"])
+            with db:
+                db.put("records", *make_records(1000))
+
+            done = threading.Event()
+            t0 = time.perf_counter()
+            thread = threading.Thread(target=writer, args=(filename, 200, done))
+            thread.start()
+            reads, max_latency = 0, 0
+            while not done.is_set():
+                t1 = time.perf_counter()
+                db.select("records", "t1 >= ? AND t1 < ?", 0, 100000)
+                max_latency = max(max_latency, time.perf_counter() - t1)
+                reads += 1
+            thread.join()
+            t = time.perf_counter() - t0
+            print(
+                f"{mode:>6}: 200 commits in {t:6.3f}s, {reads / t:7.0f} reads/s, "
+                f"max read latency {max_latency * 1000:6.1f} ms"
+            )
+    finally:
+        config.db_journal_mode = ori_mode
+
+
+def benchmark_wire_formats():
+    """Compare the size and parse time of the object and columnar formats."""
+    records = make_records(100_000)
+    for i, record in enumerate(records):
+        record["st"] = 1_700_000_000.123 + i
+        record["ds"] = f"#work #client{i % 20} meeting"
+
+    for name, body in [
+        ("objects", dict(records=records)),
+        ("columnar", dict(records=[_apiserver._records_to_columns(records)])),
+    ]:
+        text = json.dumps(body)
+        t0 = time.perf_counter()
+        json.loads(text)
+        t_parse = time.perf_counter() - t0
+        size = len(text.encode()) / 2**20
+        size_gz = len(gzip.compress(text.encode())) / 2**20
+        print(
+            f"{name:>8}: {size:6.2f} MiB ({size_gz:5.2f} MiB gzipped), "
+            f"parse {t_parse:6.3f}s"
+        )
+
+
+def benchmark_updates_throughput():
+    """Run the server with 1, 2, ... workers (up to the number of cores),
+    and measure the throughput of polling for updates, which is what
+    clients do most. Each poll returns without a query, so this mostly
+    measures the request handling, which is what is spread over the cores.
+    """
+    port = 8397
+    duration = 5
+    connections = 32
+
+    async def request(reader, writer, method, path, headers=None, body=b""):
+        lines = [f"{method} {path} HTTP/1.1", "host: 127.0.0.1"]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        lines.append(f"content-length: {len(body)}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        status_line = await reader.readline()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        body = await reader.readexactly(length)
+        return int(status_line.split()[1]), body
+
+    async def login():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        auth = base64.b64encode(json.dumps({"method": "localhost"}).encode())
+        path = "/timetagger/api/v2/bootstrap_authentication"
+        status, body = await request(reader, writer, "POST", path, body=auth)
+        writer.close()
+        assert status == 200, body
+        return json.loads(body)["token"]
+
+    async def poll_loop(token, deadline, counts):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        path = f"/timetagger/api/v2/updates?since={time.time() + 10}"
+        headers = {"authtoken": token}
+        while time.perf_counter() < deadline:
+            status, _ = await request(reader, writer, "GET", path, headers)
+            counts[status] = counts.get(status, 0) + 1
+        writer.close()
+
+    async def load():
+        token = await login()
+        deadline = time.perf_counter() + duration
+        counts = {}
+        await asyncio.gather(
+            *[poll_loop(token, deadline, counts) for _ in range(connections)]
+        )
+        return counts
+
+    def wait_for_server():
+        for _ in range(200):
+            try:
+                run(asyncio.open_connection("127.0.0.1", port))
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("Server did not start")
+
+    ncores = os.cpu_count() or 1
+    nworkers = sorted({1, 2, 4, ncores} & set(range(1, ncores + 1)))
+    env = os.environ.copy()
+    env.update(
+        TIMETAGGER_DATADIR=tempfile.mkdtemp(),
+        TIMETAGGER_BIND=f"127.0.0.1:{port}",
+        TIMETAGGER_RATE_LIMIT="0",
+        TIMETAGGER_LOG_LEVEL="warning",
+        PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    print(f"{ncores} cores, {connections} connections, {duration}s per run")
+    for n in nworkers:
+        env["TIMETAGGER_WORKERS"] = str(n)
+        p = subprocess.Popen(
+            [sys.executable, "-m", "timetagger"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_server()
+            counts = run(load())
+        finally:
+            p.terminate()
+            p.wait()
+        ok = counts.get(200, 0)
+        print(f"{n:>3} workers: {ok / duration:8.0f} polls/s  (statuses: {counts})")
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    for name, func in list(globals().items()):
+        if name.startswith("benchmark_") and callable(func):
+            if not names or name[len("benchmark_") :] in names:
+                print(f"Running {name} ...")
+                func()
@@ -1,18 +1,23 @@
-import os
+import gzip
 import json
 import time
 import asyncio
 
+import asgineer
 from asgineer.testutils import MockTestServer
+from pytest import raises
 
-from _common import run_tests
+from _common import run, run_tests, remove_db
 from timetagger import __version__ as timetagger_version
+from timetagger import config
 from timetagger.server._utils import decode_jwt_nocheck
 from timetagger.server import _apiserver
+from timetagger.server import _metrics
 from timetagger.server import (
     authenticate,
     AuthException,
     api_handler_triage,
+    api_handler_websocket,
     get_webtoken_unsafe,
     user2filename,
 )
@@ -29,12 +34,13 @@ def get_webtoken_unsafe_sync(username, reset=False):
 
 
 def clear_test_db():
-    filename = user2filename(USER)
-    if os.path.isfile(filename):
-        os.remove(filename)
+    remove_db(user2filename(USER))
 
     HEADERS["authtoken"] = get_webtoken_unsafe_sync(USER)
 
+    # The tests make many requests in a short time; test_rate_limit enables it
+    config.rate_limit = 0
+
 
 def get_from_db(what):
     filename = user2filename(USER)
@@ -49,6 +55,8 @@ async def our_api_handler(request):
         return 404, {}, "Invalid API path"
     elif not path and request.method == "GET":
         return 200, {}, "API root"
+    elif path == "sync" and isinstance(request, asgineer.WebsocketRequest):
+        return await api_handler_websocket(request)
 
     try:
         auth_info, db = await authenticate(request)
@@ -432,6 +440,590 @@ def test_records():
         assert len(d["records"]) == 6
 
 
+def test_group_commit():
+    clear_test_db()
+
+    def push(p, records):
+        body = json.dumps(records).encode()
+        url = "http://localhost/api/v2/records"
+        return p._co_request("PUT", url, data=body, headers=HEADERS)
+
+    with MockTestServer(our_api_handler) as p:
+        # Concurrent pushes, with overlapping keys and errors
+        pushes = []
+        for i in range(10):
+            records = [
+                dict(key=f"r{i}", mt=100, t1=100, t2=110 + i, ds=f"#tag{i}"),
+                dict(key="shared", mt=100 + i, t1=100, t2=110, ds=f"#tag{i}"),
+                dict(key=f"bad{i}", mt=100, t1="x", t2=110, ds=""),
+            ]
+            pushes.append(push(p, records))
+        commits_before = _metrics.db_query_duration.get_count("commit")
+
+        async def push_all():
+            return await asyncio.gather(*pushes)
+
+        responses = p._loop.run_until_complete(push_all())
+        commits = _metrics.db_query_duration.get_count("commit") - commits_before
+
+        # Fewer commits than pushes
+        assert 1 <= commits < 10
+
+        # Each caller has its own result
+        for i, (status, headers, body) in enumerate(responses):
+            assert status == 200
+            d = json.loads(body.decode())
+            assert d["accepted"] == [f"r{i}", "shared"]
+            assert d["failed"] == [f"bad{i}"]
+            assert len(d["errors"]) == 1
+
+        # The time of a shared transaction is reported as such
+        timings = [headers["server-timing"] for _, headers, _ in responses]
+        assert any("shared with other requests" in x for x in timings)
+
+        # The result is the same as when pushed one after another
+        r = p.get("http://localhost/api/v2/records?timerange=0-200", headers=HEADERS)
+        records = {x["key"]: x for x in dejsonize(r)["records"]}
+        assert len(records) == 11
+        assert records["shared"]["ds"] == "#tag9"
+        url = "http://localhost/api/v2/records?timerange=0-200&tag=tag9"
+        r = p.get(url, headers=HEADERS)
+        keys = sorted(x["key"] for x in dejsonize(r)["records"])
+        assert keys == ["r9", "shared"]
+        url = "http://localhost/api/v2/records?timerange=0-200&tag=tag3"
+        r = p.get(url, headers=HEADERS)
+        assert [x["key"] for x in dejsonize(r)["records"]] == ["r3"]
+        url = "http://localhost/api/v2/stats?timerange=0-200"
+        stats = dejsonize(p.get(url, headers=HEADERS))["stats"]
+        assert stats["#tag9"] == 10 + 19
+        assert stats["#tag3"] == 13
+
+        assert not _apiserver._write_queues
+
+
+def test_write_queue_cancelled():
+    clear_test_db()
+
+    async def main():
+        db = await _apiserver.db_pool.get(user2filename(USER))
+        loop = asyncio.get_running_loop()
+        records = [dict(key="a", mt=100, t1=100, t2=110, ds="")]
+        queue = []
+        for i in range(3):
+            future = loop.create_future()
+            queue.append(
+                ("records", records, _apiserver._new_put_result(), future, None)
+            )
+        futures = [entry[3] for entry in queue]
+        task = loop.create_task(_apiserver._process_write_queue(db, queue))
+        await asyncio.sleep(0)  # takes the entries, and starts the transaction
+        assert not queue
+        task.cancel()
+        await asyncio.wait([task])
+        # The requests do not wait forever
+        for future in futures:
+            assert isinstance(future.exception(), IOError)
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_records_tag_index():
+    clear_test_db()
+
+    def get_keys(p, tags):
+        url = "http://localhost/api/v2/records?timerange=0-99999999999&tag=" + tags
+        r = p.get(url, headers=HEADERS)
+        assert r.status == 200
+        return set(x["key"] for x in dejsonize(r)["records"])
+
+    with MockTestServer(our_api_handler) as p:
+        records = [
+            dict(key="r1", mt=110, t1=100, t2=150, ds="#Work #client-a"),
+            dict(key="r2", mt=110, t1=200, t2=250, ds="meeting #work#call"),
+            dict(key="r3", mt=110, t1=300, t2=350, ds="#workout"),
+        ]
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(records).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+
+        # Tags are parsed like the client does
+        assert get_keys(p, "work") == {"r1", "r2"}
+        assert get_keys(p, "WORK") == {"r1", "r2"}
+        assert get_keys(p, "call") == {"r2"}
+        assert get_keys(p, "client-a,work") == {"r1"}
+        assert get_keys(p, "%23workout") == {"r3"}
+
+        # Changing the description updates the index
+        records = [
+            dict(key="r1", mt=120, t1=100, t2=150, ds="#client-a"),
+            dict(key="r3", mt=120, t1=300, t2=350, ds="#work"),
+        ]
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(records).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+        assert get_keys(p, "work") == {"r2", "r3"}
+        assert get_keys(p, "workout") == set()
+        assert get_keys(p, "client-a") == {"r1"}
+
+    # A database that was created before the tag index is backfilled
+    _apiserver.db_pool.clear()
+    db = itemdb.ItemDB(user2filename(USER))
+    with db:
+        db.delete("userinfo", "key == 'record_tags'")
+    with db:
+        db.delete("record_tags", "key IS NOT NULL")
+    with MockTestServer(our_api_handler) as p:
+        assert get_keys(p, "work") == {"r2", "r3"}
+        assert get_keys(p, "client-a") == {"r1"}
+
+
+def test_records_query_plan():
+    clear_test_db()
+
+    # An old database, without the generated columns
+    filename = user2filename(USER)
+    remove_db(filename)
+    _apiserver.db_pool.clear()
+    db = itemdb.ItemDB(filename)
+    db.ensure_table("records", *_apiserver.INDICES["records"])
+    with db:
+        db.put(
+            "records",
+            dict(key="r1", st=1, mt=1, t1=100, t2=150, ds="#work"),
+            dict(key="r2", st=1, mt=1, t1=200, t2=200, ds="HIDDEN #work"),
+        )
+    db.close()
+    HEADERS["authtoken"] = get_webtoken_unsafe_sync(USER)
+
+    with MockTestServer(our_api_handler) as p:
+        for query, keys in [
+            ("", {"r1", "r2"}),
+            ("&running=yes", {"r2"}),
+            ("&running=no", {"r1"}),
+            ("&hidden=yes", {"r2"}),
+            ("&hidden=no", {"r1"}),
+        ]:
+            url = "http://localhost/api/v2/records?timerange=0-1000" + query
+            r = p.get(url, headers=HEADERS)
+            assert r.status == 200
+            assert set(x["key"] for x in dejsonize(r)["records"]) == keys
+
+    # Every filter combination uses an index
+    db = itemdb.ItemDB(filename)
+    for running in (None, True, False):
+        for hidden in (None, True, False):
+            for tags in ([], ["#work"]):
+                query, params = _apiserver._get_records_query(
+                    0, 1000, running, hidden, tags
+                )
+                plan = db._conn.execute(
+                    f"EXPLAIN QUERY PLAN SELECT _ob FROM records WHERE {query}",
+                    params,
+                ).fetchall()
+                details = [row[-1] for row in plan]
+                assert not any(d.startswith("SCAN") for d in details), details
+
+
+def test_stats():
+    clear_test_db()
+
+    import random
+    from timetagger.server import _stats
+
+    def brute_force_stats(records, t1, t2, now):
+        stats = {}
+        for r in records.values():
+            if r["ds"].startswith("HIDDEN"):
+                continue
+            r2 = now if r["t1"] == r["t2"] else r["t2"]
+            deltat = min(t2, r2) - max(t1, r["t1"])
+            if deltat > 0:
+                tagz = _stats.get_tagz(r)
+                stats[tagz] = stats.get(tagz, 0) + deltat
+        return stats
+
+    def get_stats(p, query):
+        r = p.get("http://localhost/api/v2/stats?" + query, headers=HEADERS)
+        assert r.status == 200, r.body
+        return dejsonize(r)
+
+    day = 86400
+    random.seed(3)
+    descriptions = ["#work", "#work #client", "#home", "", "HIDDEN #work"]
+    records = {}
+    for i in range(300):
+        t1 = 1_600_000_000 + random.randint(0, 400 * day)
+        t2 = t1 + random.choice([0, 600, 3600, 5 * 3600, 3 * day])
+        ds = random.choice(descriptions)
+        if t1 == t2:
+            t1 = t2 = 1_600_000_000 + 401 * day  # running
+        records[f"r{i}"] = dict(key=f"r{i}", mt=100, t1=t1, t2=t2, ds=ds)
+
+    with MockTestServer(our_api_handler) as p:
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(list(records.values())).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+
+        # Modify some records
+        for key in list(records.keys())[:50]:
+            record = records[key] = records[key].copy()
+            record["mt"] = 110
+            record["t2"] += random.choice([0, 1000, 2 * day])
+            record["ds"] = random.choice(descriptions)
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(list(records.values())[:50]).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+
+        # Compare with a brute force approach, for different ranges
+        for i in range(20):
+            t1 = 1_600_000_000 + random.randint(-10 * day, 400 * day)
+            t2 = t1 + random.randint(0, 400 * day)
+            d = get_stats(p, f"timerange={t1}-{t2}")
+            now = time.time()
+            expected = brute_force_stats(records, t1, t2, now)
+            assert d["stats"].keys() == expected.keys()
+            for tagz in expected:
+                assert abs(d["stats"][tagz] - expected[tagz]) < 5
+
+        # Filter by tag
+        t1, t2 = 1_600_000_000, 1_600_000_000 + 300 * day
+        d1 = get_stats(p, f"timerange={t1}-{t2}")
+        d2 = get_stats(p, f"timerange={t1}-{t2}&tag=work")
+        assert set(d2["stats"].keys()) == {"#work", "#client #work"}
+        assert d2["stats"]["#work"] == d1["stats"]["#work"]
+        d3 = get_stats(p, f"timerange={t1}-{t2}&tag=client,work")
+        assert set(d3["stats"].keys()) == {"#client #work"}
+
+        # Group by day, week, month
+        for groupby, n in [("day", 300), ("week", 44), ("month", 10)]:
+            d = get_stats(p, f"timerange={t1}-{t2}&groupby={groupby}")
+            groups = d["groups"]
+            assert n <= len(groups) <= n + 1
+            assert groups[0]["t1"] == t1 and groups[-1]["t2"] == t2
+            for g1, g2 in zip(groups[:-1], groups[1:]):
+                assert g1["t2"] == g2["t1"]
+            total = {}
+            for group in groups:
+                for tagz, seconds in group["stats"].items():
+                    total[tagz] = total.get(tagz, 0) + seconds
+            assert total == d["stats"]
+
+        # Bad requests
+        too_many_groups = f"timerange=0-{20000 * 86400}&groupby=day"
+        for query in [
+            "",
+            "timerange=foo",
+            "timerange=0-1&groupby=year",
+            too_many_groups,
+        ]:
+            r = p.get("http://localhost/api/v2/stats?" + query, headers=HEADERS)
+            assert r.status == 400
+
+    # A database that was created before the stats existed is backfilled
+    _apiserver.db_pool.clear()
+    db = itemdb.ItemDB(user2filename(USER))
+    with db:
+        db.delete("userinfo", "key == 'stat_bins'")
+    with db:
+        db.delete("stat_bins", "key IS NOT NULL")
+    with MockTestServer(our_api_handler) as p:
+        assert get_stats(p, f"timerange={t1}-{t2}") == d1
+
+    # Concurrent backfills (e.g. by two workers) do not count twice
+    _apiserver.db_pool.clear()
+    with db:
+        db.delete("userinfo", "key == 'stat_bins'")
+    with db:
+        db.delete("stat_bins", "key IS NOT NULL")
+
+    async def backfill_concurrently():
+        dbs = [await itemdb.AsyncItemDB(user2filename(USER)) for i in range(3)]
+        await asyncio.gather(*[_apiserver._stats.backfill_stat_bins(x) for x in dbs])
+        for db in dbs:
+            await db.close()
+
+    run(backfill_concurrently())
+    with MockTestServer(our_api_handler) as p:
+        assert get_stats(p, f"timerange={t1}-{t2}") == d1
+
+    # A script that hides records directly has the derived tables rebuilt
+    _apiserver.db_pool.clear()
+    with db:
+        for record in db.select_all("records"):
+            record["ds"] = "HIDDEN #gone"
+            db.put("records", record)
+        _apiserver.invalidate_derived_tables(db)
+    with MockTestServer(our_api_handler) as p:
+        assert get_stats(p, f"timerange={t1}-{t2}") == {"stats": {}}
+    tag_items = []
+    for record in db.select_all("records"):
+        tag_items += _apiserver._get_record_tag_items(record)
+    kts = sorted(item["kt"] for item in db.select_all("record_tags"))
+    assert kts == sorted(item["kt"] for item in tag_items)
+    assert db.select("daily_rollup", "count > 0") == []
+
+
+def test_stats_outliers():
+    clear_test_db()
+
+    from timetagger.server import _stats
+
+    # Very long records, and records far away, are not in the bins
+    records = [
+        dict(key="a", mt=100, t1=0, t2=4102444800, ds="#long"),
+        dict(key="b", mt=100, t1=1_600_000_000, t2=10**12, ds="#far"),
+        dict(key="c", mt=100, t1=1_600_000_000, t2=1_600_003_600, ds="#work"),
+    ]
+    assert [_stats.is_outlier(r) for r in records] == [True, True, False]
+
+    with MockTestServer(our_api_handler) as p:
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(records).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+        assert dejsonize(r)["accepted"] == ["a", "b", "c"]
+        assert len(get_from_db("stat_bins")) == _stats.STATS_LEVELS
+
+        # But they are counted
+        t1, t2 = 1_599_000_000, 1_601_000_000
+        r = p.get(f"http://localhost/api/v2/stats?timerange={t1}-{t2}", headers=HEADERS)
+        assert dejsonize(r)["stats"] == {
+            "#long": t2 - t1,
+            "#far": t2 - 1_600_000_000,
+            "#work": 3600,
+        }
+        r = p.get(
+            f"http://localhost/api/v2/stats?timerange={t1}-{t2}&groupby=day",
+            headers=HEADERS,
+        )
+        groups = dejsonize(r)["groups"]
+        assert sum(g["stats"].get("#long", 0) for g in groups) == t2 - t1
+        assert groups[-2]["stats"] == {"#long": 86400, "#far": 86400}
+
+        # After the year 9999, datetime cannot be used, but that's fine
+        t1 = 253402300000
+        record = dict(key="d", mt=100, t1=t1, t2=t1 + 3600, ds="#future")
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps([record]).encode(),
+            headers=HEADERS,
+        )
+        assert dejsonize(r)["accepted"] == ["d"]
+        url = f"http://localhost/api/v2/stats?timerange={t1}-{t1 + 86400}"
+        r = p.get(url, headers=HEADERS)
+        assert dejsonize(r)["stats"] == {"#far": 86400, "#future": 3600}
+        r = p.get(url + "&groupby=day", headers=HEADERS)
+        assert r.status == 400
+        assert len(get_from_db("daily_rollup")) == 1  # only record c
+
+
+def test_compression():
+    clear_test_db()
+
+    headers = HEADERS.copy()
+    headers["accept-encoding"] = "deflate, gzip;q=0.9"
+
+    with MockTestServer(our_api_handler) as p:
+        # Push gzipped records
+        records = [
+            dict(key=f"r{i}", mt=100, t1=100 + i, t2=110 + i, ds="#work #client")
+            for i in range(100)
+        ]
+        body = gzip.compress(json.dumps(records).encode())
+        r = p.put(
+            "http://localhost/api/v2/records",
+            body,
+            headers={**HEADERS, "content-encoding": "gzip"},
+        )
+        assert r.status == 200
+        assert len(dejsonize(r)["accepted"]) == 100
+
+        # Unsupported encoding
+        r = p.put(
+            "http://localhost/api/v2/records",
+            body,
+            headers={**HEADERS, "content-encoding": "br"},
+        )
+        assert r.status == 415
+
+        # Too large after decompression
+        body = gzip.compress(b"[" + b" " * (_apiserver.PUSH_MAX_SIZE + 10) + b"]")
+        assert len(body) < 100_000
+        r = p.put(
+            "http://localhost/api/v2/records",
+            body,
+            headers={**HEADERS, "content-encoding": "gzip"},
+        )
+        assert r.status == 500
+        assert "too large" in r.body.decode()
+
+        # Large responses are compressed if the client accepts it
+        url = "http://localhost/api/v2/records?timerange=0-1000"
+        r = p.get(url, headers=headers)
+        assert r.status == 200
+        assert r.headers["content-encoding"] == "gzip"
+        assert r.headers["vary"] == "accept-encoding"
+        assert len(json.loads(gzip.decompress(r.body))["records"]) == 100
+        r = p.get(url, headers=HEADERS)
+        assert "content-encoding" not in r.headers
+        assert len(dejsonize(r)["records"]) == 100
+        r = p.get(url, headers={**HEADERS, "accept-encoding": "gzip;q=0"})
+        assert "content-encoding" not in r.headers
+
+        # Small responses are not
+        r = p.get("http://localhost/api/v2/version", headers=headers)
+        assert "content-encoding" not in r.headers
+
+        # Streamed responses too
+        r = p.get("http://localhost/api/v2/updates?since=0", headers=headers)
+        assert r.headers["content-encoding"] == "gzip"
+        assert len(json.loads(gzip.decompress(r.body))["records"]) == 100
+
+
+def test_accepts_gzip():
+    class Request:
+        def __init__(self, value):
+            self.headers = {"accept-encoding": value}
+
+    for value, expected in [
+        ("", False),
+        ("gzip", True),
+        ("deflate, gzip;q=0.9", True),
+        ("gzip;q=0", False),
+        ("gzip;q=0.0", False),
+        ("*", True),
+        ("*;q=0", False),
+        ("br", False),
+        # An explicit gzip takes precedence over the wildcard
+        ("*, gzip;q=0", False),
+        ("gzip;q=0, *", False),
+        ("*;q=0, gzip", True),
+        ("identity;q=1, gzip;q=0.5;foo=bar", True),
+        ("gzip;q=foo", True),
+    ]:
+        assert _apiserver._accepts_gzip(Request(value)) is expected, value
+
+
+def test_columnar_format():
+    clear_test_db()
+
+    def from_columns(blocks):
+        records = []
+        for block in blocks:
+            for i in range(len(block["key"])):
+                record = {
+                    name: block[name][i] for name in ("key", "mt", "t1", "t2", "st")
+                }
+                if block["ds"][i] is not None:
+                    record["ds"] = block["ds_values"][block["ds"][i]]
+                records.append(record)
+        return records
+
+    ori_batch_size = _apiserver.FULL_UPDATES_BATCH_SIZE
+    _apiserver.FULL_UPDATES_BATCH_SIZE = 10
+
+    try:
+        with MockTestServer(our_api_handler) as p:
+            records = [
+                dict(key=f"r{i}", mt=100, t1=100 + i, t2=110 + i, ds=f"#p{i % 3}")
+                for i in range(25)
+            ]
+            del records[3]["ds"]
+            r = p.put(
+                "http://localhost/api/v2/records",
+                json.dumps(records).encode(),
+                headers=HEADERS,
+            )
+            assert r.status == 200
+
+            for url in [
+                "http://localhost/api/v2/records?timerange=0-1000",
+                "http://localhost/api/v2/records?timerange=0-1000&limit=20",
+                "http://localhost/api/v2/updates?since=0",  # streamed
+                "http://localhost/api/v2/updates?since=0&limit=20",
+            ]:
+                r = p.get(url, headers=HEADERS)
+                d1 = dejsonize(r)
+                r = p.get(url + "&format=columnar", headers=HEADERS)
+                assert r.status == 200
+                d2 = dejsonize(r)
+                assert d2["format"] == "columnar"
+                assert len(d2["records"]) >= 1
+                assert set(d2["records"][0]["ds_values"]) == {"#p0", "#p1", "#p2"}
+                assert from_columns(d2["records"]) == d1["records"]
+                assert len(r.body) < len(json.dumps(d1))
+
+            r = p.get(url + "&format=foo", headers=HEADERS)
+            assert r.status == 400
+    finally:
+        _apiserver.FULL_UPDATES_BATCH_SIZE = ori_batch_size
+
+
+def test_records_push_bulk():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+        # Push more records than fit in one query chunk
+        n = _apiserver.SELECT_CHUNK_SIZE * 2 + 10
+        records = [
+            dict(key=f"r{i}", mt=100, t1=100 + i, t2=110 + i, ds="#p1")
+            for i in range(n)
+        ]
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(records).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+        assert len(dejsonize(r)["accepted"]) == n
+        stored = {x["key"]: x for x in get_from_db("records")}
+        assert len(stored) == n
+        st1 = stored["r0"]["st"]
+
+        # Update all of them, with some older, newer, corrupt, and duplicate
+        records = [
+            dict(key=f"r{i}", mt=110, t1=100 + i, t2=120 + i, ds="#p2")
+            for i in range(n)
+        ]
+        records[1]["mt"] = 90  # older -> current version is reput
+        records[2]["t1"] = "xx"  # corrupt -> current version is reput
+        records.append(dict(key="r3", mt=120, t1=1, t2=2, ds="#p3"))  # duplicate
+        records.append(dict(key="r3", mt=115, t1=3, t2=4, ds="#p4"))  # older dup
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(records).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+        d = dejsonize(r)
+        assert len(d["accepted"]) == n + 1
+        assert d["accepted"][:2] == ["r0", "r1"]
+        assert d["accepted"][-2:] == ["r3", "r3"]
+        assert d["failed"] == ["r2"]
+
+        stored = {x["key"]: x for x in get_from_db("records")}
+        assert len(stored) == n
+        assert stored["r0"]["ds"] == "#p2" and stored["r0"]["st"] > st1
+        assert stored["r1"]["ds"] == "#p1" and stored["r1"]["st"] > st1
+        assert stored["r2"]["ds"] == "#p1" and stored["r2"]["st"] > st1
+        assert stored["r3"]["ds"] == "#p3" and stored["r3"]["t1"] == 1
+        assert stored["r3"]["st"] > stored["r0"]["st"]  # was put thrice
+
+
 def test_records_get():
     # This endpoint was added later
 
@@ -1580,6 +2172,518 @@ def test_updates():
         assert "since needs a number" in r.body.decode() and "since" in r.body.decode()
 
 
+def test_updates_last_st():
+    clear_test_db()
+
+    def get_updates(p, since):
+        url = f"http://localhost/api/v2/updates?since={since}"
+        r = p.get(url, headers=HEADERS)
+        assert r.status == 200
+        return dejsonize(r)
+
+    with MockTestServer(our_api_handler) as p:
+        records = [dict(key="r1", mt=100, t1=100, t2=110, ds="")]
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(records).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+
+        # Right after a write, we can exit early without a query
+        d = get_updates(p, 0.001)
+        assert len(d["records"]) == 1
+        st = d["server_time"]
+        d = get_updates(p, st)
+        assert d["reset"] == 0 and d["reset"] is not False
+        assert d["records"] == []
+
+        # Also after a forced reset
+        r = p.put("http://localhost/api/v2/forcereset", headers=HEADERS)
+        assert r.status == 200
+        assert get_updates(p, st)["reset"] is True
+
+        # When another process writes, we don't trust what we know
+        st = get_updates(p, 0.001)["server_time"]
+        db = itemdb.ItemDB(user2filename(USER))
+        with db:
+            db.put_one("records", key="r2", mt=100, t1=100, t2=110, st=st + 1)
+        d = get_updates(p, st)
+        assert [x["key"] for x in d["records"]] == ["r2"]
+
+
+def test_updates_full_stream():
+    clear_test_db()
+
+    ori_batch_size = _apiserver.FULL_UPDATES_BATCH_SIZE
+    _apiserver.FULL_UPDATES_BATCH_SIZE = 10
+
+    try:
+        with MockTestServer(our_api_handler) as p:
+            # Getting all data of an empty db
+            r = p.get("http://localhost/api/v2/updates?since=0", headers=HEADERS)
+            assert r.status == 200
+            assert r.headers["content-type"] == "application/json"
+            d = dejsonize(r)
+            assert d["reset"] is False
+            assert d["records"] == [] and d["settings"] == []
+
+            # Push records and settings, spanning multiple batches
+            for n in (10, 25):
+                records = [
+                    dict(key=f"r{i:02d}", mt=100, t1=100 + i, t2=110 + i, ds="")
+                    for i in range(n)
+                ]
+                settings = [dict(key="s1", mt=100, value="x")]
+                r = p.put(
+                    "http://localhost/api/v2/records",
+                    json.dumps(records).encode(),
+                    headers=HEADERS,
+                )
+                assert r.status == 200
+                r = p.put(
+                    "http://localhost/api/v2/settings",
+                    json.dumps(settings).encode(),
+                    headers=HEADERS,
+                )
+                assert r.status == 200
+
+                # Get all, the response has the same shape
+                r = p.get("http://localhost/api/v2/updates?since=0", headers=HEADERS)
+                assert r.status == 200
+                d = dejsonize(r)
+                assert set(d.keys()) == {"server_time", "reset", "records", "settings"}
+                assert d["reset"] is False
+                assert d["server_time"] > 0
+                assert [x["key"] for x in d["records"]] == [x["key"] for x in records]
+                assert d["records"][5]["t1"] == 105
+                assert [x["key"] for x in d["settings"]] == ["s1"]
+
+                # Incremental updates are not streamed
+                since = d["server_time"]
+                r = p.get(
+                    f"http://localhost/api/v2/updates?since={since}", headers=HEADERS
+                )
+                assert r.status == 200
+                assert dejsonize(r)["records"] == []
+
+            # After a reset, the client must do a full resync
+            r = p.put("http://localhost/api/v2/forcereset", headers=HEADERS)
+            assert r.status == 200
+            r = p.get(f"http://localhost/api/v2/updates?since={since}", headers=HEADERS)
+            assert r.status == 200
+            d = dejsonize(r)
+            assert d["reset"] is True
+            assert len(d["records"]) == 25
+
+    finally:
+        _apiserver.FULL_UPDATES_BATCH_SIZE = ori_batch_size
+
+
+def test_updates_paginated():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+        records = [
+            dict(key=f"r{i}", mt=100, t1=100 + i, t2=110 + i, ds="") for i in range(7)
+        ]
+        settings = [dict(key=f"s{i}", mt=100, value="x") for i in range(3)]
+        for what, items in [("records", records), ("settings", settings)]:
+            r = p.put(
+                f"http://localhost/api/v2/{what}",
+                json.dumps(items).encode(),
+                headers=HEADERS,
+            )
+            assert r.status == 200
+
+        # Get pages of 4 items, records first, then settings
+        pages = []
+        cursor = ""
+        while True:
+            url = f"http://localhost/api/v2/updates?since=0&limit=4&cursor={cursor}"
+            r = p.get(url, headers=HEADERS)
+            assert r.status == 200
+            d = dejsonize(r)
+            pages.append(d)
+            if not d["more"]:
+                assert d["cursor"] is None
+                break
+            cursor = d["cursor"]
+            # Modify a record while paging, it moves to the end
+            if len(pages) == 1:
+                r = p.put(
+                    "http://localhost/api/v2/records",
+                    json.dumps([dict(records[0], mt=110, ds="changed")]).encode(),
+                    headers=HEADERS,
+                )
+                assert r.status == 200
+
+        assert len(pages) == 3
+        assert len(set(d["server_time"] for d in pages)) == 1
+        assert [len(d["records"]) for d in pages] == [4, 4, 0]
+        assert [len(d["settings"]) for d in pages] == [0, 0, 3]
+        keys = [x["key"] for d in pages for x in d["records"]]
+        assert keys == ["r0", "r1", "r2", "r3", "r4", "r5", "r6", "r0"]
+        assert pages[1]["records"][-1]["ds"] == "changed"
+
+        # Without limit, there is no more and cursor
+        r = p.get("http://localhost/api/v2/updates?since=0", headers=HEADERS)
+        assert set(dejsonize(r).keys()) == {
+            "server_time",
+            "reset",
+            "records",
+            "settings",
+        }
+
+        # Bad limit and cursor
+        for query in ["limit=0", "limit=x", "cursor=" + cursor, "limit=4&cursor=foo"]:
+            r = p.get(
+                f"http://localhost/api/v2/updates?since=0&{query}", headers=HEADERS
+            )
+            assert r.status == 400
+
+
+def test_records_paginated():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+        records = [
+            dict(key=f"r{i}", mt=100, t1=100 + i, t2=110 + i, ds="") for i in range(5)
+        ]
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(records).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+
+        keys = []
+        cursor = ""
+        for i in range(3):
+            url = "http://localhost/api/v2/records?timerange=0-200&limit=2"
+            r = p.get(url + "&cursor=" + cursor, headers=HEADERS)
+            assert r.status == 200
+            d = dejsonize(r)
+            keys += [x["key"] for x in d["records"]]
+            assert d["more"] == (i < 2)
+            cursor = d["cursor"] or ""
+        assert keys == ["r0", "r1", "r2", "r3", "r4"]
+
+        url = "http://localhost/api/v2/records?timerange=0-200&limit=2&cursor=W10="
+        assert p.get(url, headers=HEADERS).status == 400
+
+
+def test_etags():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+        url1 = "http://localhost/api/v2/records?timerange=0-200"
+        url2 = "http://localhost/api/v2/records?timerange=0-300"
+        url3 = "http://localhost/api/v2/settings"
+
+        r = p.get(url1, headers=HEADERS)
+        assert r.status == 200
+        etag1 = r.headers["etag"]
+        assert etag1.startswith('W/"')
+
+        # Etag differs per query
+        r = p.get(url2, headers=HEADERS)
+        assert r.headers["etag"] != etag1
+        r = p.get(url3, headers=HEADERS)
+        assert r.status == 200
+        etag3 = r.headers["etag"]
+        assert etag3 != etag1
+
+        # Timing info
+        server_timing = r.headers["server-timing"]
+        assert server_timing.startswith("db;dur=")
+        assert "encode;dur=" in server_timing and "total;dur=" in server_timing
+
+        # Not modified
+        for etag in [etag1, etag1[2:], '"x", ' + etag1, "*"]:
+            r = p.get(url1, headers={**HEADERS, "if-none-match": etag})
+            assert r.status == 304
+            assert r.headers["etag"] == etag1
+        r = p.get(url3, headers={**HEADERS, "if-none-match": etag3})
+        assert r.status == 304
+        r = p.get(url3, headers={**HEADERS, "if-none-match": etag1})
+        assert r.status == 200
+
+        # Modified
+        records = [dict(key="r1", mt=100, t1=100, t2=110, ds="")]
+        r = p.put(
+            "http://localhost/api/v2/records",
+            json.dumps(records).encode(),
+            headers=HEADERS,
+        )
+        assert r.status == 200
+        r = p.get(url1, headers={**HEADERS, "if-none-match": etag1})
+        assert r.status == 200
+        assert r.headers["etag"] != etag1
+        assert len(dejsonize(r)["records"]) == 1
+        r = p.get(url3, headers={**HEADERS, "if-none-match": etag3})
+        assert r.status == 200
+
+
+def test_rate_limit():
+    clear_test_db()
+
+    # Set costs such that a full resync costs 4, and a burst is 5
+    config.rate_limit_costs = "updates_full:3, records_scan:9"
+    config.rate_limit = 1
+    config.rate_limit_burst = 5
+    _apiserver._rate_limiter.clear()
+
+    try:
+        with MockTestServer(our_api_handler) as p:
+            url = "http://localhost/api/v2/updates?since=0"
+            r = p.get(url, headers=HEADERS)
+            assert r.status == 200
+
+            # The bucket has 1 token left
+            r = p.get(url, headers=HEADERS)
+            assert r.status == 429
+            assert 1 <= int(r.headers["retry-after"]) <= 3
+
+            # Cheap requests still work
+            r = p.get("http://localhost/api/v2/settings", headers=HEADERS)
+            assert r.status == 200
+            r = p.get("http://localhost/api/v2/settings", headers=HEADERS)
+            assert r.status == 429
+
+            # A scan of a long time range costs more
+            _apiserver._rate_limiter.clear()
+            url = "http://localhost/api/v2/records?timerange=0-100000000"
+            r = p.get(url, headers=HEADERS)
+            assert r.status == 200
+            r = p.get(url.replace("=0", "=99990000"), headers=HEADERS)
+            assert r.status == 429
+
+            # Stats cost more with more groups (here 1 + 1000 / 100)
+            _apiserver._rate_limiter.clear()
+            url = f"http://localhost/api/v2/stats?timerange=0-{1000 * 86400}"
+            r = p.get(url + "&groupby=day", headers=HEADERS)
+            assert r.status == 200
+            r = p.get(url, headers=HEADERS)
+            assert r.status == 429
+            assert int(r.headers["retry-after"]) >= 6
+
+            # Websocket messages are limited too
+            _apiserver._rate_limiter.clear()
+
+            async def client(ws):
+                await ws.send(json.dumps(dict(type="auth", **HEADERS)))
+                assert json.loads(await ws.receive())["type"] == "auth"
+                for i in range(5):
+                    await ws.send(json.dumps(dict(type="pull", since=1)))
+                    assert json.loads(await ws.receive())["type"] == "updates"
+                msg = dict(type="push", id=7, kind="records", items=[])
+                await ws.send(json.dumps(msg))
+                m = json.loads(await ws.receive())
+                assert m["type"] == "error" and m["status"] == 429
+                assert m["id"] == 7 and m["retry_after"] >= 1
+                return True
+
+            assert p.ws_communicate("/api/v2/sync", client, loop=p._loop)
+
+            # Disabled
+            config.rate_limit = 0
+            assert p.get(url, headers=HEADERS).status == 200
+    finally:
+        config.rate_limit = 0
+        config.rate_limit_burst = 300.0
+        config.rate_limit_costs = ""
+        _apiserver._rate_limiter.clear()
+
+
+def test_updates_longpoll():
+    clear_test_db()
+
+    ori_timeout = config.longpoll_timeout
+    config.longpoll_timeout = 1
+
+    try:
+        with MockTestServer(our_api_handler) as p:
+            # Get server time
+            r = p.get("http://localhost/api/v2/updates?since=0", headers=HEADERS)
+            assert r.status == 200
+            st1 = dejsonize(r)["server_time"]
+
+            # A long poll without changes waits until the timeout
+            t0 = time.time()
+            url = f"http://localhost/api/v2/updates?since={st1}&pollmethod=long"
+            r = p.get(url, headers=HEADERS)
+            assert r.status == 200
+            d = dejsonize(r)
+            assert set(d.keys()) == {"server_time", "reset", "records", "settings"}
+            assert d["records"] == [] and d["settings"] == []
+            assert d["server_time"] > st1 + 0.9
+            assert 0.9 < time.time() - t0 < 2
+
+            # A long poll returns as soon as a change is pushed
+            async def push_later():
+                await asyncio.sleep(0.2)
+                records = [dict(key="r1", mt=110, t1=100, t2=110, ds="A record!")]
+                return await p._co_request(
+                    "PUT",
+                    "http://localhost/api/v2/records",
+                    data=json.dumps(records).encode(),
+                    headers=HEADERS,
+                )
+
+            async def poll_and(co):
+                return await asyncio.gather(
+                    p._co_request("GET", url, headers=HEADERS), co
+                )
+
+            config.longpoll_timeout = 10
+            t0 = time.time()
+            co = poll_and(push_later())
+            (status1, _, body1), (status2, _, _) = p._loop.run_until_complete(co)
+            assert status1 == 200 and status2 == 200
+            assert 0.15 < time.time() - t0 < 2
+            d = json.loads(body1.decode())
+            assert [x["key"] for x in d["records"]] == ["r1"]
+
+            # Same for a force reset
+            async def reset_later():
+                await asyncio.sleep(0.2)
+                url = "http://localhost/api/v2/forcereset"
+                return await p._co_request("PUT", url, headers=HEADERS)
+
+            url = f"http://localhost/api/v2/updates?since={time.time()}&pollmethod=long"
+            t0 = time.time()
+            co = poll_and(reset_later())
+            (status1, _, body1), (status2, _, _) = p._loop.run_until_complete(co)
+            assert status1 == 200 and status2 == 200
+            assert 0.15 < time.time() - t0 < 2
+            assert json.loads(body1.decode())["reset"] is True
+
+            # Invalid pollmethod
+            url = "http://localhost/api/v2/updates?since=0&pollmethod=foo"
+            r = p.get(url, headers=HEADERS)
+            assert r.status == 400
+            assert "pollmethod" in r.body.decode()
+
+    finally:
+        config.longpoll_timeout = ori_timeout
+
+
+def test_websocket_sync():
+    clear_test_db()
+
+    async def send(ws, **kwargs):
+        await ws.send(json.dumps(kwargs))
+
+    async def receive(ws):
+        return json.loads(await ws.receive())
+
+    with MockTestServer(our_api_handler) as p:
+
+        async def client_no_auth(ws):
+            await send(ws, type="pull", since=0)
+            m = await receive(ws)
+            assert m["type"] == "error" and m["status"] == 401
+            with raises(IOError):
+                await ws.receive()  # closed
+
+        async def client_bad_auth(ws):
+            await send(ws, type="auth", authtoken="foo")
+            m = await receive(ws)
+            assert m["type"] == "error" and m["status"] == 401
+            with raises(IOError):
+                await ws.receive()  # closed
+
+        async def client(ws):
+            await send(ws, type="auth", authtoken=HEADERS["authtoken"])
+            assert await receive(ws) == {"type": "auth", "status": "ok"}
+
+            # A full sync must be done with GET updates
+            await send(ws, type="pull", since=0)
+            m = await receive(ws)
+            assert m == {"type": "resync"}
+
+            # Get the state since the last sync
+            await send(ws, type="pull", since=1)
+            m = await receive(ws)
+            assert m["type"] == "updates"
+            assert m["records"] == [] and m["settings"] == []
+
+            # Push a record, get an ack, and then the update
+            records = [dict(key="r1", mt=110, t1=100, t2=110, ds="A record!")]
+            await send(ws, type="push", id=1, kind="records", items=records)
+            m = await receive(ws)
+            assert m["type"] == "ack" and m["id"] == 1 and m["kind"] == "records"
+            assert m["accepted"] == ["r1"] and m["failed"] == [] and m["errors"] == []
+            m = await receive(ws)
+            assert m["type"] == "updates"
+            assert [x["key"] for x in m["records"]] == ["r1"]
+            assert m["records"][0]["st"] > 0
+
+            # Push a setting with an error
+            settings = [dict(key="pref1", mt=110, value=42), dict(key="pref2")]
+            await send(ws, type="push", id=2, kind="settings", items=settings)
+            m = await receive(ws)
+            assert m["type"] == "ack" and m["id"] == 2 and m["kind"] == "settings"
+            assert m["accepted"] == ["pref1"] and m["failed"] == ["pref2"]
+            m = await receive(ws)
+            assert m["type"] == "updates"
+            assert [x["key"] for x in m["settings"]] == ["pref1"]
+
+            # Changes from elsewhere are pushed to us
+            records = [dict(key="r2", mt=110, t1=200, t2=210, ds="Another!")]
+            url = "http://localhost/api/v2/records"
+            data = json.dumps(records).encode()
+            r = await p._co_request("PUT", url, data=data, headers=HEADERS)
+            assert r[0] == 200
+            m = await receive(ws)
+            assert m["type"] == "updates"
+            assert [x["key"] for x in m["records"]] == ["r2"]
+
+            # A reset means that the client must resync, and pull again
+            url = "http://localhost/api/v2/forcereset"
+            r = await p._co_request("PUT", url, headers=HEADERS)
+            assert r[0] == 200
+            m = await receive(ws)
+            assert m == {"type": "resync"}
+            await send(ws, type="pull", since=time.time())
+            m = await receive(ws)
+            assert m["type"] == "updates" and m["reset"] is False
+
+            # Bad messages
+            await ws.send("not json")
+            m = await receive(ws)
+            assert m["type"] == "error" and m["status"] == 400
+            await send(ws, type="foo")
+            m = await receive(ws)
+            assert m["type"] == "error" and "message type" in m["message"]
+            await send(ws, type="push", kind="foo", items=[])
+            m = await receive(ws)
+            assert m["type"] == "error" and "push kind" in m["message"]
+            await send(ws, type="push", kind="records", items={})
+            m = await receive(ws)
+            assert m["type"] == "error" and "must be a list" in m["message"]
+            await send(ws, type="pull", since="foo")
+            m = await receive(ws)
+            assert m["type"] == "error" and "since" in m["message"]
+
+            # Revoking the token closes the connection
+            await get_webtoken_unsafe(USER, reset=True)
+            m = await receive(ws)
+            assert m["type"] == "error" and m["status"] == 401
+            assert "revoked" in m["message"]
+            with raises(IOError):
+                await ws.receive()  # closed
+
+            return True
+
+        p.ws_communicate("/api/v2/sync", client_no_auth, loop=p._loop)
+        p.ws_communicate("/api/v2/sync", client_bad_auth, loop=p._loop)
+        assert p.ws_communicate("/api/v2/sync", client, loop=p._loop)
+
+    HEADERS["authtoken"] = get_webtoken_unsafe_sync(USER)
+
+
 def test_webtoken():
     clear_test_db()
     time.sleep(1.1)
@@ -0,0 +1,112 @@
+import os
+import socket
+import asyncio
+import tempfile
+
+from pytest import raises
+
+from _common import run, run_tests
+from timetagger.server._changes import ChangeNotifier, get_channel_dir
+
+
+def test_change_notifier():
+    async def main():
+        notifier = ChangeNotifier()
+        assert notifier.get_version("a") == 0
+        notifier.notify("a")
+        assert notifier.get_version("a") == 1
+        assert notifier.get_version("b") == 0
+
+        # Wait returns immediately if the version differs
+        assert await notifier.wait("a", 0, 10)
+        # Wait times out
+        assert not await notifier.wait("a", 1, 0.01)
+
+        # Wait is woken up
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, notifier.notify, "a")
+        assert await notifier.wait("a", 1, 10)
+        assert not notifier._waiters
+
+    run(main())
+
+
+def test_change_notifier_between_processes():
+    dirname = tempfile.mkdtemp()
+
+    async def main():
+        # Two notifiers, like in two worker processes
+        notifier1 = ChangeNotifier()
+        notifier2 = ChangeNotifier()
+        received1, received2 = [], []
+        notifier1.add_listener(received1.append)
+        notifier2.add_listener(received2.append)
+        notifier1.connect(dirname)
+        notifier2.connect(dirname)
+        notifier2.connect(dirname)  # no-op
+        assert len(os.listdir(dirname)) == 2
+
+        # A stale socket, of a process that is gone
+        stale = os.path.join(dirname, "123-456.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(stale)
+        sock.close()
+
+        # A change wakes the waiters in the other process
+        version = notifier2.get_version("a")
+        asyncio.get_running_loop().call_later(0.01, notifier1.notify, "a")
+        assert await notifier2.wait("a", version, 10)
+        assert notifier1.get_version("a") == 1
+        assert notifier2.get_version("a") == 1
+        # Listeners are only called for changes of other processes
+        assert received1 == []
+        assert received2 == ["a"]
+        assert not os.path.exists(stale)
+
+        notifier2.notify("b")
+        await asyncio.sleep(0.01)
+        assert received1 == ["b"]
+        assert notifier1.get_version("b") == 1
+
+        notifier1.disconnect()
+        notifier2.disconnect()
+        assert os.listdir(dirname) == []
+
+    run(main())
+
+
+def test_change_notifier_checks_dir():
+    dirname = tempfile.mkdtemp()
+    link = dirname + "-link"
+    os.symlink(dirname, link)
+
+    async def main():
+        notifier = ChangeNotifier()
+        # Not if others can access it
+        os.chmod(dirname, 0o755)
+        with raises(PermissionError):
+            notifier.connect(dirname)
+        # Not if it's a symlink (could point anywhere)
+        os.chmod(dirname, 0o700)
+        with raises(PermissionError):
+            notifier.connect(link)
+        # Ok
+        notifier.connect(dirname)
+        notifier.disconnect()
+
+    try:
+        run(main())
+    finally:
+        os.remove(link)
+
+
+def test_get_channel_dir():
+    dir1 = get_channel_dir("~/_timetagger")
+    dir2 = get_channel_dir(os.path.expanduser("~/_timetagger"))
+    dir3 = get_channel_dir("~/other")
+    assert dir1 == dir2 != dir3
+    assert len(os.path.join(dir1, "12345678-140000000000000.sock")) < 100
+
+
+if __name__ == "__main__":
+    run_tests(globals())
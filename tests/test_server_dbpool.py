@@ -0,0 +1,359 @@
+import gc
+import os
+import time
+import weakref
+import asyncio
+import threading
+import sqlite3
+import tempfile
+
+from _common import run, run_tests, remove_db
+from timetagger import config
+from timetagger.server import user2filename
+from timetagger.server._dbpool import UserDBPool, PooledItemDB, start_db_timing
+from timetagger.server._dbpool import move_user_db, is_moved_user_db
+
+from pytest import raises
+
+TEMP_DIR = tempfile.mkdtemp()
+
+
+def get_filename(name):
+    filename = os.path.join(TEMP_DIR, name + ".db")
+    remove_db(filename)
+    return filename
+
+
+def test_pool_reuse():
+    setup_calls = []
+
+    async def setup(db):
+        setup_calls.append(db)
+        await db.ensure_table("items", "!key")
+
+    pool = UserDBPool(setup)
+    filename = get_filename("reuse")
+
+    async def main():
+        db1 = await pool.get(filename)
+        assert db1.mtime == -1  # did not exist
+        db2 = await pool.get(filename)
+        assert db1 is db2
+        assert len(setup_calls) == 1
+        assert db1.mtime > 0
+
+        # When the file is removed, the db is opened anew
+        remove_db(filename)
+        db3 = await pool.get(filename)
+        assert db3 is not db1
+        assert len(setup_calls) == 2
+        assert db3.mtime == -1
+
+    run(main())
+    assert pool.stats()["hits"] == 1
+    assert pool.stats()["misses"] == 2
+
+    # A new event loop also means a new db
+    run(pool.get(filename))
+    assert len(setup_calls) == 3
+
+
+def test_pool_concurrent_open():
+    setup_calls = []
+
+    async def setup(db):
+        setup_calls.append(db)
+        await asyncio.sleep(0.05)
+        await db.ensure_table("items", "!key")
+        if "fail" in db.filename:
+            raise RuntimeError("setup failed")
+
+    pool = UserDBPool(setup)
+    filename = get_filename("concurrent")
+
+    async def main():
+        # The setup runs once, and all callers get the same db
+        dbs = await asyncio.gather(*[pool.get(filename) for i in range(5)])
+        assert len(setup_calls) == 1
+        assert all(db is dbs[0] for db in dbs)
+
+        # An error in the setup is raised for all callers
+        filename2 = get_filename("concurrent_fail")
+        coros = [pool.get(filename2) for i in range(3)]
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        assert len(setup_calls) == 2
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert not pool._opening
+
+    run(main())
+
+
+def test_pool_eviction():
+    async def setup(db):
+        await db.ensure_table("items", "!key")
+
+    ori_size, ori_idle = config.db_pool_size, config.db_pool_idle
+    pool = UserDBPool(setup)
+    filenames = [get_filename(f"evict{i}") for i in range(5)]
+
+    async def main():
+        # Size bound
+        for filename in filenames:
+            await pool.get(filename)
+        assert len(pool) == 3
+        assert pool.stats()["evictions"] == 2
+        # Most recently used are kept
+        await pool.get(filenames[2])
+        await pool.get(filenames[0])
+        assert len(pool) == 3
+        assert pool.stats()["hits"] == 1
+        # Idle
+        await asyncio.sleep(1.1)
+        config.db_pool_idle = 1
+        await pool.get(filenames[0])
+        assert len(pool) == 1
+        config.db_pool_idle = ori_idle
+
+    async def write(filename):
+        db = await pool.get(filename)
+        async with db:
+            await db.put_one("items", key="a")
+        await db.mark_written()
+
+    async def requests():
+        # Removed dbs are closed when no request uses them
+        filenames = [get_filename(f"evict_many{i}") for i in range(20)]
+        for filename in filenames:
+            await asyncio.create_task(write(filename))
+        assert len(pool) == 3
+        # Also when a request is still using it
+        db = await pool.get(filenames[0])
+        task = asyncio.create_task(write(filenames[1]))
+        pool.clear()
+        await task
+        assert db._removed and not db._closed
+        assert len(await db.select_all("items")) == 1
+
+    def wait_for_threads(n):
+        for _ in range(100):
+            if threading.active_count() <= n:
+                break
+            time.sleep(0.01)
+        return threading.active_count()
+
+    try:
+        config.db_pool_size = 3
+        run(main())
+        pool.clear()
+        nthreads = wait_for_threads(threading.active_count() - 3)
+        run(requests())
+        assert wait_for_threads(nthreads + 3) <= nthreads + 3
+        pool.clear()
+        assert wait_for_threads(nthreads) <= nthreads
+    finally:
+        config.db_pool_size, config.db_pool_idle = ori_size, ori_idle
+
+
+def test_pool_db_is_deleted():
+    filename = get_filename("deleted")
+
+    async def main():
+        db = await PooledItemDB(filename)
+        assert await db.run_in_thread(lambda conn, x: x + 1, 1) == 2
+        ref = weakref.ref(db)
+        del db
+        gc.collect()
+        assert ref() is None
+
+    run(main())
+
+
+def test_pool_transactions():
+    async def setup(db):
+        await db.ensure_table("items", "!key")
+
+    pool = UserDBPool(setup)
+    filename = get_filename("transactions")
+
+    async def writer(db, events):
+        async with db:
+            await db.put_one("items", key="a")
+            events.append("put")
+            await asyncio.sleep(0.1)
+        events.append("commit")
+
+    async def reader(db, events):
+        await asyncio.sleep(0.01)
+        items = await db.select_all("items")
+        events.append(f"read {len(items)}")
+
+    async def main():
+        db = await pool.get(filename)
+        events = []
+        await asyncio.gather(writer(db, events), reader(db, events))
+        # The reader waited for the transaction to finish
+        assert events == ["put", "commit", "read 1"]
+
+        # Nested transactions still fail
+        with raises(IOError):
+            async with db:
+                async with db:
+                    pass
+        # And the db is still usable
+        async with db:
+            await db.put_one("items", key="b")
+        assert len(await db.select_all("items")) == 2
+
+    t0 = time.time()
+    run(main())
+    assert time.time() - t0 < 2
+
+
+def test_pool_pragmas():
+    async def setup(db):
+        await db.ensure_table("items", "!key")
+
+    def get_pragmas(conn):
+        names = "journal_mode", "synchronous", "cache_size", "journal_size_limit"
+        return [conn.execute(f"PRAGMA {name}").fetchone()[0] for name in names]
+
+    pool = UserDBPool(setup)
+    filename = get_filename("pragmas")
+
+    async def main():
+        # The default is the SQLite default, and we wait for locks like itemdb
+        db = await pool.get(filename)
+        assert await db.run_in_thread(get_pragmas) == ["delete", 2, -8192, 4 * 2**20]
+        busy_timeout = await db.run_in_thread(
+            lambda conn: conn.execute("PRAGMA busy_timeout").fetchone()[0]
+        )
+        assert busy_timeout == 60000
+        await db.close()
+        pool.clear()
+
+        # WAL is opt-in
+        config.db_journal_mode = "wal"
+        config.db_synchronous = "normal"
+        db = await pool.get(filename)
+        assert await db.run_in_thread(get_pragmas) == ["wal", 1, -8192, 4 * 2**20]
+
+        # Commits go to the WAL file, and the mtime takes it into account
+        mtime = db.mtime
+        time.sleep(0.02)
+        async with db:
+            await db.put_one("items", key="a")
+        assert os.path.isfile(filename + "-wal")
+        db = await pool.get(filename)
+        assert db.mtime > mtime
+
+        # Another profile
+        config.db_journal_mode = "DELETE"
+        config.db_synchronous = "full"
+        config.db_cache_size = 1000
+        await db.close()  # leaving WAL mode needs exclusive access
+        pool.clear()
+        db = await pool.get(filename)
+        assert await db.run_in_thread(get_pragmas) == ["delete", 2, -1000, 4 * 2**20]
+        assert len(await db.select_all("items")) == 1
+
+        # Invalid values
+        config.db_journal_mode = "foo"
+        pool.clear()
+        with raises(ValueError):
+            await pool.get(filename)
+
+    try:
+        run(main())
+    finally:
+        config.db_journal_mode = "delete"
+        config.db_synchronous = "full"
+        config.db_cache_size = 8192
+
+
+def test_db_timing_and_slow_query_log(caplog):
+    async def setup(db):
+        await db.ensure_table("items", "!key", "x")
+
+    pool = UserDBPool(setup)
+    filename = user2filename("slowtest")
+    remove_db(filename)
+
+    async def main():
+        db = await pool.get(filename)
+        timing = start_db_timing()
+        async with db:
+            await db.put("items", dict(key="a", x=1), dict(key="b", x=2))
+        await db.select("items", "x > ?", 0)
+        await db.select_one("items", "key == ?", "a")
+        assert timing.count == 5  # begin, put, commit, select, select_one
+        assert timing.rows == 2 + 2 + 1
+        assert timing.time > 0
+        header = timing.get_server_timing(total=0.5)
+        assert header.startswith("db;dur=")
+        assert '"5 queries, 5 rows"' in header
+        assert header.endswith(", total;dur=500.0")
+
+        # Log all queries as slow
+        config.slow_query_threshold = 1e-9
+        try:
+            await db.select("items", "x > ?", 0)
+        finally:
+            config.slow_query_threshold = 0.5
+
+    caplog.set_level("WARNING", logger="asgineer")
+    run(main())
+    messages = [r.getMessage() for r in caplog.records]
+    assert len(messages) == 1
+    msg = messages[0]
+    assert "Slow db operation for 'slowtest': select" in msg
+    assert "SQL: SELECT _ob FROM items WHERE x > ?" in msg
+    assert "params: (0,)" in msg
+    assert "plan: SEARCH items USING INDEX" in msg
+
+
+def test_move_user_db():
+    async def setup(db):
+        await db.ensure_table("items", "!key")
+
+    pool = UserDBPool(setup)
+    filename1 = get_filename("move1")
+    filename2 = os.path.join(TEMP_DIR, "ab", "cd", "move2.db")
+    remove_db(filename2)
+
+    async def main():
+        db1 = await pool.get(filename1)
+        async with db1:
+            await db1.put_one("items", key="a")
+
+        # Move while the db is open, and has uncheckpointed changes
+        assert os.path.isfile(filename1 + "-wal")
+        assert move_user_db(filename1, filename2) is True
+        assert not os.path.isfile(filename2 + ".tmp")
+        assert move_user_db(filename1, filename2 + "x") is False
+        with raises(FileExistsError):
+            move_user_db(filename1, filename2)
+
+        # The old db can be read, but no longer written
+        assert len(await db1.select_all("items")) == 1
+        with raises(sqlite3.IntegrityError):
+            async with db1:
+                await db1.put_one("items", key="b")
+        assert len(await db1.select_all("items")) == 1
+
+        # The new db has the data, and can be written
+        db2 = await pool.get(filename2)
+        assert await db2.run_in_thread(is_moved_user_db) is False
+        async with db2:
+            await db2.put_one("items", key="b")
+        assert len(await db2.select_all("items")) == 2
+
+    config.db_journal_mode = "wal"
+    try:
+        run(main())
+    finally:
+        config.db_journal_mode = "delete"
+        pool.clear()
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -1,9 +1,12 @@
 """Tests for main handler routing with path_prefix and app_redirect configuration."""
 
 import sys
+import asyncio
+
+import bcrypt
 
 from asgineer.testutils import MockTestServer
-from _common import run_tests
+from _common import run, run_tests
 
 from timetagger import config
 from timetagger._config import set_config
@@ -292,5 +295,81 @@ def test_combined_features():
         assert r.status == 404
 
 
+def test_check_password():
+    """Test that passwords are checked in a process pool, with a cache."""
+    set_config([], {})
+    get_main_handler()
+    import timetagger.__main__ as main_module
+
+    hash = bcrypt.hashpw(b"secret", bcrypt.gensalt(4)).decode()
+
+    async def main():
+        # Concurrent checks
+        results = await asyncio.gather(
+            main_module.check_password("user1", "secret", hash),
+            main_module.check_password("user1", "wrong", hash),
+            main_module.check_password("user2", "secret", hash),
+        )
+        assert results == [True, False, True]
+        assert main_module._password_checks_pending == 0
+        assert main_module._password_executor is not None
+        # The workers are not forked from the (threaded) server
+        mp_context = main_module._password_executor._mp_context
+        assert mp_context.get_start_method() == "spawn"
+        # Successful checks are cached, and the cache has no passwords
+        assert len(main_module._password_cache) == 2
+        assert "secret" not in repr(main_module._password_cache._d)
+        main_module._password_executor.shutdown()
+        main_module._password_executor = None
+        assert await main_module.check_password("user1", "secret", hash)
+        assert main_module._password_executor is None
+        # Not for another hash
+        hash2 = bcrypt.hashpw(b"other", bcrypt.gensalt(4)).decode()
+        assert not await main_module.check_password("user1", "secret", hash2)
+        # When too many checks are pending, only cached checks succeed
+        main_module._password_checks_pending = main_module.PASSWORD_CHECK_MAX_PENDING
+        try:
+            assert await main_module.check_password("user1", "secret", hash)
+            assert await main_module.check_password("user1", "secret", hash2) is None
+        finally:
+            main_module._password_checks_pending = 0
+
+    try:
+        run(main())
+    finally:
+        if main_module._password_executor is not None:
+            main_module._password_executor.shutdown()
+
+
+def test_get_client_ip():
+    """Test that the client IP is taken from X-Forwarded-For via trusted proxies."""
+    set_config([], {"TIMETAGGER_PROXY_AUTH_TRUSTED": "127.0.0.1,10.0.0.0/8"})
+    get_main_handler()
+    import timetagger.__main__ as main_module
+
+    class FakeRequest:
+        def __init__(self, client, forwarded=None):
+            self.scope = dict(client=client)
+            self.headers = {}
+            if forwarded is not None:
+                self.headers["x-forwarded-for"] = forwarded
+
+    def get_ip(*args):
+        return main_module.get_client_ip(FakeRequest(*args))
+
+    try:
+        assert get_ip(None) is None
+        assert get_ip(("1.2.3.4", 80)) == "1.2.3.4"
+        assert get_ip(("1.2.3.4", 80), "5.6.7.8") == "1.2.3.4"  # not trusted
+        assert get_ip(("10.0.0.2", 80)) is None  # trusted proxy, but no header
+        assert get_ip(("10.0.0.2", 80), "5.6.7.8") == "5.6.7.8"
+        assert get_ip(("10.0.0.2", 80), "9.9.9.9, 5.6.7.8, 127.0.0.1") == "5.6.7.8"
+        assert get_ip(("10.0.0.2", 80), "10.0.0.3") == "10.0.0.3"
+        assert get_ip(("10.0.0.2", 80), "foo") == "foo"
+    finally:
+        set_config([], {})
+        get_main_handler()
+
+
 if __name__ == "__main__":
     run_tests(globals())
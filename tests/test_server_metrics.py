@@ -0,0 +1,106 @@
+import json
+import asyncio
+
+from asgineer.testutils import MockTestServer
+
+from _common import run_tests
+from timetagger.server import _metrics
+from timetagger.server import get_metrics
+from test_server_apiserver import our_api_handler, clear_test_db, HEADERS
+
+
+class FakeRequest:
+    def __init__(self, client, headers=None):
+        self.scope = dict(client=client)
+        self.headers = headers or {}
+
+
+def test_metrics_render():
+    registry = _metrics.Registry()
+    counter = registry.add(_metrics.Counter("x_total", "Some count.", ("path",)))
+    registry.add(_metrics.Gauge("x_size", "Some size.", callback=lambda: 3))
+    hist = registry.add(_metrics.Histogram("x_seconds", "Some time.", (), (1, 2)))
+
+    counter.inc("records")
+    counter.inc("records", amount=2)
+    counter.inc('a"b')
+    hist.observe(value=0.5)
+    hist.observe(value=1.5)
+    hist.observe(value=5)
+    assert counter.get("records") == 3
+    assert hist.get_count() == 3
+
+    text = registry.render()
+    lines = text.splitlines()
+    assert "# TYPE x_total counter" in lines
+    assert 'x_total{path="records"} 3' in lines
+    assert 'x_total{path="a\\"b"} 1' in lines
+    assert "# TYPE x_size gauge" in lines
+    assert "x_size 3" in lines
+    assert "# TYPE x_seconds histogram" in lines
+    assert 'x_seconds_bucket{le="1"} 1' in lines
+    assert 'x_seconds_bucket{le="2"} 2' in lines
+    assert 'x_seconds_bucket{le="+Inf"} 3' in lines
+    assert "x_seconds_sum 7.0" in lines
+    assert "x_seconds_count 3" in lines
+
+    registry.clear()
+    assert counter.get("records") == 0
+
+
+def test_metrics_handler():
+    loop = asyncio.new_event_loop()
+    try:
+        # Only from localhost
+        for client in (None, ("10.0.0.2", 1234), ("testclient", 50000)):
+            request = FakeRequest(client)
+            status, _, _ = loop.run_until_complete(get_metrics(request))
+            assert status == 403
+        request = FakeRequest(("127.0.0.1", 1234), {"x-forwarded-for": "1.2.3.4"})
+        status, _, _ = loop.run_until_complete(get_metrics(request))
+        assert status == 403
+
+        request = FakeRequest(("127.0.0.1", 1234))
+        status, headers, body = loop.run_until_complete(get_metrics(request))
+        assert status == 200
+        assert headers["content-type"].startswith("text/plain")
+        assert "timetagger_db_pool_size" in body
+        task = _metrics._lag_monitors.pop(loop)
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+    finally:
+        loop.close()
+
+
+def test_metrics_of_requests():
+    clear_test_db()
+    _metrics.registry.clear()
+
+    with MockTestServer(our_api_handler) as p:
+        records = [dict(key="r1", mt=100, t1=100, t2=110, ds="")]
+        body = json.dumps(records).encode()
+        r = p.put("http://localhost/api/v2/records", body, headers=HEADERS)
+        assert r.status == 200
+        r = p.get("http://localhost/api/v2/updates?since=0", headers=HEADERS)
+        assert r.status == 200
+        r = p.get("http://localhost/api/v2/records?timerange=x", headers=HEADERS)
+        assert r.status == 400
+        r = p.get("http://localhost/api/v2/nope", headers=HEADERS)
+        assert r.status == 404
+        r = p.get("http://localhost/api/v2/records", headers={"authtoken": "x"})
+        assert r.status == 401
+
+    assert _metrics.requests_total.get("records", "PUT", 200) == 1
+    assert _metrics.requests_total.get("updates", "GET", 200) == 1
+    assert _metrics.requests_total.get("records", "GET", 400) == 1
+    assert _metrics.requests_total.get("other", "GET", 404) == 1
+    assert _metrics.request_duration.get_count("records", "GET") == 1
+    assert _metrics.auth_failures_total.get("invalid") == 1
+    assert _metrics.payload_size.get_count("records", "in") == 1
+    assert _metrics.payload_size.get_count("updates", "out") == 1
+    assert _metrics.db_query_duration.get_count("select") > 0
+    assert _metrics.db_query_duration.get_count("commit") > 0
+
+
+if __name__ == "__main__":
+    run_tests(globals())
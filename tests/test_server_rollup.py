@@ -0,0 +1,168 @@
+import os
+import random
+import datetime
+import tempfile
+import zoneinfo
+
+from _common import run, run_tests
+from timetagger import config
+from timetagger.server import _apiserver, _stats
+from timetagger.server._rollup import (
+    get_timezone,
+    split_by_day,
+    rebuild_daily_rollup,
+    check_daily_rollup,
+    select_daily_rollup,
+    get_stats_per_period,
+)
+
+TEMP_DIR = tempfile.mkdtemp()
+
+
+async def get_db(name):
+    filename = os.path.join(TEMP_DIR, name + ".db")
+    return await _apiserver.db_pool.get(filename)
+
+
+def test_split_by_day():
+    utc = datetime.timezone.utc
+    day = 86400
+    t0 = int(datetime.datetime(2024, 3, 30, tzinfo=utc).timestamp())
+
+    assert split_by_day(t0 + 10, t0 + 20, utc) == [("2024-03-30", 10)]
+    assert split_by_day(t0 - 10, t0 + 20, utc) == [
+        ("2024-03-29", 10),
+        ("2024-03-30", 20),
+    ]
+    assert split_by_day(t0, t0 + 2 * day, utc) == [
+        ("2024-03-30", day),
+        ("2024-03-31", day),
+    ]
+
+    # Day boundaries are local, and a day can be shorter because of DST
+    tz = zoneinfo.ZoneInfo("Europe/Amsterdam")
+    t1 = int(datetime.datetime(2024, 3, 31, tzinfo=tz).timestamp())
+    parts = split_by_day(t1 - 60, t1 + day, tz)
+    assert parts == [
+        ("2024-03-30", 60),
+        ("2024-03-31", day - 3600),
+        ("2024-04-01", 3600),
+    ]
+
+
+def test_get_timezone():
+    # UTC works without the tz database
+    assert get_timezone() is datetime.timezone.utc
+    ori_timezone = config.rollup_timezone
+    try:
+        config.rollup_timezone = "Europe/Amsterdam"
+        assert get_timezone() == zoneinfo.ZoneInfo("Europe/Amsterdam")
+    finally:
+        config.rollup_timezone = ori_timezone
+
+
+def test_daily_rollup():
+    random.seed(4)
+    day = 86400
+    t0 = 1_700_000_000
+    descriptions = ["#work", "#work #client", "", "HIDDEN #work"]
+
+    def make_record(i, mt):
+        t1 = t0 + random.randint(0, 60 * day)
+        t2 = t1 + random.choice([0, 600, 5 * 3600, 2 * day])
+        ds = random.choice(descriptions)
+        return dict(key=f"r{i}", mt=mt, t1=t1, t2=t2, ds=ds)
+
+    async def main():
+        db = await get_db("rollup")
+
+        # Put records, and then modify (and hide) some of them
+        records = [make_record(i, 100) for i in range(200)]
+        await _apiserver._put_items(db, "records", records)
+        records = [make_record(i, 110) for i in range(0, 200, 3)]
+        await _apiserver._put_items(db, "records", records)
+        assert await check_daily_rollup(db) == []
+
+        # Select days, from one index scan
+        items = await select_daily_rollup(db, "2023-11-20", "2023-11-26")
+        assert items
+        assert all("2023-11-20" <= item["day"] <= "2023-11-26" for item in items)
+        assert all(not item["tagz"].startswith("HIDDEN") for item in items)
+        total = sum(item["seconds"] for item in await select_daily_rollup(db, "", "9"))
+        records = await db.select_all("records")
+        expected = sum(
+            r["t2"] - r["t1"] for r in records if not r["ds"].startswith("HIDDEN")
+        )
+        assert total == expected
+
+        # The checker finds problems, and a rebuild fixes them
+        async with db:
+            item = items[0]
+            item["seconds"] += 1
+            await db.put("daily_rollup", item)
+            await db.put("daily_rollup", dict(item, key="x", day="2000-01-01"))
+        problems = await check_daily_rollup(db)
+        assert len(problems) == 2
+        await rebuild_daily_rollup(db)
+        assert await check_daily_rollup(db) == []
+
+        # Changing the timezone rebuilds the rollup when the db is opened
+        ori_timezone = config.rollup_timezone
+        try:
+            config.rollup_timezone = "America/New_York"
+            assert len(await check_daily_rollup(db)) > 0
+            _apiserver.db_pool.clear()
+            db = await get_db("rollup")
+            assert await check_daily_rollup(db) == []
+        finally:
+            config.rollup_timezone = ori_timezone
+            _apiserver.db_pool.clear()
+
+    run(main())
+
+
+def test_stats_per_period():
+    random.seed(5)
+    day = 86400
+    t0 = 1_700_000_000
+    now = t0 + 50 * day
+    descriptions = ["#work", "#work #client", "", "HIDDEN #work"]
+
+    def make_record(i):
+        t1 = t0 + random.randint(0, 60 * day)
+        t2 = t1 + random.choice([0, 600, 5 * 3600, 2 * day])
+        return dict(key=f"r{i}", mt=100, t1=t1, t2=t2, ds=random.choice(descriptions))
+
+    def nonzero(stats):
+        return {tagz: seconds for tagz, seconds in stats.items() if seconds}
+
+    async def main():
+        db = await get_db("stats_per_period")
+        records = [make_record(i) for i in range(300)]
+        await _apiserver._put_items(db, "records", records)
+
+        # The same result as get_stats() per period, for ranges that start
+        # halfway a day, and for days that are aligned with the rollup or not
+        t1, t2 = t0 - 3 * day - 1234, t0 + 61 * day + 4321
+        for groupby in _stats.GROUPBY_OPTIONS:
+            for tzoffset in (0, 3600):
+                periods = _stats.get_periods(t1, t2, groupby, tzoffset)
+                result = await get_stats_per_period(db, periods, now)
+                assert len(result) == len(periods)
+                for (p1, p2), stats in zip(periods, result):
+                    expected = await _stats.get_stats(db, p1, p2, now)
+                    assert nonzero(stats) == nonzero(expected)
+
+        assert await get_stats_per_period(db, [], now) == []
+
+        # Periods outside the range of the rollup (and datetime)
+        periods = [(253402300000, 253402300000 + day)]
+        expected = await _stats.get_stats(db, *periods[0], now)
+        assert await get_stats_per_period(db, periods, now) == [expected]
+        _apiserver.db_pool.clear()
+
+    run(main())
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -1,7 +1,9 @@
 import os
+import json
 import time
 
-from _common import run_tests
+from _common import run_tests, remove_db
+from timetagger import config
 from timetagger.server import _utils as utils
 
 from pytest import raises
@@ -35,6 +37,43 @@ def test_user2filename_and_filename2user():
         assert utils.filename2user(filename) == username
 
 
+def test_user2filename_layouts():
+    username = "sharded@test.com"
+    flat = utils.user2filename(username, "flat")
+    sharded = utils.user2filename(username, "sharded")
+    assert flat == utils.user2filename(username)  # the default
+    assert os.path.dirname(flat) == utils.ROOT_USER_DIR
+    assert os.path.basename(sharded) == os.path.basename(flat)
+    shard = os.path.relpath(os.path.dirname(sharded), utils.ROOT_USER_DIR)
+    assert len(shard) == 5 and shard[2] == os.sep
+    assert utils.filename2user(sharded) == username
+    with raises(ValueError):
+        utils.user2filename(username, "foo")
+
+    remove_db(flat)
+    remove_db(sharded)
+    config.user_dir_layout = "sharded"
+    try:
+        # A new db is in the sharded layout, and its directory is created
+        assert utils.user2filename(username) == sharded
+        assert os.path.isdir(os.path.dirname(sharded))
+
+        # An existing db in the flat layout is used until it's moved
+        with open(flat, "wb"):
+            pass
+        assert utils.user2filename(username) == flat
+        assert flat in utils.list_user_filenames()
+        with open(sharded, "wb"):
+            pass
+        assert utils.user2filename(username) == sharded
+        filenames = utils.list_user_filenames()
+        assert sharded in filenames and flat not in filenames
+    finally:
+        config.user_dir_layout = "flat"
+        remove_db(flat)
+        remove_db(sharded)
+
+
 def test_jwt_stuff():
     exp = time.time() + 100
 
@@ -68,6 +107,103 @@ def test_jwt_stuff():
         utils.decode_jwt("not.a.token")
 
 
+def test_ttl_cache():
+    cache = utils.TTLCache(3, 0.2)
+    assert cache.get("a") is None
+    assert cache.get("a", 42) == 42
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1 and cache.get("b") == 2
+    assert len(cache) == 2
+
+    # Size bound drops the oldest
+    cache.set("c", 3)
+    cache.set("d", 4)
+    assert len(cache) == 3
+    assert cache.get("a") is None
+    assert cache.get("d") == 4
+
+    # Discard
+    cache.discard("d")
+    cache.discard("d")
+    assert cache.get("d") is None
+
+    # Expiration
+    time.sleep(0.3)
+    assert cache.get("b") is None
+    assert cache.get("c") is None
+    assert len(cache) == 0
+
+
+def test_token_bucket_limiter():
+    limiter = utils.TokenBucketLimiter(3)
+
+    # Burst of 5 tokens
+    for i in range(5):
+        assert limiter.consume("a", 1, 10, 5) == 0
+    retry_after = limiter.consume("a", 1, 10, 5)
+    assert 0 < retry_after <= 0.1
+    assert limiter.consume("b", 1, 10, 5) == 0
+
+    # Refill
+    time.sleep(0.11)
+    assert limiter.consume("a", 1, 10, 5) == 0
+
+    # Size bound drops the least recent
+    limiter.consume("c", 1, 10, 5)
+    limiter.consume("d", 1, 10, 5)
+    assert len(limiter) == 3
+
+    # Buckets that are full again are dropped
+    time.sleep(0.6)
+    limiter.consume("e", 1, 10, 5)
+    assert len(limiter) == 1
+
+    # A cost larger than the burst is allowed once, leaving a debt
+    assert limiter.consume("f", 20, 10, 5) == 0
+    assert limiter.consume("f", 1, 10, 5) > 1
+
+    limiter.clear()
+    assert len(limiter) == 0
+
+
+def test_json_list_parser():
+    items = [dict(key=f"r{i}", mt=i, ds="é #foo [,]") for i in range(20)]
+    items += [1, 23, 4.5, True, None, "x", [1, 2], {}]
+    text = " " + json.dumps(items, indent=1) + "\n"
+
+    # Feed in pieces of different sizes
+    for n in (1, 2, 7, 100, len(text)):
+        parser = utils.JSONListParser()
+        result = []
+        for i in range(0, len(text), n):
+            result += parser.feed(text[i : i + n])
+        result += parser.feed("", True)
+        assert result == items
+
+    # Empty list
+    parser = utils.JSONListParser()
+    assert parser.feed("[") == []
+    assert parser.feed(" ]", True) == []
+
+    # Not a list
+    for text in ["{}", "3", '"x"', "foo"]:
+        with raises(TypeError):
+            utils.JSONListParser().feed(text, True)
+
+    # Invalid or incomplete
+    for text in ["[", "[1", "[1,", "[1 2]", "[1,]", "[}]", "[1] 2", "[1]]", "[,1]"]:
+        with raises(ValueError):
+            utils.JSONListParser().feed(text, True)
+
+    # Elements are limited in size, so memory use is bounded
+    parser = utils.JSONListParser(100)
+    parser.feed('["' + "x" * 90)
+    with raises(ValueError):
+        parser.feed("x" * 20)
+
+
 def test_scss_stuff():
     text = """
     $foo: #fff;
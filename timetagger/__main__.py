@@ -21,9 +21,14 @@ using a modified version of this script.
 
 import sys
 import json
+import asyncio
+import hashlib
 import logging
+import secrets
+import multiprocessing
 from base64 import b64decode
 from importlib import resources
+from concurrent.futures import ProcessPoolExecutor
 
 import bcrypt
 import asgineer
@@ -36,10 +41,16 @@ from timetagger.server import (
     authenticate,
     AuthException,
     api_handler_triage,
+    api_handler_websocket,
     get_webtoken_unsafe,
+    get_rate_limit_cost,
+    rate_limit,
+    get_metrics,
     create_assets_from_dir,
     enable_service_worker,
 )
+from timetagger.server import _metrics
+from timetagger.server._utils import TTLCache
 
 # Special hooks exit early
 if __name__ == "__main__" and len(sys.argv) >= 2:
@@ -92,6 +103,8 @@ async def main_handler(request):
     if request.path.startswith(config.path_prefix):
         if request.path == f"{config.path_prefix}status":
             return 200, {}, "ok"
+        elif request.path == f"{config.path_prefix}metrics":
+            return await get_metrics(request)
         elif request.path.startswith(f"{config.path_prefix}api/v2/"):
             path = request.path.removeprefix(f"{config.path_prefix}api/v2/").strip("/")
             return await api_handler(request, path)
@@ -118,7 +131,16 @@ async def api_handler(request, path):
         return 200, {}, "See https://timetagger.readthedocs.io"
     elif path == "bootstrap_authentication":
         # The client-side that requests these is in pages/login.md
+        ip = get_client_ip(request)
+        if ip:
+            response = rate_limit("ip:" + ip, get_rate_limit_cost("bootstrap"))
+            if response:
+                return response
         return await get_webtoken(request)
+    elif path == "sync" and isinstance(request, asgineer.WebsocketRequest):
+        # The websocket authenticates via its first message
+        validate = validate_auth if config.proxy_auth_enabled else None
+        return await api_handler_websocket(request, validate)
 
     # Authenticate and get user db
     try:
@@ -133,6 +155,35 @@ async def api_handler(request, path):
     return await api_handler_triage(request, path, auth_info, db)
 
 
+def get_client_ip(request):
+    """Get the IP address of the client, or None if it's not known. If the
+    request comes from a trusted proxy, the X-Forwarded-For header is used.
+    A request from a trusted proxy without that header has no known IP,
+    because it may represent any client.
+    """
+    client = request.scope.get("client", None)
+    if not client:
+        return None  # e.g. a Unix socket
+    ip = client[0]
+    if not _is_trusted_proxy(ip):
+        return ip
+    # Each proxy appends the address it got the request from
+    ip = None
+    forwarded = request.headers.get("x-forwarded-for", "")
+    for address in reversed(forwarded.split(",")):
+        ip = address.strip() or None
+        if not _is_trusted_proxy(ip):
+            break
+    return ip
+
+
+def _is_trusted_proxy(ip):
+    try:
+        return ip in TRUSTED_PROXIES
+    except Exception:  # invalid address
+        return False
+
+
 async def get_webtoken(request):
     """Exhange some form of trust for a webtoken."""
 
@@ -195,14 +246,76 @@ async def get_webtoken_usernamepassword(request, auth_info):
     pw = auth_info.get("password", "").strip()
     # Get hash for this user
     hash = CREDENTIALS.get(user, "")
+    if not (user and hash):
+        return 403, {}, "Invalid credentials"
     # Check
-    if user and hash and bcrypt.checkpw(pw.encode(), hash.encode()):
+    ok = await check_password(user, pw, hash)
+    if ok is None:
+        return 503, {"retry-after": "5"}, "Too many login attempts, try again later"
+    elif ok:
         token = await get_webtoken_unsafe(user)
         return 200, {}, dict(token=token)
     else:
         return 403, {}, "Invalid credentials"
 
 
+# Bcrypt is slow by design. The checks are done in a process pool, so that
+# they don't block the event loop (and thus other users). Successful checks
+# are cached for a short time, so that e.g. multiple devices logging in at
+# once don't repeat the work. The cache does not store the passwords, but a
+# salted digest. The workers are spawned rather than forked, because forking
+# a process that runs threads (e.g. of the db pool) can deadlock the child.
+PASSWORD_CHECK_WORKERS = 2
+PASSWORD_CHECK_MAX_PENDING = 64
+PASSWORD_CACHE_TTL = 300
+
+_password_executor = None
+_password_checks_pending = 0
+_password_cache = TTLCache(1000, PASSWORD_CACHE_TTL)
+_password_cache_salt = secrets.token_bytes(16)
+
+_metrics.registry.add(
+    _metrics.Gauge(
+        "timetagger_password_checks_pending",
+        "Number of password checks that are running or waiting.",
+        callback=lambda: _password_checks_pending,
+    )
+)
+
+
+async def check_password(user, pw, hash):
+    """Check the password against the given bcrypt hash, without
+    blocking the event loop. Returns None if too many checks are pending
+    (and the check is not in the cache).
+    """
+    global _password_executor, _password_checks_pending
+
+    key = hashlib.sha256(
+        b"\0".join([_password_cache_salt, user.encode(), pw.encode(), hash.encode()])
+    ).digest()
+    if _password_cache.get(key, False):
+        return True
+    if _password_checks_pending >= PASSWORD_CHECK_MAX_PENDING:
+        return None
+
+    if _password_executor is None:
+        _password_executor = ProcessPoolExecutor(
+            PASSWORD_CHECK_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    loop = asyncio.get_running_loop()
+    _password_checks_pending += 1
+    try:
+        ok = await loop.run_in_executor(
+            _password_executor, bcrypt.checkpw, pw.encode(), hash.encode()
+        )
+    finally:
+        _password_checks_pending -= 1
+
+    if ok:
+        _password_cache.set(key, True)
+    return ok
+
+
 async def get_webtoken_localhost(request, auth_info):
     """An authentication handler that provides a webtoken when the
     hostname is localhost. See `get_webtoken_unsafe()` for details.
@@ -252,7 +365,27 @@ CREDENTIALS = load_credentials()
 TRUSTED_PROXIES = load_trusted_proxies()
 
 
+def get_server_options():
+    """Get the options for uvicorn from the config."""
+    options = dict(
+        workers=max(1, config.workers),
+        loop=config.loop,
+        http=config.http,
+        backlog=config.backlog,
+        timeout_keep_alive=config.keep_alive_timeout,
+        log_level="warning",
+    )
+    if config.max_concurrency > 0:
+        options["limit_concurrency"] = config.max_concurrency
+    return options
+
+
 if __name__ == "__main__":
+    # With multiple workers, uvicorn binds the socket, and then starts the
+    # worker processes, which all accept connections on that socket.
     asgineer.run(
-        "timetagger.__main__:main_handler", "uvicorn", config.bind, log_level="warning"
+        "timetagger.__main__:main_handler",
+        "uvicorn",
+        config.bind,
+        **get_server_options(),
     )
@@ -26,6 +26,27 @@ class Config:
     * `bind (str)`: the address and port to bind on. Default "127.0.0.1:8080".
     * `datadir (str)`: the directory to store data. Default "~/_timetagger".
       The user db's are stored in `datadir/users`.
+    * `user_dir_layout (str)`: how the user db's are organized in
+      `datadir/users`. In the "flat" layout, they're all in that directory.
+      In the "sharded" layout, they are in subdirectories based on a hash of
+      the username (e.g. `users/ab/cd/name.db`), which keeps directories
+      small when there are many users. Db's that are still in the flat
+      layout are found too; see `contrib/shard_user_dbs` to move them.
+      Default "flat".
+    * `workers (int)`: the number of worker processes of the server. The
+      workers share the listening socket, and notify each other of changes.
+      In-process state, like rate limits and metrics, is per worker. Default 1.
+    * `loop (str)`: the event loop implementation, "auto", "asyncio" or
+      "uvloop". With "auto", uvloop is used when installed. Default "auto".
+    * `http (str)`: the HTTP parser, "auto", "h11" or "httptools". With "auto",
+      httptools is used when installed. Default "auto".
+    * `backlog (int)`: the maximum number of connections that wait to be
+      accepted. Default 2048.
+    * `keep_alive_timeout (int)`: the number of seconds to keep an idle
+      connection open. Default 5.
+    * `max_concurrency (int)`: the maximum number of concurrent connections
+      and tasks per worker, after which new requests get a 503. Default 0
+      (no limit).
     * `log_level (str)`: the log level for timetagger and asgineer
       (not the asgi server). Default "info".
     * `credentials (str)`: login credentials for one or more users, in the
@@ -36,11 +57,59 @@ class Config:
       (for example Authelia). Default "False".
     * `proxy_auth_trusted (str)`: list of trusted reverse proxy IPs with or without CIDR, in the
       form "127.0.0.1,10.0.0.1,10.99.0.0/24,192.168/16". Default "127.0.0.1".
+      For requests from these IPs, the X-Forwarded-For header is used to get
+      the client IP, e.g. for the rate limiting of logins.
     * `proxy_auth_header (str)`: name of the proxy header which contains the
       username of the logged in user. Default "X-Remote-User".
     * `path_prefix (str)`: the path prefix where timetagger is served. Default "/timetagger/".
     * `app_redirect (bool)`: whether to redirect the root path "/" directly to the timetagger app,
       instead of the promotional landing page. Default "False".
+    * `db_pool_size (int)`: the maximum number of user databases that the
+      server keeps open. Each open database uses a file descriptor and a
+      thread. Default 256.
+    * `db_pool_idle (int)`: the number of seconds after which an unused
+      user database is closed. Default 300.
+    * `db_journal_mode (str)`: the SQLite journal mode of user databases.
+      In "wal" mode, readers and writers don't block each other, but the
+      data dir must be on a local filesystem, and backups must include the
+      "-wal" files (or use the SQLite backup API). Default "delete" (the
+      SQLite default).
+    * `db_synchronous (str)`: the SQLite synchronous level, "off", "normal",
+      "full" or "extra". With WAL, "normal" is safe against corruption, but
+      the last commits may be lost on power failure. Default "full" (the
+      SQLite default).
+    * `db_cache_size (int)`: the SQLite page cache size per open user database,
+      in KiB. Default 8192.
+    * `db_mmap_size (int)`: the maximum number of bytes of a user database
+      that SQLite memory-maps. Default 0 (disabled).
+    * `db_busy_timeout (float)`: the number of seconds to wait for a lock held
+      by another connection (e.g. another worker or a script). Default 60 (the
+      same as itemdb).
+    * `db_wal_autocheckpoint (int)`: the number of pages in the WAL file after
+      which SQLite checkpoints it into the database. Default 1000.
+    * `db_journal_size_limit (int)`: the number of bytes to which the WAL file
+      is truncated after a checkpoint. Default 4194304 (4 MiB).
+    * `longpoll_timeout (int)`: the maximum number of seconds that a request
+      to `/updates?pollmethod=long` is held open while waiting for changes.
+      Default 30.
+    * `worker_notifications (bool)`: whether to notify changes to the other
+      worker processes of the server (on the same machine). This is always
+      enabled when `workers` is larger than 1, and can be enabled for e.g. a
+      custom multi-process setup. Default "False".
+    * `rollup_timezone (str)`: the timezone (e.g. "Europe/Amsterdam") that
+      determines the day boundaries in the per-day rollup of records.
+      Changing it rebuilds the rollups. Default "UTC".
+    * `slow_query_threshold (float)`: database operations that take longer
+      than this number of seconds are logged, with their SQL and query plan.
+      Set to 0 to disable. Default 0.5.
+    * `rate_limit (float)`: the number of request tokens per second that each
+      user (and each client IP that logs in) gets. Set to 0 to disable rate
+      limiting. Default 10.
+    * `rate_limit_burst (float)`: the maximum number of tokens that a user can
+      save up, i.e. the size of a burst of requests. Default 300.
+    * `rate_limit_costs (str)`: the costs of requests in tokens, overriding the
+      defaults, in the form "updates_full:50,push_mib:20". See
+      ``RATE_LIMIT_COSTS`` in the apiserver for the names. Default "".
 
     The values can be configured using CLI arguments and environment variables.
     For CLI arguments, the following formats are supported:
@@ -58,6 +127,13 @@ class Config:
     _ITEMS = [
         ("bind", str, "127.0.0.1:8080"),
         ("datadir", str, "~/_timetagger"),
+        ("user_dir_layout", str, "flat"),
+        ("workers", int, 1),
+        ("loop", str, "auto"),
+        ("http", str, "auto"),
+        ("backlog", int, 2048),
+        ("keep_alive_timeout", int, 5),
+        ("max_concurrency", int, 0),
         ("log_level", str, "info"),
         ("credentials", str, ""),
         ("proxy_auth_enabled", to_bool, False),
@@ -65,6 +141,22 @@ class Config:
         ("proxy_auth_header", str, "X-Remote-User"),
         ("path_prefix", to_path_prefix, "/timetagger/"),
         ("app_redirect", to_bool, False),
+        ("db_pool_size", int, 256),
+        ("db_pool_idle", int, 300),
+        ("db_journal_mode", str, "delete"),
+        ("db_synchronous", str, "full"),
+        ("db_cache_size", int, 8192),
+        ("db_mmap_size", int, 0),
+        ("db_busy_timeout", float, 60.0),
+        ("db_wal_autocheckpoint", int, 1000),
+        ("db_journal_size_limit", int, 4 * 2**20),
+        ("longpoll_timeout", int, 30),
+        ("worker_notifications", to_bool, False),
+        ("rollup_timezone", str, "UTC"),
+        ("slow_query_threshold", float, 0.5),
+        ("rate_limit", float, 10.0),
+        ("rate_limit_burst", float, 300.0),
+        ("rate_limit_costs", str, ""),
     ]
     __slots__ = [name for name, _, _ in _ITEMS]
 
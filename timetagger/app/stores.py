@@ -721,6 +721,7 @@ class BaseDataStore:
         self.state = ""  # pending, sync, warning, error, ""
         # Sync stuff
         self._to_push = {"settings": {}, "records": {}}
+        self._poll_delay = 10
         window.clearTimeout(self._sync_timeout)
         window.clearTimeout(self._state_timeout)
         # Sync the settings API
@@ -768,7 +769,8 @@ class BaseDataStore:
                 window.canvas.update()
         finally:
             if self._sync_timeout is None and not window.document.hidden:
-                self.sync_soon()  # Post a sync to keep getting updates
+                # Post a sync to keep getting updates
+                self.sync_soon(self._poll_delay)
         # Reset state, leave current state shown for a bit if _sync() set it.
         if self.state == "sync":
             self._set_state("", 0.25)
@@ -782,11 +784,25 @@ class BaseDataStore:
 class ConnectedDataStore(BaseDataStore):
     """A data store that communicates with the server."""
 
+    def __init__(self):
+        # The websocket sync channel, used instead of polling when available
+        self._ws = None
+        self._ws_ok = True  # becomes False if the server does not support it
+        self._ws_ready = False
+        self._ws_pulling = False  # whether the server sends us updates
+        self._ws_id = 0
+        self._ws_pending = {}
+        self._pull_page_size = 2000
+        super().__init__()
+
     def reset(self):
         super().reset()
         self._server_time = 0
+        self._pull_cursor = None  # set while getting updates in pages
         self._last_auth_get = 0
         self._pull_statuses = [0, 0, 0, 0, 0]
+        self._long_poll_ok = True
+        self._long_poll_pending = False
         self._auth = window.tools.get_auth_info()
         self._auth_cantuse = None
 
@@ -829,9 +845,10 @@ class ConnectedDataStore(BaseDataStore):
             try:
                 storage = window.tools.AsyncStorage()
                 ob = await storage.getItem(self._auth.username)
-                if ob and ob.server_time:
+                if ob and (ob.server_time or ob.pull_cursor):
                     self._log_load("cache", ob)
                     self._server_time = ob.server_time
+                    self._pull_cursor = ob.pull_cursor or None
                     self.settings._put_received(*ob.settings)
                     self.records._put_received(*ob.records)
                     for item in ob.settings:
@@ -849,6 +866,7 @@ class ConnectedDataStore(BaseDataStore):
                 dump = {
                     "key": self._auth.username,
                     "server_time": self._server_time,
+                    "pull_cursor": self._pull_cursor,
                     "settings": self.settings.get_dump(),
                     "records": self.records.get_dump(),
                 }
@@ -868,12 +886,21 @@ class ConnectedDataStore(BaseDataStore):
             self.last_error = auth.cantuse or "Not authenticated"
             return
         # Get from local cache?
-        if self._server_time == 0:
+        if self._server_time == 0 and not self._pull_cursor:
             await self._load_from_cache()
-        # Push to server, then pull
-        for kind in ["settings", "records"]:
-            await self._push(kind, auth.token)
-        await self._pull(auth.token)
+        if self._ws_pulling:
+            # Push over the websocket, the server sends us the updates
+            for kind in ["settings", "records"]:
+                self._ws_push(kind)
+        else:
+            # Try to connect the websocket, to use from the next sync
+            self._ws_connect(auth.token)
+            # Push to server, then pull. A first sync (or resync) is done
+            # this way, in pages, and then the websocket can take over.
+            for kind in ["settings", "records"]:
+                await self._push(kind, auth.token)
+            await self._pull(auth.token)
+            self._ws_pull()
         # Save to local cache
         await self._save_to_cache()
 
@@ -891,13 +918,21 @@ class ConnectedDataStore(BaseDataStore):
             return
         self._to_push[kind] = {}
 
+        # Compress the body if it's large and the browser supports it
+        body = JSON.stringify(items.values())
+        headers = {"authtoken": authtoken}
+        if window.CompressionStream and len(body) > 1024:
+            try:
+                stream = window.Blob([body]).stream()
+                stream = stream.pipeThrough(window.CompressionStream("gzip"))
+                body = await window.Response(stream).arrayBuffer()
+                headers["content-encoding"] = "gzip"
+            except Exception as err:
+                console.warn(err)
+
         # Fetch and wait for response
         url = tools.build_api_url(kind)
-        init = dict(
-            method="PUT",
-            body=JSON.stringify(items.values()),
-            headers={"authtoken": authtoken},
-        )
+        init = dict(method="PUT", body=body, headers=headers)
         try:
             res = await window.fetch(url, init)
         except Exception as err:
@@ -939,21 +974,70 @@ class ConnectedDataStore(BaseDataStore):
             console.warn(self.last_error)
 
         else:
-            # Success, but it can still mean that some records failed. In this
-            # case these records are likely corrupt, so we delete them, and
-            # will get the server's version back when we pull.
             d = JSON.parse(await res.text())
-            # d.accepted -> list of ok keys
-            for key in d.failed:
-                self[kind]._drop(key)
-            for err in d.errors:
-                self._set_state("warning")
-                self.last_error = f"Server dropped a {kind}: {err}"
-                console.warn(self.last_error)
+            self._process_push_result(kind, d)
+
+    def _process_push_result(self, kind, d):
+        # Success, but it can still mean that some records failed. In this
+        # case these records are likely corrupt, so we delete them, and
+        # will get the server's version back when we pull.
+        # d.accepted -> list of ok keys
+        for key in d.failed:
+            self[kind]._drop(key)
+        for err in d.errors:
+            self._set_state("warning")
+            self.last_error = f"Server dropped a {kind}: {err}"
+            console.warn(self.last_error)
 
     async def _pull(self, authtoken):
+        # Use long polling if we're idle, so that the server holds the
+        # request until there are changes. Then we can poll again right
+        # away, and changes from other devices arrive quickly.
+        long_poll = (
+            self._long_poll_ok
+            and self._ws is None
+            and not self._long_poll_pending
+            and not self._pull_cursor
+            and self._server_time > 0
+            and len(self._to_push["settings"].keys()) == 0
+            and len(self._to_push["records"].keys()) == 0
+        )
+
+        # Get the updates in pages. Each page is stored, so that when we
+        # get interrupted (e.g. on a first sync) we can continue later.
+        t0 = dt.now()
+        while True:
+            query = "updates?since=" + self._server_time
+            query += "&limit=" + self._pull_page_size + "&format=columnar"
+            is_long_poll = False
+            if self._pull_cursor:
+                query += "&cursor=" + self._pull_cursor
+            elif long_poll:
+                query += "&pollmethod=long"
+                is_long_poll = self._long_poll_pending = True
+                self._set_state("")  # don't show a spinner while we wait
+            try:
+                res, ob = await self._pull_page(query, authtoken)
+            finally:
+                # Only this request may clear the flag, not other fetches
+                if is_long_poll:
+                    self._long_poll_pending = False
+            if ob is None or not self._pull_cursor:
+                break
+            await self._save_to_cache()
+
+        # Determine when to poll next. A long poll that returns quickly
+        # without changes means that the server does not support it.
+        self._poll_delay = 10
+        if long_poll and res.status == 200:
+            if ob.reset or ob.settings or ob.records or dt.now() - t0 > 5:
+                self._poll_delay = 0.5
+            else:
+                self._long_poll_ok = False
+
+    async def _pull_page(self, query, authtoken):
         # Fetch and wait for response
-        url = tools.build_api_url("updates?since=" + self._server_time)
+        url = tools.build_api_url(query)
         init = dict(method="GET", headers={"authtoken": authtoken})
         try:
             res = await window.fetch(url, init)
@@ -963,6 +1047,7 @@ class ConnectedDataStore(BaseDataStore):
         self._pull_statuses = self._pull_statuses[-5:]
 
         # Process response
+        ob = None
         if res.status != 200:
             text = await res.text()
             self._set_state("error")  # E.g. Wifi or server down, or 500
@@ -980,34 +1065,165 @@ class ConnectedDataStore(BaseDataStore):
                     window.location.href = "../logout"
         else:
             ob = JSON.parse(await res.text())
-            if ob.server_time:
-                self._log_load("server", ob)
-                # Reset?
-                if ob.reset:
-                    await self._clear_cache()
-                    self.reset()
+            await self._process_updates(ob)
+        return res, ob
+
+    async def _process_updates(self, ob, paged=True):
+        if ob.server_time:
+            self._log_load("server", ob)
+            # Reset? The next pages of a paginated update have the same flag.
+            if ob.reset and not self._pull_cursor:
+                await self._clear_cache()
+                self.reset()
+            # While paging, the server_time is only used after the last page.
+            # Updates from the websocket must not interfere with the paging.
+            if not paged:
+                if not self._pull_cursor:
+                    self._server_time = ob.server_time
+            elif ob.more:
+                self._pull_cursor = ob.cursor
+            else:
                 self._server_time = ob.server_time
-                # The odds of something going wrong here are tiny ...
-                # but if they happen, we're out of sync with the server :(
-                try:
-                    self.settings._put_received(*ob.settings)
-                except Exception as err:
-                    self._set_state("warning")
-                    self.last_error = err
-                    console.error(err)
-                    window.alert("Sync error (settings), see dev console for details.")
-                try:
-                    self.records._put_received(*ob.records)
-                except Exception as err:
-                    self._set_state("warning")
-                    self.last_error = err
-                    console.error(err)
-                    window.alert("Sync error (records), see dev console for details.")
-
-                # Set state to ok if we got new items, and if there were no errors
-                if ob.settings or ob.records:
-                    if self.state != "warning":
-                        self._set_state("ok")
+                self._pull_cursor = None
+            # The odds of something going wrong here are tiny ...
+            # but if they happen, we're out of sync with the server :(
+            try:
+                self.settings._put_received(*ob.settings)
+            except Exception as err:
+                self._set_state("warning")
+                self.last_error = err
+                console.error(err)
+                window.alert("Sync error (settings), see dev console for details.")
+            try:
+                records = ob.records
+                if ob.format == "columnar":
+                    records = self._records_from_columns(records)
+                self.records._put_received(*records)
+            except Exception as err:
+                self._set_state("warning")
+                self.last_error = err
+                console.error(err)
+                window.alert("Sync error (records), see dev console for details.")
+
+            # Set state to ok if we got new items, and if there were no errors
+            if ob.settings or ob.records:
+                if self.state != "warning":
+                    self._set_state("ok")
+
+    def _records_from_columns(self, blocks):
+        # Decode records in the columnar format, see the server for details
+        records = []
+        for block in blocks:
+            for i in range(len(block.key)):
+                record = dict(
+                    key=block.key[i],
+                    mt=block.mt[i],
+                    t1=block.t1[i],
+                    t2=block.t2[i],
+                    st=block.st[i],
+                )
+                ds_index = block.ds[i]
+                if ds_index is not None:
+                    record.ds = block.ds_values[ds_index]
+                records.append(record)
+        return records
+
+    def _ws_connect(self, authtoken):
+        """Try to connect the websocket sync channel."""
+        if self._ws is not None or not self._ws_ok or not window.WebSocket:
+            return
+        url = tools.build_api_url("sync")
+        url = "ws" + url[4:]  # http -> ws, https -> wss
+        try:
+            ws = window.WebSocket(url)
+        except Exception as err:
+            console.warn(err)
+            self._ws_ok = False
+            return
+        self._ws = ws
+        self._ws_ready = False
+        ws.onopen = lambda ev: self._ws_send({"type": "auth", "authtoken": authtoken})
+        ws.onmessage = self._ws_on_message
+        ws.onclose = lambda ev: self._ws_on_close(ws)
+
+    def _ws_send(self, ob):
+        if self._ws is not None:
+            self._ws.send(JSON.stringify(ob))
+
+    def _ws_pull(self):
+        # Have the server send us updates, unless we need a (paged) resync
+        if self._ws_ready and not self._ws_pulling:
+            if self._server_time > 0 and not self._pull_cursor:
+                self._ws_pulling = True
+                self._poll_delay = 30
+                self._ws_send({"type": "pull", "since": self._server_time})
+
+    def _ws_push(self, kind):
+        # Take items, only proceed if nonempty
+        items = self._to_push[kind]
+        if len(items.keys()) == 0:
+            return
+        self._to_push[kind] = {}
+        # Send, and keep the items until we get an ack
+        self._ws_id += 1
+        self._ws_pending[self._ws_id] = [kind, items]
+        msg = {"type": "push", "id": self._ws_id, "kind": kind, "items": items.values()}
+        self._ws_send(msg)
+
+    async def _ws_on_message(self, ev):
+        ob = JSON.parse(ev.data)
+        if ob.type == "auth":
+            # Authenticated, get updates, and push what we have
+            self._ws_ready = True
+            self._ws_pull()
+            if self._ws_pulling:
+                for kind in ["settings", "records"]:
+                    self._ws_push(kind)
+        elif ob.type == "updates":
+            await self._process_updates(ob, False)
+            await self._save_to_cache()
+            if window.canvas:
+                window.canvas.update()
+        elif ob.type == "resync":
+            # We need all items, which we get with the paged REST API
+            self._ws_pulling = False
+            self.sync_soon(0.1)
+        elif ob.type == "ack":
+            self._ws_pending.pop(ob.id, None)
+            self._process_push_result(ob.kind, ob)
+        elif ob.type == "error":
+            console.warn("Websocket: " + ob.status + " " + ob.message)
+            if ob.status == 401:
+                # Let the normal flow handle auth problems
+                self._ws_ok = False
+                self._ws.close()
+            elif ob.status == 429:
+                # Rate limited, put back the items and try again later
+                kind_and_items = self._ws_pending.pop(ob.id, None)
+                if kind_and_items:
+                    kind, items = kind_and_items
+                    for key, item in items.items():
+                        self._to_push[kind].setdefault(key, item)
+                self.sync_soon(ob.retry_after or 10)
+
+    def _ws_on_close(self, ws):
+        if ws is not self._ws:
+            return
+        # If we never got ready, the server probably does not support it
+        if not self._ws_ready:
+            self._ws_ok = False
+        self._ws = None
+        self._ws_ready = False
+        self._ws_pulling = False
+        self._poll_delay = 10
+        # Put back items that were not acknowledged, but don't overwrite
+        # if the item was updated again.
+        for kind_and_items in self._ws_pending.values():
+            kind, items = kind_and_items
+            for key, item in items.items():
+                self._to_push[kind].setdefault(key, item)
+        self._ws_pending = {}
+        self.sync_soon(1.0)
 
 
 class SandboxDataStore(BaseDataStore):
@@ -5,7 +5,12 @@ from ._apiserver import (
     authenticate,
     AuthException,
     api_handler_triage,
+    api_handler_websocket,
     get_webtoken_unsafe,
+    get_rate_limit_cost,
+    rate_limit,
+    get_metrics,
+    db_pool,
 )
 from ._assets import (
     md2html,
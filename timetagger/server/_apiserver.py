@@ -3,15 +3,30 @@ This implements the API side of the server.
 """
 
 import json
+import math
 import time
+import zlib
+import codecs
+import inspect
+import hashlib
+import asyncio
 import logging
 import secrets
+import sqlite3
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
-import itemdb
+from asgineer import DisconnectedError
 
 from ._utils import user2filename, create_jwt, decode_jwt
+from ._utils import TTLCache, JSONListParser, TokenBucketLimiter
+from ._dbpool import UserDBPool, start_db_timing, get_db_timing
+from ._changes import ChangeNotifier, get_channel_dir
+from . import _stats
+from . import _rollup
+from . import _metrics
 
-from timetagger import __version__
+from timetagger import __version__, config
+from timetagger.app.utils import get_tags_and_parts_from_string
 
 logger = logging.getLogger("asgineer")
 
@@ -69,11 +84,151 @@ INDICES = {
     "records": ("!key", "st", "t1", "t2"),
     "settings": ("!key", "st"),
     "userinfo": ("!key", "st"),
+    "record_tags": ("!kt", "key", "tag", "st"),
+    "stat_bins": ("!key",),
+    "daily_rollup": ("!key", "day", "count"),
+}
+
+# Columns that are derived from the item, and can be used in queries
+GENERATED_COLUMNS = {
+    "records": {
+        "hidden": "json_extract(_ob, '$.ds') LIKE 'HIDDEN%'",
+        "running": "t1 == t2",
+        "outlier": _stats.OUTLIER_EXPRESSION,
+    },
 }
 
 FALSY_VALUES = ("false", "off", "no", "n", "0")
 
 
+async def _setup_user_db(db):
+    """Prepare a freshly opened user database. Called once per open."""
+    # The file may have been replaced, so we cannot trust cached seeds
+    for tokenkind in ("webtoken", "apitoken"):
+        _seed_cache.discard((db.filename, tokenkind))
+    await db.ensure_table("userinfo", *INDICES["userinfo"])
+    await db.ensure_table("records", *INDICES["records"])
+    await db.run_in_thread(_migrate_records_table)
+    await db.ensure_table("settings", *INDICES["settings"])
+    await db.ensure_table("record_tags", *INDICES["record_tags"])
+    await _backfill_record_tags(db)
+    await db.ensure_table("stat_bins", *INDICES["stat_bins"])
+    await _stats.backfill_stat_bins(db)
+    await db.ensure_table("daily_rollup", *INDICES["daily_rollup"])
+    await _rollup.ensure_daily_rollup(db)
+
+
+def _migrate_records_table(conn):
+    """Add the hidden, running and outlier columns to the records table.
+    These are generated columns, so SQLite populates them when a record is
+    written, and itemdb does not know about them. The indices include t1, so that
+    combined with the time range, a query can use one index.
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_xinfo(records)")}
+    for name, expression in GENERATED_COLUMNS["records"].items():
+        if name not in columns:
+            try:
+                conn.execute(
+                    f"ALTER TABLE records ADD COLUMN {name} INTEGER "
+                    f"GENERATED ALWAYS AS ({expression}) VIRTUAL"
+                )
+            except sqlite3.OperationalError as err:
+                # Another process (e.g. worker) may have just added it
+                if "duplicate column" not in str(err):
+                    raise
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_records_{name} ON records ({name}, t1)"
+        )
+
+
+# %% Tag index
+#
+# The record_tags table has an item (key, tag) for each tag of each record.
+# It is kept up to date when records are put, so that filtering on tags
+# does not need to scan all records.
+
+
+def _get_record_tag_items(record):
+    key, st = record["key"], record.get("st", 0)
+    tags, _ = get_tags_and_parts_from_string(record.get("ds", ""))
+    return [dict(kt=key + " " + tag, key=key, tag=tag, st=st) for tag in tags]
+
+
+async def _backfill_record_tags(db):
+    """Fill the record_tags table for a database that was created before
+    it existed. This only does work once per database.
+    """
+    if await db.select_one("userinfo", "key == 'record_tags'"):
+        return
+    # Clear the table first, in case the marker was removed to have it
+    # rebuilt. In each step, check again, now that we have the write lock.
+    async with db:
+        if await db.select_one("userinfo", "key == 'record_tags'"):
+            return
+        await db.delete("record_tags", "kt IS NOT NULL")
+    async with db:
+        if await db.select_one("userinfo", "key == 'record_tags'"):
+            return
+        tag_items = []
+        for record in await db.select_all("records"):
+            tag_items += _get_record_tag_items(record)
+        if tag_items:
+            await db.put("record_tags", *tag_items)
+        st = time.time()
+        await db.put_one("userinfo", key="record_tags", st=st, mt=st, value=1)
+
+
+def invalidate_derived_tables(db):
+    """For scripts that modify records directly with an ``itemdb.ItemDB``
+    (i.e. not via the API): mark the tables that the server derives from
+    the records (the tag index, stats, and rollup) as outdated, so that
+    they are rebuilt when the server opens the db. Call this at the end of
+    the transaction that modifies the records. The server rebuilds them
+    when it opens the db, so run such a script while the server is not
+    running, or restart the server afterwards.
+    """
+    if "userinfo" in db.get_table_names():
+        keys = "'record_tags', 'stat_bins', 'daily_rollup'"
+        db.delete("userinfo", f"key IN ({keys})")
+
+
+async def _update_record_tags(db, records, server_time):
+    """Update the tags of the given records, which have just been put
+    with the given server time. Must be called at the end of the transaction.
+    """
+    tag_items = []
+    for record in records:
+        tag_items += _get_record_tag_items(record)
+    if tag_items:
+        await db.put("record_tags", *tag_items)
+    # Remove tags that the records no longer have. Note that itemdb closes
+    # the cursor on delete(), so this must be the last call in the transaction.
+    query = "st < ? AND key IN (SELECT key FROM records WHERE st >= ?)"
+    await db.delete("record_tags", query, server_time, server_time)
+
+
+# The open user databases are shared between requests
+db_pool = UserDBPool(_setup_user_db)
+
+# Notify changes to user databases, per filename
+change_notifier = ChangeNotifier()
+
+
+def _connect_workers():
+    # With multiple worker processes, notify changes to the other workers,
+    # so that they wake up long polls, and invalidate cached seeds.
+    if config.worker_notifications or config.workers > 1:
+        change_notifier.connect(get_channel_dir(config.datadir))
+
+
+def _on_change_in_other_worker(filename):
+    for tokenkind in ("webtoken", "apitoken"):
+        _seed_cache.discard((filename, tokenkind))
+
+
+change_notifier.add_listener(_on_change_in_other_worker)
+
+
 class AuthException(Exception):
     """Exception raised when authentication fails.
     You should catch this error and respond with 401 unauthorized.
@@ -85,12 +240,55 @@ class AuthException(Exception):
 
 # %% Main handler
 
-# todo: rate limiting
+
+API_PATHS = (
+    "version",
+    "updates",
+    "records",
+    "settings",
+    "stats",
+    "forcereset",
+    "webtoken",
+    "apitoken",
+)
 
 
 async def api_handler_triage(request, path, auth_info, db):
     """The API handler that triages over the API options."""
+    t0 = time.perf_counter()
+    db_timing = start_db_timing()
+    cost = get_request_cost(request, path)
+    response = rate_limit("user:" + auth_info["username"], cost)
+    if response is None:
+        response = await _api_handler_triage(request, path, auth_info, db)
+    t1 = time.perf_counter()
+    response = _compress_response(request, response)  # also encodes json
+    # Measure
+    status, headers, body = response
+    path = path if path in API_PATHS else "other"
+    t2 = time.perf_counter()
+    t = t2 - t0
+    server_timing = db_timing.get_server_timing(encode=t2 - t1, total=t)
+    headers = {**headers, "server-timing": server_timing}
+    _metrics.requests_total.inc(path, request.method, status)
+    _metrics.request_duration.observe(path, request.method, value=t)
+    if path == "updates" and status == 200:
+        if inspect.isasyncgen(body):
+            body = _measure_stream(body, path)
+        else:
+            _metrics.payload_size.observe(path, "out", value=len(body))
+    return status, headers, body
+
 
+async def _measure_stream(body, path):
+    nbytes = 0
+    async for chunk in body:
+        nbytes += len(chunk)
+        yield chunk
+    _metrics.payload_size.observe(path, "out", value=nbytes)
+
+
+async def _api_handler_triage(request, path, auth_info, db):
     if path == "version":
         if request.method == "GET":
             return await get_version(request, auth_info, db)
@@ -123,6 +321,13 @@ async def api_handler_triage(request, path, auth_info, db):
             expl = "/settings can only be used with GET and PUT"
             return 405, {}, "method not allowed: " + expl
 
+    elif path == "stats":
+        if request.method == "GET":
+            return await get_stats(request, auth_info, db)
+        else:
+            expl = "/stats can only be used with GET"
+            return 405, {}, "method not allowed: " + expl
+
     elif path == "forcereset":
         if request.method == "PUT":
             return await put_forcereset(request, auth_info, db)
@@ -149,6 +354,190 @@ async def api_handler_triage(request, path, auth_info, db):
         return 404, {}, "not found: " + expl
 
 
+# %% Rate limiting
+#
+# Each user has a token bucket, and each request takes a number of tokens
+# from it. Requests that are expensive for the server cost more. The
+# bootstrap_authentication endpoint is not authenticated, so there the
+# client IP is used as the key instead (see __main__.py).
+
+RATE_LIMIT_COSTS = {
+    "default": 1,  # any request
+    "records_scan": 10,  # GET records for a time range of more than a year
+    "updates_full": 20,  # GET updates that may result in a full resync
+    "push_mib": 10,  # per MiB of the body of a PUT
+    "bootstrap": 10,  # login attempts, which may check a bcrypt hash
+    "stats_groups": 1,  # per 100 groups of GET stats
+}
+
+_rate_limiter = TokenBucketLimiter()
+
+
+def get_rate_limit_cost(name):
+    """Get the cost for the given name in RATE_LIMIT_COSTS, taking
+    ``config.rate_limit_costs`` into account.
+    """
+    for part in config.rate_limit_costs.split(","):
+        key, _, value = part.partition(":")
+        if key.strip() == name:
+            return float(value)
+    return RATE_LIMIT_COSTS[name]
+
+
+def get_request_cost(request, path):
+    """Get the number of tokens that the given API request costs. This
+    is estimated from the request, before it is handled.
+    """
+    cost = get_rate_limit_cost("default")
+    querydict = request.querydict
+    if request.method == "GET" and path == "records":
+        tr1, _, tr2 = querydict.get("timerange", "").partition("-")
+        try:
+            long_range = float(tr2) - float(tr1) > 366 * 86400
+        except ValueError:
+            long_range = False
+        if long_range and not querydict.get("limit", ""):
+            cost += get_rate_limit_cost("records_scan")
+    elif request.method == "GET" and path == "updates":
+        try:
+            full = float(querydict.get("since", "0")) <= 0
+        except ValueError:
+            full = False
+        if full and not querydict.get("limit", ""):
+            cost += get_rate_limit_cost("updates_full")
+    elif request.method == "GET" and path == "stats":
+        groupby = querydict.get("groupby", "").strip().lower()
+        tr1, _, tr2 = querydict.get("timerange", "").partition("-")
+        try:
+            ngroups = (float(tr2) - float(tr1)) / _stats.GROUPBY_SECONDS[groupby]
+        except (KeyError, ValueError):
+            ngroups = 0
+        cost += get_rate_limit_cost("stats_groups") * max(0, ngroups) / 100
+    elif request.method == "PUT":
+        try:
+            size = int(request.headers.get("content-length", "0"))
+        except ValueError:
+            size = 0
+        cost += get_rate_limit_cost("push_mib") * size / 2**20
+    return cost
+
+
+def get_websocket_message_cost(msg, size):
+    """Get the number of tokens that a message on the websocket costs,
+    given the (parsed) message and the length of its text.
+    """
+    cost = get_rate_limit_cost("default")
+    if isinstance(msg, dict) and msg.get("type", None) == "push":
+        cost += get_rate_limit_cost("push_mib") * size / 2**20
+    return cost
+
+
+def rate_limit(key, cost):
+    """Take cost tokens from the bucket of the given key (e.g. "user:name"
+    or "ip:address"). Returns None if the request can proceed, or a 429
+    response with a Retry-After header.
+    """
+    rate = config.rate_limit
+    if rate <= 0:
+        return None
+    retry_after = _rate_limiter.consume(key, cost, rate, config.rate_limit_burst)
+    if not retry_after:
+        return None
+    headers = {"retry-after": str(math.ceil(retry_after))}
+    return 429, headers, "too many requests: retry later"
+
+
+# %% Metrics
+
+_metrics.registry.add(
+    _metrics.Gauge(
+        "timetagger_db_pool_size",
+        "Number of open user databases.",
+        callback=lambda: len(db_pool),
+    )
+)
+
+
+async def get_metrics(request):
+    """Handler for the metrics, in the Prometheus text exposition format.
+    Only clients on localhost get them, and requests that came through a
+    (local) reverse proxy are refused.
+    """
+    client = request.scope.get("client", None)
+    if not client or client[0] not in ("127.0.0.1", "::1"):
+        return 403, {}, "forbidden: metrics are only available on localhost"
+    elif "x-forwarded-for" in request.headers:
+        return 403, {}, "forbidden: metrics are not available via a proxy"
+    _metrics.ensure_event_loop_monitor()
+    headers = {"content-type": "text/plain; version=0.0.4; charset=utf-8"}
+    return 200, headers, _metrics.registry.render()
+
+
+# %% Compression
+
+COMPRESS_MIN_SIZE = 1024
+
+
+def _accepts_gzip(request):
+    """Get whether the client accepts a gzip encoded response. An explicit
+    gzip entry takes precedence over a wildcard.
+    """
+    qvalues = {}
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, *params = part.split(";")
+        name = name.strip().lower()
+        if name not in ("gzip", "*"):
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    pass
+        qvalues[name] = q
+    return qvalues.get("gzip", qvalues.get("*", 0)) > 0
+
+
+def _compress_response(request, response):
+    """Gzip the body of the given response, if the client accepts it and
+    the body is large enough to be worth it. Streamed bodies are always
+    compressed.
+    """
+    status, headers, body = response
+    if status != 200 or "content-encoding" in headers:
+        return response
+    if isinstance(body, dict):
+        body = json.dumps(body).encode()
+        headers = {"content-type": "application/json", **headers}
+    elif isinstance(body, str):
+        body = body.encode()
+    headers = {**headers, "vary": "accept-encoding"}
+    if not _accepts_gzip(request):
+        return status, headers, body
+    elif inspect.isasyncgen(body):
+        headers["content-encoding"] = "gzip"
+        return status, headers, _gzip_stream(body)
+    elif len(body) >= COMPRESS_MIN_SIZE:
+        headers["content-encoding"] = "gzip"
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return status, headers, compressor.compress(body) + compressor.flush()
+    else:
+        return status, headers, body
+
+
+async def _gzip_stream(body):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for chunk in body:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 # %% Auth
 
 
@@ -156,6 +545,14 @@ WEBTOKEN_DAYS = 2 * 7
 WEBTOKEN_LIFETIME = WEBTOKEN_DAYS * 24 * 60 * 60
 API_TOKEN_EXP = 32503748400  # the year 3000
 
+# Caches to avoid verifying the same JWT, and querying the seed, on each
+# request. The seed cache is updated when a seed is (re)set, so that
+# revoking tokens takes effect immediately.
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 60
+_jwt_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)  # token -> payload
+_seed_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)  # (filename, kind) -> seed
+
 
 async def authenticate(request):
     """Authenticate the user, returning (auth_info, db) if all is well.
@@ -171,25 +568,31 @@ async def authenticate(request):
     #   before the expiration. Clients can scan the 401 message for the word
     #   "revoked" and handle revokation different from expiration.
 
-    st = time.time()
-
     # Get jwt from header. Validates that a token is provided.
     token = request.headers.get("authtoken", "")
     if not token:
+        _metrics.auth_failures_total.inc("missing")
         raise AuthException("Missing jwt 'authtoken' in header.")
 
-    # Decode the jwt to get auth_info. Validates that we created it.
-    try:
-        auth_info = decode_jwt(token)
-    except Exception as err:
-        raise AuthException(str(err))
+    return await _authenticate_token(token)
 
-    # Open the database, this creates it if it does not yet exist
-    dbname = user2filename(auth_info["username"])
-    db = await itemdb.AsyncItemDB(dbname)
-    await db.ensure_table("userinfo", *INDICES["userinfo"])
-    await db.ensure_table("records", *INDICES["records"])
-    await db.ensure_table("settings", *INDICES["settings"])
+
+async def _authenticate_token(token):
+    st = time.time()
+    _connect_workers()
+
+    # Decode the jwt to get auth_info. Validates that we created it.
+    auth_info = _jwt_cache.get(token, None)
+    if auth_info is None:
+        try:
+            auth_info = decode_jwt(token)
+        except Exception as err:
+            _metrics.auth_failures_total.inc("invalid")
+            raise AuthException(str(err))
+        _jwt_cache.set(token, auth_info)
+
+    # Get the database, this creates it if it does not yet exist
+    db = await db_pool.get(user2filename(auth_info["username"]))
 
     # Get reference seed from db
     expires = auth_info["expires"]
@@ -198,11 +601,13 @@ async def authenticate(request):
 
     # Compare seeds. Validates that the token is not revoked.
     if not ref_seed or ref_seed != auth_info["seed"]:
+        _metrics.auth_failures_total.inc("revoked")
         raise AuthException(f"The {tokenkind} is revoked (seed does not match)")
 
     # Check expiration last. Validates that the token is not too old.
     # If a token is both revoked and expired, we want to emit the revoked-message.
     if auth_info["expires"] < st:
+        _metrics.auth_failures_total.inc("expired")
         raise AuthException(f"The {tokenkind} has expired (after {WEBTOKEN_DAYS} days)")
 
     # All is well!
@@ -252,18 +657,28 @@ async def _get_any_token(auth_info, db, tokenkind, reset):
 
 
 async def _get_token_seed_from_db(db, tokenkind, reset):
-    # Get seed
-    query = f"key = '{tokenkind}_seed'"
-    ob = await db.select_one("userinfo", query) or {}
-    seed = ob.get("value", "")
+    cache_key = db.filename, tokenkind
+    # Get seed, from the cache if we can
+    seed = "" if reset else _seed_cache.get(cache_key, "")
+    if not seed and not reset:
+        query = f"key = '{tokenkind}_seed'"
+        ob = await db.select_one("userinfo", query) or {}
+        seed = ob.get("value", "")
+        # Don't overwrite a seed that was set while we were querying
+        if seed and _seed_cache.get(cache_key, None) is None:
+            _seed_cache.set(cache_key, seed)
     # Create new seed if needed
     if reset or not seed:
         seed = secrets.token_urlsafe(8)  # new random seed
         st = time.time()
+        _seed_cache.discard(cache_key)
         async with db:
             await db.put_one(
                 "userinfo", key=f"{tokenkind}_seed", st=st, mt=st, value=seed
             )
+        _seed_cache.set(cache_key, seed)
+        await db.mark_written()
+        change_notifier.notify(db.filename)
     return seed
 
 
@@ -282,10 +697,8 @@ async def get_webtoken_unsafe(username, reset=False):
     The provided webtoken expires in two weeks. It is recommended to
     use GET /api/v2/webtoken to get a fresh token once a day.
     """
-    # Open db
-    dbname = user2filename(username)
-    db = await itemdb.AsyncItemDB(dbname)
-    await db.ensure_table("userinfo", *INDICES["userinfo"])
+    # Get db
+    db = await db_pool.get(user2filename(username))
     # Produce payload
     seed = await _get_token_seed_from_db(db, "webtoken", reset)
     payload = dict(
@@ -316,22 +729,79 @@ async def get_updates(request, auth_info, db):
     except ValueError:
         return 400, {}, "bad request: /updates since needs a number (timestamp)"
 
-    # # Parse pollmethod option
-    # pollmethod = request.querydict.get("pollmethod", "").strip() or "short"
-    # if pollmethod not in ("short", "long"):
-    #     return 400, {}, "/records pollmethod must be 'short' or 'long'"
+    # Parse pollmethod option
+    pollmethod = request.querydict.get("pollmethod", "").strip() or "short"
+    if pollmethod not in ("short", "long"):
+        return 400, {}, "bad request: /updates pollmethod must be 'short' or 'long'"
+
+    # Parse format option
+    columnar = _parse_columnar(request.querydict)
+    if columnar is None:
+        return 400, {}, f"bad request: /updates format must be {FORMAT_OPTIONS}"
+
+    # Parse optional limit and cursor, for pagination
+    try:
+        limit = _parse_limit(request.querydict)
+        cursor = _parse_cursor(request.querydict, limit, _check_updates_cursor)
+    except ValueError as err:
+        return 400, {}, f"bad request: /updates {err}"
+
+    if cursor is not None:
+        # The next page. The cursor captures the state of the first page.
+        result = await _get_updates_page(db, limit, *cursor)
+    elif pollmethod == "short":
+        result = await _get_updates(db, since, True, False, limit)
+    else:
+        # Long polling: wait for a change notification if there is
+        # nothing new. The version is obtained before querying, so
+        # that we cannot miss a change.
+        deadline = time.time() + config.longpoll_timeout
+        use_mtime = True
+        while True:
+            version = change_notifier.get_version(db.filename)
+            result = await _get_updates(db, since, use_mtime, False, limit)
+            timeout = deadline - time.time()
+            if result["records"] is None or result["reset"]:
+                break  # full resync
+            elif result["records"] or result["settings"]:
+                break
+            elif timeout <= 0:
+                break
+            await change_notifier.wait(db.filename, version, timeout)
+            use_mtime = False  # db.mtime is from before we waited
+
+    # A full resync can be big, so we stream it
+    if result["records"] is None:
+        headers = {"content-type": "application/json"}
+        body = _iter_full_updates(db, result["server_time"], result["reset"], columnar)
+        return 200, headers, body
+
+    if columnar:
+        _make_columnar(result)
+    return 200, {}, result
+
 
+async def _get_updates(db, since, use_mtime, full=True, limit=None):
     server_time = time.time()
 
-    # Early exit - this is what will happen most of the time. Use a margin to
-    # account for limited resolution of getmtime.
-    if db.mtime + 0.2 < since:
-        return dict(
+    # Early exit - this is what will happen most of the time. If we know the
+    # last st from our own writes, we need no query. Otherwise we use the
+    # mtime, with a margin to account for its limited resolution.
+    last_st = db.last_st
+    if use_mtime and last_st is not None:
+        nothing_new = last_st < since
+    else:
+        nothing_new = use_mtime and db.mtime + 0.2 < since
+    if nothing_new:
+        result = dict(
             server_time=server_time,
             reset=0,  # Not False; is used in the tests to know that we exited early
             records=[],
             settings=[],
         )
+        if limit is not None:
+            result.update(more=False, cursor=None)
+        return result
 
     # Get reset time from userinfo. We set userinfo.reset_time when the
     # database is reset (or when we want to force a refresh). We make
@@ -340,8 +810,14 @@ async def get_updates(request, auth_info, db):
     reset_time = float((ob or {}).get("value", -1))
     reset = since <= reset_time
 
-    # Get data
-    if reset:
+    # Get data. When not full, getting all data is left to the caller.
+    if limit is not None:
+        return await _get_updates_page(
+            db, limit, server_time, since, reset, "records", None, None
+        )
+    elif (reset or since <= 0) and not full:
+        records = settings = None
+    elif reset:
         records = await db.select_all("records")
         settings = await db.select_all("settings")
     else:
@@ -350,16 +826,109 @@ async def get_updates(request, auth_info, db):
         settings = await db.select("settings", query)
 
     # Return result
-    result = dict(
+    return dict(
         server_time=server_time,
         reset=reset,
         records=records,
         settings=settings,
     )
-    return 200, {}, result
+
+
+async def _get_updates_page(db, limit, server_time, since, reset, what, st, key):
+    """Get a page of at most limit items, records first, then settings.
+    The other arguments are those of the first page, plus the position
+    in the table that the page starts at (what, st, key).
+    """
+    if reset:
+        query, params = "key IS NOT NULL", []
+    else:
+        query, params = "st >= ?", [float(since)]
+
+    result = dict(
+        server_time=server_time,
+        reset=reset,
+        records=[],
+        settings=[],
+        more=False,
+        cursor=None,
+    )
+
+    tables = ["records", "settings"]
+    after = None if st is None else (st, key)
+    for what in tables[tables.index(what) :]:
+        if limit <= 0:
+            state = [server_time, since, reset, what, None, None]
+            result.update(more=True, cursor=_encode_cursor(state))
+            break
+        items, more = await _select_page(db, what, query, params, after, limit)
+        result[what] = items
+        if more:
+            state = [server_time, since, reset, what, items[-1]["st"], items[-1]["key"]]
+            result.update(more=True, cursor=_encode_cursor(state))
+            break
+        limit -= len(items)
+        after = None
+
+    return result
+
+
+def _check_updates_cursor(cursor):
+    server_time, since, reset, what, st, key = cursor
+    for x in (server_time, since):
+        if not isinstance(x, (int, float)):
+            raise ValueError()
+    if not isinstance(reset, bool) or what not in ("records", "settings"):
+        raise ValueError()
+    _check_position(st, key)
+
+
+FULL_UPDATES_BATCH_SIZE = 1000
+
+
+async def _iter_full_updates(db, server_time, reset, columnar=False):
+    """Async generator that produces the JSON for a full resync in
+    chunks, reading the items from the database in batches. The response
+    has the same shape as a normal /updates response.
+
+    The batches are read with separate queries, so that writers are
+    not blocked by a slow client. Items that are modified in the
+    meantime have an st >= server_time, so the client will get them on
+    its next poll.
+    """
+    head = dict(server_time=server_time, reset=reset)
+    if columnar:
+        head["format"] = "columnar"
+    yield json.dumps(head)[:-1]
+    for what in ("records", "settings"):
+        yield ', "' + what + '": ['
+        prefix = ""
+        async for items in _iter_all_items(db, what, FULL_UPDATES_BATCH_SIZE):
+            if columnar and what == "records":
+                yield prefix + json.dumps(_records_to_columns(items))
+            else:
+                yield prefix + ", ".join(json.dumps(item) for item in items)
+            prefix = ", "
+        yield "]"
+    yield "}"
+
+
+async def _iter_all_items(db, what, batch_size):
+    """Iterate over all items in the given table, in batches ordered by key."""
+    items = await db.select(what, "key IS NOT NULL ORDER BY key LIMIT ?", batch_size)
+    while items:
+        yield items
+        if len(items) < batch_size:
+            break
+        query = "key > ? ORDER BY key LIMIT ?"
+        items = await db.select(what, query, items[-1]["key"], batch_size)
 
 
 async def get_records(request, auth_info, db):
+    # Is the client's version still up to date?
+    etag = _get_etag(request, db)
+    if _etag_matches(request, etag):
+        return 304, {"etag": etag}, b""
+
     # Parse timerange option
     timerange_str = request.querydict.get("timerange", "").strip()
     if not timerange_str:
@@ -395,132 +964,570 @@ async def get_records(request, auth_info, db):
     tag_str = request.querydict.get("tag", "").strip()
     tags = []
     if tag_str:
-        # ignore client-provided hashtags
-        tag_str = tag_str.replace("#", "")
-        # escape special SQL LIKE characters
-        tag_str = tag_str.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
-        tags = [tag.strip() for tag in tag_str.split(",")]
+        # ignore client-provided hashtags, tags are stored lowercase
+        tag_str = tag_str.replace("#", "").lower()
+        tags = ["#" + tag.strip() for tag in tag_str.split(",")]
 
     # Prepare query
+    query, safe_params = _get_records_query(tr1, tr2, running, hidden, tags)
+
+    # Parse optional limit and cursor, for pagination
+    try:
+        limit = _parse_limit(request.querydict)
+        cursor = _parse_cursor(request.querydict, limit, _check_records_cursor)
+    except ValueError as err:
+        return 400, {}, f"bad request: /records {err}"
+
+    # Parse format option
+    columnar = _parse_columnar(request.querydict)
+    if columnar is None:
+        return 400, {}, f"bad request: /records format must be {FORMAT_OPTIONS}"
+
+    # Collect records
+    if limit is None:
+        records = await db.select("records", query, *safe_params)
+        result = dict(records=records)
+    else:
+        records, more = await _select_page(
+            db, "records", query, safe_params, cursor, limit
+        )
+        result = dict(records=records, more=more, cursor=None)
+        if more:
+            result["cursor"] = _encode_cursor([records[-1]["st"], records[-1]["key"]])
+
+    # Return result
+    if columnar:
+        _make_columnar(result)
+    return 200, {"etag": etag}, result
+
+
+def _get_records_query(tr1, tr2, running, hidden, tags):
+    """Get the query and its parameters to select records. Each filter
+    is written so that SQLite can use an index for it.
+    """
     query_parts = []
     safe_params = []
-    query_parts.append(f"(t2 >= {tr1} AND t1 <= {tr2}) OR (t1 == t2 AND t1 <= {tr2})")
+    query_parts.append(
+        f"(t2 >= {tr1} AND t1 <= {tr2}) OR (running == 1 AND t1 <= {tr2})"
+    )
     for tag in tags:
-        query_parts.append(
-            "json_extract(_ob, '$.ds') LIKE ? ESCAPE '\\' OR json_extract(_ob, '$.ds') LIKE ? ESCAPE '\\'"
-        )
-        safe_params += [f"%#{tag} %", f"%#{tag}"]
+        query_parts.append("key IN (SELECT key FROM record_tags WHERE tag == ?)")
+        safe_params.append(tag)
     if running is True:
-        query_parts.append("t1 == t2")
+        query_parts.append("running == 1")
     if running is False:
-        query_parts.append("t1 != t2")
+        query_parts.append("running == 0")
     if hidden is True:
-        query_parts.append("json_extract(_ob, '$.ds') LIKE 'HIDDEN%'")
+        query_parts.append("hidden == 1")
     if hidden is False:
-        query_parts.append("json_extract(_ob, '$.ds') NOT LIKE 'HIDDEN%'")
+        query_parts.append("hidden == 0")
     query = " AND ".join(f"({part})" for part in query_parts)
+    return query, safe_params
 
-    # Collect records
-    records = await db.select("records", query, *safe_params)
 
-    # Return result
-    result = dict(records=records)
-    return 200, {}, result
+# %% Columnar format
+#
+# With format=columnar, the records in a response are a list of blocks.
+# Each block has a list per field, and the descriptions are dictionary
+# encoded: the ds list has indices into the ds_values list (or null for
+# records without ds). The settings are unaffected. Full resyncs are
+# streamed as one block per batch.
+
+FORMAT_OPTIONS = "'objects' or 'columnar'"
+RECORD_COLUMNS = ("key", "mt", "t1", "t2", "st")
+
+
+def _parse_columnar(querydict):
+    """Get whether the columnar format is requested, or None if invalid."""
+    format = querydict.get("format", "").strip().lower() or "objects"
+    return {"objects": False, "columnar": True}.get(format, None)
+
+
+def _records_to_columns(records):
+    """Encode a list of records as a block of columns."""
+    block = {name: [record[name] for record in records] for name in RECORD_COLUMNS}
+    ds_indices = {}
+    block["ds"] = [
+        ds_indices.setdefault(record["ds"], len(ds_indices)) if "ds" in record else None
+        for record in records
+    ]
+    block["ds_values"] = list(ds_indices)
+    return block
+
+
+def _make_columnar(result):
+    records = result["records"]
+    result["records"] = [_records_to_columns(records)] if records else []
+    result["format"] = "columnar"
+
+
+# %% Pagination
+#
+# Paginated results are ordered by (st, key), and a cursor encodes the
+# position of the last item of a page. Items that are modified while a
+# client is paging get a new st, so they move to the end, and are not
+# skipped. A cursor is opaque to the client.
+
+
+def _parse_limit(querydict):
+    limit_str = querydict.get("limit", "").strip()
+    if not limit_str:
+        return None
+    try:
+        limit = int(limit_str)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return limit
+
+
+def _parse_cursor(querydict, limit, check):
+    cursor_str = querydict.get("cursor", "").strip()
+    if not cursor_str:
+        return None
+    elif limit is None:
+        raise ValueError("cursor needs limit")
+    try:
+        cursor = json.loads(urlsafe_b64decode(cursor_str.encode()).decode())
+        if not isinstance(cursor, list):
+            raise ValueError()
+        check(cursor)
+    except Exception:
+        raise ValueError("cursor is invalid") from None
+    return cursor
+
+
+def _check_records_cursor(cursor):
+    st, key = cursor
+    _check_position(st, key)
+
+
+def _check_position(st, key):
+    if st is None and key is None:
+        return
+    elif not (isinstance(st, (int, float)) and isinstance(key, str)):
+        raise ValueError()
+
+
+def _encode_cursor(cursor):
+    return urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+async def _select_page(db, what, query, params, after, limit):
+    """Select at most limit items that match the query, ordered by (st, key),
+    starting after the given (st, key) position. Returns (items, more).
+    """
+    if after is not None and after[0] is not None:
+        st, key = after
+        query = f"({query}) AND (st > ? OR (st == ? AND key > ?))"
+        params = [*params, st, st, key]
+    query += " ORDER BY st, key LIMIT ?"
+    items = await db.select(what, query, *params, limit + 1)
+    return items[:limit], len(items) > limit
 
 
 async def put_records(request, auth_info, db):
     return await _push_items(request, auth_info, db, "records")
 
 
+async def get_stats(request, auth_info, db):
+    # Parse timerange option
+    timerange_str = request.querydict.get("timerange", "").strip()
+    if not timerange_str:
+        return 400, {}, "bad request: /stats needs timerange (2 timestamps)"
+    timerange = timerange_str.split("-")
+    try:
+        timerange = [float(x) for x in timerange]
+        if len(timerange) != 2:
+            raise ValueError()
+    except ValueError:
+        return 400, {}, "bad request: /stats timerange needs 2 numbers (timestamps)"
+    tr1, tr2 = int(timerange[0]), int(timerange[1])
+
+    # Parse optional tag option
+    tag_str = request.querydict.get("tag", "").strip()
+    tags = []
+    if tag_str:
+        tag_str = tag_str.replace("#", "").lower()
+        tags = ["#" + tag.strip() for tag in tag_str.split(",")]
+
+    # Parse optional groupby option
+    groupby = request.querydict.get("groupby", "").strip().lower() or None
+    if groupby is not None and groupby not in _stats.GROUPBY_OPTIONS:
+        options = ", ".join(_stats.GROUPBY_OPTIONS)
+        return 400, {}, f"bad request: /stats groupby must be one of {options}"
+
+    # Parse optional tzoffset option
+    try:
+        tzoffset = int(request.querydict.get("tzoffset", "").strip() or 0)
+        if abs(tzoffset) >= 86400:
+            raise ValueError()
+    except ValueError:
+        return 400, {}, "bad request: /stats tzoffset needs a number (seconds)"
+
+    # Get the periods to group by
+    periods = []
+    if groupby is not None:
+        if (tr2 - tr1) / _stats.GROUPBY_SECONDS[groupby] > _stats.MAX_GROUPS:
+            return (
+                400,
+                {},
+                f"bad request: /stats supports up to {_stats.MAX_GROUPS} groups",
+            )
+        if tr1 < _stats.STATS_MIN_TIME or tr2 > _stats.STATS_MAX_TIME:
+            return 400, {}, "bad request: /stats groupby needs a timerange in 1970-2106"
+        periods = _stats.get_periods(tr1, tr2, groupby, tzoffset)
+
+    # Collect stats
+    now = time.time()
+    stats = await _stats.get_stats(db, tr1, tr2, now)
+    result = dict(stats=_stats.filter_stats(stats, tags))
+    if groupby is not None:
+        result["groups"] = groups = []
+        group_stats = await _rollup.get_stats_per_period(db, periods, now)
+        for (t1, t2), stats in zip(periods, group_stats):
+            groups.append(dict(t1=t1, t2=t2, stats=_stats.filter_stats(stats, tags)))
+
+    return 200, {}, result
+
+
 async def get_settings(request, auth_info, db):
+    # Is the client's version still up to date?
+    etag = _get_etag(request, db)
+    if _etag_matches(request, etag):
+        return 304, {"etag": etag}, b""
+
     # Collect settings
     settings = await db.select_all("settings")
 
     # Return result
     result = dict(settings=settings)
-    return 200, {}, result
+    return 200, {"etag": etag}, result
+
+
+# %% ETags
+#
+# The ETag of a response is derived from the change state of the user db,
+# and the request path and query. It changes when anything in the db
+# changes, which is simple, and cheap to check: it needs no queries.
+# The change counter is per process, so the ETag includes an id that
+# differs per process, as well as the mtime of the db file.
+
+ETAG_PROCESS_ID = secrets.token_hex(4)
+
+
+def _get_etag(request, db):
+    version = change_notifier.get_version(db.filename)
+    query = json.dumps(sorted(request.querydict.items()))
+    digest = hashlib.sha1((request.path + query).encode()).hexdigest()[:16]
+    return f'W/"{ETAG_PROCESS_ID}-{version}-{db.mtime}-{digest}"'
+
+
+def _etag_matches(request, etag):
+    """Get whether the request's If-None-Match header matches the etag,
+    using weak comparison.
+    """
+    if_none_match = request.headers.get("if-none-match", "")
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
 
 
 async def put_settings(request, auth_info, db):
     return await _push_items(request, auth_info, db, "settings")
 
 
+# Limits for pushing items
+PUSH_MAX_SIZE = 10 * 2**20  # 10 MiB
+PUSH_BATCH_SIZE = 1000
+
+
 async def _push_items(request, auth_info, db, what):
-    # Download items
-    items = await request.get_json(10 * 2**20)  # 10 MiB limit
+    # The body is parsed as it comes in, and the items are stored in
+    # batches. This way, the memory use is bounded by the batch size,
+    # instead of by the size of the body. This means that a request that
+    # fails halfway has stored the batches before that (see the docs).
+    content_length = int(request.headers.get("content-length", "") or 0)
+    if content_length > PUSH_MAX_SIZE:
+        raise IOError("Request body too large.")
+
+    # The body may be gzip encoded. The size limit applies to the decoded
+    # body, and we decompress in limited steps to protect against zip bombs.
+    encoding = request.headers.get("content-encoding", "").strip().lower()
+    if encoding not in ("", "identity", "gzip"):
+        return 415, {}, f"unsupported media type: content-encoding {encoding}"
+    decompressor = zlib.decompressobj(31) if encoding == "gzip" else None
+
+    parser = JSONListParser()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def feed(data, final=False):
+        try:
+            return parser.feed(text_decoder.decode(data, final), final)
+        except TypeError:
+            raise TypeError(f"List of {what} must be a list") from None
+
+    result = _new_put_result()
+    batch = []
+    nbytes = 0
+    async for chunk in request.iter_body():
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk, PUSH_MAX_SIZE - nbytes + 1)
+            if decompressor.unconsumed_tail:
+                raise IOError("Request body too large.")
+        nbytes += len(chunk)
+        if nbytes > PUSH_MAX_SIZE:
+            raise IOError("Request body too large.")
+        batch += feed(chunk)
+        while len(batch) >= PUSH_BATCH_SIZE:
+            await _put_items_batch(db, what, batch[:PUSH_BATCH_SIZE], result)
+            batch = batch[PUSH_BATCH_SIZE:]
+    if decompressor is not None and not decompressor.eof:
+        raise ValueError("Incomplete gzip encoded body.")
+    batch += feed(b"", True)
+    await _put_items_batch(db, what, batch, result)
+    _metrics.payload_size.observe(what, "in", value=nbytes)
+
+    return 200, {}, _finish_put_result(result)
+
+
+async def _put_items(db, what, items):
     if not isinstance(items, list):
         raise TypeError(f"List of {what} must be a list")
+    result = _new_put_result()
+    await _put_items_batch(db, what, items, result)
+    return _finish_put_result(result)
 
-    server_time = time.time()
 
-    req = REQS[what]
-    spec = SPECS[what]
+def _new_put_result():
+    return dict(
+        accepted=[],  # keys of accepted items (but might have mt < current)
+        failed=[],  # keys of corrupt items
+        errors=[],  # error messages, matching up with failed
+        errors2=[],  # error messages for items that did not even have a key
+    )
 
-    accepted = []  # keys of accepted items (but might have mt < current)
-    failed = []  # keys of corrupt items
-    errors = []  # error messages, matching up with failed
-    errors2 = []  # error messages for items that did not even have a key
+
+def _finish_put_result(result):
+    return dict(
+        accepted=result["accepted"],
+        failed=result["failed"],
+        errors=result["errors"] + result["errors2"],
+    )
+
+
+async def _put_items_batch(db, what, items, result):
+    """Put the given items, adding the outcome to the given result. Concurrent
+    calls for the same db are merged into one transaction (group commit).
+    """
+    if not items:
+        return
+    future = asyncio.get_running_loop().create_future()
+    entry = what, items, _new_put_result(), future, get_db_timing()
+    queue = _write_queues.get(db.filename, None)
+    if queue is None:
+        queue = _write_queues[db.filename] = [entry]
+        task = asyncio.ensure_future(_process_write_queue(db, queue))
+        _write_tasks.add(task)
+        task.add_done_callback(_write_tasks.discard)
+    else:
+        queue.append(entry)
+    # Wait until committed. Only then the result is final. The shield
+    # makes that the future is not cancelled if the request is.
+    await asyncio.shield(future)
+    for key in ("accepted", "failed", "errors", "errors2"):
+        result[key] += entry[2][key]
+
+
+# %% Group commit
+#
+# A user with multiple devices (or tabs) may push items concurrently. Each
+# push would need its own transaction, and thus its own commit and fsync.
+# Instead, the pushes that arrive while a transaction is in progress are
+# queued, and put together in the next transaction. The batches are
+# applied one after another, in the order in which they arrived, so the
+# outcome for each caller is the same as without grouping.
+
+GROUP_COMMIT_MAX_ITEMS = 10 * PUSH_BATCH_SIZE
+
+_write_queues = {}  # filename -> list of (what, items, result, future, timing)
+_write_tasks = set()  # keep references to the tasks
+
+
+async def _process_write_queue(db, queue):
+    group = []
+    try:
+        while queue:
+            # Take entries up to the max number of items (but at least one)
+            group = [queue.pop(0)]
+            n = len(group[0][1])
+            while queue and n + len(queue[0][1]) <= GROUP_COMMIT_MAX_ITEMS:
+                n += len(queue[0][1])
+                group.append(queue.pop(0))
+            # If the group fails, put the entries one by one, so that
+            # an error in one entry does not affect the others.
+            if len(group) > 1:
+                timing = start_db_timing()
+                try:
+                    await _put_items_group(db, group)
+                except Exception:
+                    _add_db_timing(group, timing)
+                    for entry in group:
+                        entry[2].update(_new_put_result())
+                else:
+                    _add_db_timing(group, timing)
+                    change_notifier.notify(db.filename)
+                    for entry in group:
+                        entry[3].set_result(None)
+                    continue
+            for entry in group:
+                timing = start_db_timing()
+                try:
+                    await _put_items_group(db, [entry])
+                except Exception as err:
+                    _add_db_timing([entry], timing)
+                    entry[3].set_exception(err)
+                else:
+                    _add_db_timing([entry], timing)
+                    change_notifier.notify(db.filename)
+                    entry[3].set_result(None)
+    finally:
+        # E.g. when cancelled, the requests must not wait forever
+        _write_queues.pop(db.filename, None)
+        for entry in group + queue:
+            if not entry[3].done():
+                entry[3].set_exception(IOError("Write queue was interrupted"))
+
+
+def _add_db_timing(group, timing):
+    # The time of the transaction counts for each request in the group
+    for entry in group:
+        if entry[4] is not None:
+            entry[4].add(timing, shared=len(group) > 1)
+
+
+async def _put_items_group(db, group):
+    """Put the items of the given entries in one transaction."""
+    server_time = time.time()
+    old_records = {}  # the records before the first put in this group
+    new_records = {}  # the records after the last put in this group
 
     async with db:
         ob = await db.select_one("userinfo", "key == 'reset_time'")
         reset_time = float((ob or {}).get("value", -1))
 
-        for item in items:
-            # First check minimal requirement.
-            if not (isinstance(item, dict) and isinstance(item.get("key", None), str)):
-                errors2.append("Got item that is not a dict with str 'key' field.")
-                continue
+        for what, items, result, _, _ in group:
+            old_items, to_put = await _put_items_entry(
+                db, what, items, result, server_time, reset_time
+            )
+            if what == "records":
+                for key, item in to_put.items():
+                    if key not in new_records:
+                        old_records[key] = old_items.get(key, None)
+                    new_records[key] = item
 
-            # Get current item (or None). We will ALWAYS update the item's st
-            # (except when cur_item is None and incoming is corrupt).
-            # This helps guarantee consistency between server and client.
-            cur_item = await db.select_one(what, "key == ?", item["key"])
+        # Keep the stats, rollup, and the tag index up to date
+        if new_records:
+            await _stats.update_stat_bins(db, old_records, new_records)
+            await _rollup.update_daily_rollup(db, old_records, new_records)
+            await _update_record_tags(db, new_records.values(), server_time)
 
-            # Validate and copy the item (only copy fields that we know)
-            try:
-                item = {
-                    key: func(item[key]) for key, func in spec.items() if key in item
-                }
-                if req.difference(item.keys()):
-                    raise ValueError(
-                        f"A {what} is missing required fields: {req.difference(item.keys())}"
-                    )
-                if item["mt"] < reset_time:
-                    raise ValueError("Item was modified after a reset")
-            except Exception as err:
-                # Item is corrupt - mark it as failed
-                failed.append(item["key"])
-                errors.append(str(err))
-                # Re-put the current item if there was one, otherwise ignore
-                if cur_item is not None:
-                    item = cur_item
-                else:
-                    continue
-            else:
-                accepted.append(item["key"])
+    await db.mark_written()
 
-            # Reput the current item if its mt is larger than the incoming item.
-            if cur_item is not None and cur_item["mt"] > item["mt"]:
-                item = cur_item
 
-            # Ensure that st is never equal, so that we can guarantee
-            # eventual consistency. It also means that the exact value
-            # of mt is less important and we can allow it to be int.
+async def _put_items_entry(db, what, items, result, server_time, reset_time):
+    """Validate and put the given items. Returns the current items (before
+    the put) and the items that were put, as dicts.
+    """
+    req = REQS[what]
+    spec = SPECS[what]
+
+    accepted = result["accepted"]
+    failed = result["failed"]
+    errors = result["errors"]
+    errors2 = result["errors2"]
+
+    # Get the current items in bulk
+    keys = set()
+    for item in items:
+        if isinstance(item, dict) and isinstance(item.get("key", None), str):
+            keys.add(item["key"])
+    cur_items = await _select_by_keys(db, what, keys)
+    old_items = cur_items.copy()
+
+    to_put = {}  # key -> item
+
+    for item in items:
+        # First check minimal requirement.
+        if not (isinstance(item, dict) and isinstance(item.get("key", None), str)):
+            errors2.append("Got item that is not a dict with str 'key' field.")
+            continue
+
+        # Get current item (or None). We will ALWAYS update the item's st
+        # (except when cur_item is None and incoming is corrupt).
+        # This helps guarantee consistency between server and client.
+        cur_item = cur_items.get(item["key"], None)
+
+        # Validate and copy the item (only copy fields that we know)
+        try:
+            item = {key: func(item[key]) for key, func in spec.items() if key in item}
+            if req.difference(item.keys()):
+                raise ValueError(
+                    f"A {what} is missing required fields: {req.difference(item.keys())}"
+                )
+            if item["mt"] < reset_time:
+                raise ValueError("Item was modified after a reset")
+        except Exception as err:
+            # Item is corrupt - mark it as failed
+            failed.append(item["key"])
+            errors.append(str(err))
+            # Re-put the current item if there was one, otherwise ignore
             if cur_item is not None:
-                item["st"] = max(server_time, cur_item["st"] + 0.0001)
+                item = cur_item
             else:
-                item["st"] = server_time
+                continue
+        else:
+            accepted.append(item["key"])
 
-            # Store it!
-            await db.put(what, item)
+        # Reput the current item if its mt is larger than the incoming item.
+        if cur_item is not None and cur_item["mt"] > item["mt"]:
+            item = cur_item
 
-    # Return result
-    result = dict(
-        accepted=accepted,
-        failed=failed,
-        errors=errors + errors2,
-    )
-    return 200, {}, result
+        # Ensure that st is never equal, so that we can guarantee
+        # eventual consistency. It also means that the exact value
+        # of mt is less important and we can allow it to be int.
+        if cur_item is not None:
+            item["st"] = max(server_time, cur_item["st"] + 0.0001)
+        else:
+            item["st"] = server_time
+
+        # Store it! The item is also the current item for a later
+        # item with the same key.
+        to_put[item["key"]] = cur_items[item["key"]] = item
+
+    if to_put:
+        await db.put(what, *to_put.values())
+
+    return old_items, to_put
+
+
+# Max number of keys per query, well below SQLite's variable limit
+SELECT_CHUNK_SIZE = 500
+
+
+async def _select_by_keys(db, what, keys):
+    """Select the items with the given keys, in chunks. Returns a dict."""
+    keys = list(keys)
+    result = {}
+    for i in range(0, len(keys), SELECT_CHUNK_SIZE):
+        chunk = keys[i : i + SELECT_CHUNK_SIZE]
+        query = "key IN (" + ", ".join("?" for _ in chunk) + ")"
+        for item in await db.select(what, query, *chunk):
+            result[item["key"]] = item
+    return result
 
 
 async def put_forcereset(request, auth_info, db):
@@ -528,6 +1535,175 @@ async def put_forcereset(request, auth_info, db):
 
     async with db:
         await db.put_one("userinfo", key="reset_time", st=st, mt=st, value=st)
+    await db.mark_written()
+    change_notifier.notify(db.filename)
 
     result = dict(status="ok")
     return 200, {}, result
+
+
+# %% Websocket sync channel
+
+WEBSOCKET_AUTH_TIMEOUT = 10
+WEBSOCKET_CHECK_INTERVAL = 60
+
+
+async def api_handler_websocket(request, validate=None):
+    """The handler for the websocket sync channel. This combines pushing
+    items and getting updates over a single connection, which is
+    authenticated once. The optional ``validate`` is an async function
+    ``(request, auth_info)`` that raises AuthException to deny access.
+
+    All messages are JSON objects with a "type" field:
+
+    * The client must first send "auth" with an "authtoken". The server
+      replies with "auth", or with an "error" and closes the connection.
+    * The client sends "push" with "kind" (records or settings), "items",
+      and an "id". The server replies with "ack" with the same "id" and
+      "kind", and the same fields as the response to PUT /records.
+    * The client sends "pull" with "since". The server replies with
+      "updates", with the same fields as the response to GET /updates.
+      After that, the server sends "updates" whenever there are changes.
+      If all items are needed (a full resync), the server sends "resync"
+      instead, and the client must use GET /updates and pull again.
+    """
+    await request.accept()
+
+    # Authenticate using the first message
+    try:
+        msg = await asyncio.wait_for(request.receive_json(), WEBSOCKET_AUTH_TIMEOUT)
+        token = msg.get("authtoken", "") if isinstance(msg, dict) else ""
+        if not token:
+            raise AuthException("Missing jwt 'authtoken' in auth message.")
+        auth_info, db = await _authenticate_token(token)
+        if validate is not None:
+            await validate(request, auth_info)
+    except DisconnectedError:
+        return
+    except (AuthException, asyncio.TimeoutError, ValueError) as err:
+        message = f"unauthorized: {err}" if str(err) else "unauthorized"
+        await request.send(json.dumps(dict(type="error", status=401, message=message)))
+        await request.close(4001)
+        return
+    await request.send(json.dumps(dict(type="auth", status="ok")))
+
+    try:
+        await _websocket_sync_loop(request, token, validate, db.filename)
+    except DisconnectedError:
+        pass
+    except AuthException as err:
+        message = f"unauthorized: {err}"
+        await request.send(json.dumps(dict(type="error", status=401, message=message)))
+        await request.close(4001)
+
+
+async def _websocket_sync_loop(request, token, validate, filename):
+    since = None  # set by the client's pull message
+    version = 0  # the change counter at the time of our last query
+    receiver = waiter = None
+
+    try:
+        while True:
+            # Wait for a message from the client, or a change notification
+            if receiver is None:
+                receiver = asyncio.ensure_future(request.receive())
+            if waiter is None and since is not None:
+                waiter = asyncio.ensure_future(
+                    change_notifier.wait(filename, version, WEBSOCKET_CHECK_INTERVAL)
+                )
+            futures = [f for f in (receiver, waiter) if f is not None]
+            done, _ = await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
+
+            # Authenticate again, so that revoked and expired tokens are noticed
+            auth_info, db = await _authenticate_token(token)
+            if validate is not None:
+                await validate(request, auth_info)
+
+            send_updates = force_send = False
+
+            if waiter in done:
+                send_updates = waiter.result()  # False on timeout
+                waiter = None
+
+            if receiver in done:
+                text = receiver.result()
+                receiver = None
+                try:
+                    msg = json.loads(text)
+                except ValueError:
+                    msg = None  # invalid JSON
+                # Messages are rate limited like the corresponding requests
+                cost = get_websocket_message_cost(msg, len(text))
+                response = rate_limit("user:" + auth_info["username"], cost)
+                if response is not None:
+                    status, headers, message = response
+                    reply = dict(type="error", status=status, message=message)
+                    reply["retry_after"] = int(headers["retry-after"])
+                    if isinstance(msg, dict):
+                        reply["id"] = msg.get("id", None)
+                    await request.send(json.dumps(reply))
+                    continue
+                reply, new_since = await _handle_websocket_message(db, msg)
+                if reply is not None:
+                    await request.send(json.dumps(reply))
+                if new_since is not None:
+                    since = new_since
+                    send_updates = force_send = True
+
+            # Send updates since the last time. The version is obtained
+            # before querying, so that we cannot miss a change.
+            if send_updates and since is not None:
+                if waiter is not None:
+                    waiter.cancel()
+                    waiter = None
+                version = change_notifier.get_version(filename)
+                result = await _get_updates(db, since, False, full=False)
+                if result["records"] is None:
+                    # A full resync would be one large message, so the client
+                    # must do that with (paginated) GET updates, and pull again.
+                    since = None
+                    await request.send(json.dumps(dict(type="resync")))
+                    continue
+                since = result["server_time"]
+                if result["reset"] or result["records"] or result["settings"]:
+                    force_send = True
+                if force_send:
+                    await request.send(json.dumps(dict(type="updates", **result)))
+
+    finally:
+        for fut in (receiver, waiter):
+            if fut is not None:
+                fut.cancel()
+
+
+async def _handle_websocket_message(db, msg):
+    """Handle a message from the client. Returns (reply, since)."""
+    mtype = msg.get("type", None) if isinstance(msg, dict) else None
+
+    if not isinstance(msg, dict):
+        message = "bad request: messages must be JSON objects"
+        return dict(type="error", status=400, message=message), None
+
+    elif mtype == "push":
+        kind = msg.get("kind", None)
+        if kind not in SPECS:
+            message = "bad request: push kind must be 'records' or 'settings'"
+            return dict(type="error", status=400, message=message), None
+        try:
+            result = await _put_items(db, kind, msg.get("items", None))
+        except TypeError as err:
+            message = f"bad request: {err}"
+            return dict(type="error", status=400, message=message), None
+        return dict(type="ack", id=msg.get("id", None), kind=kind, **result), None
+
+    elif mtype == "pull":
+        try:
+            since = float(msg.get("since", None))
+        except (TypeError, ValueError):
+            message = "bad request: pull since needs a number (timestamp)"
+            return dict(type="error", status=400, message=message), None
+        return None, since
+
+    else:
+        message = f"bad request: invalid message type {mtype!r}"
+        return dict(type="error", status=400, message=message), None
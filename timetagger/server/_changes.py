@@ -0,0 +1,201 @@
+"""
+Notification of changes to user databases, within a process, and
+optionally between the worker processes of a server.
+"""
+
+import os
+import stat
+import socket
+import asyncio
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger("asgineer")
+
+
+class ChangeNotifier:
+    """Keeps a change counter per key (e.g. the filename of a user db)
+    and allows waiting for the next change. This is used to implement
+    long polling.
+
+    To avoid missing a change, get the version *before* querying the
+    database, and pass it to ``wait()``.
+
+    When connected to a channel directory, changes are also sent to the
+    other processes that are connected to that directory, so that their
+    waiters wake up, and their listeners can invalidate caches.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._waiters = {}
+        self._listeners = []
+        self._channel = None
+
+    def get_version(self, key):
+        """Get the current change counter for the given key."""
+        return self._versions.get(key, 0)
+
+    def notify(self, key):
+        """Notify a change for the given key, waking up all waiters,
+        in this process and in connected processes.
+        """
+        self._notify(key)
+        if self._channel is not None:
+            self._channel.send(key)
+
+    def _notify(self, key):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        for fut in self._waiters.pop(key, ()):
+            if not fut.done():
+                fut.set_result(None)
+
+    def _notify_from_other_process(self, key):
+        self._notify(key)
+        for callback in self._listeners:
+            try:
+                callback(key)
+            except Exception as err:
+                logger.error(f"Error in change listener: {err}")
+
+    def add_listener(self, callback):
+        """Register a function ``callback(key)`` that is called for changes
+        that were notified by another process.
+        """
+        self._listeners.append(callback)
+
+    def connect(self, dirname):
+        """Connect to the channel in the given directory, for the running
+        event loop. Does nothing if already connected. Not supported on
+        platforms without Unix domain sockets.
+        """
+        loop = asyncio.get_running_loop()
+        channel = self._channel
+        if channel is not None:
+            if channel.loop is loop and channel.dirname == dirname:
+                return
+            channel.close()
+            self._channel = None
+        if not hasattr(socket, "AF_UNIX"):
+            return
+        self._channel = WorkerChannel(dirname, loop, self._notify_from_other_process)
+
+    def disconnect(self):
+        """Disconnect from the channel, if connected."""
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+
+    async def wait(self, key, version, timeout):
+        """Wait until the version for the given key differs from the
+        given version, or until the timeout (in seconds) has passed.
+        Returns whether a change has occurred.
+        """
+        if self.get_version(key) != version:
+            return True
+        fut = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.setdefault(key, set())
+        waiters.add(fut)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters.discard(fut)
+            if not waiters and self._waiters.get(key, None) is waiters:
+                self._waiters.pop(key)
+        return self.get_version(key) != version
+
+
+def get_channel_dir(datadir):
+    """Get the channel directory for the server that uses the given data
+    directory. It is in the temp dir, because the path of a socket is
+    limited to about 100 characters. Its owner and mode are checked when
+    connecting.
+    """
+    datadir = os.path.abspath(os.path.expanduser(datadir))
+    return os.path.join(
+        tempfile.gettempdir(),
+        "timetagger-" + hashlib.sha1(datadir.encode()).hexdigest()[:12],
+    )
+
+
+class WorkerChannel:
+    """Broadcast short messages between the processes on this machine that
+    use the same directory. Each process binds a Unix datagram socket in
+    that directory, and sends a message by sending a datagram to each
+    socket in it. There is no broker, so there's nothing to set up, and a
+    process that dies just leaves a socket file that is removed when
+    sending to it fails.
+
+    Messages are best effort: a message is dropped if the receiving
+    process is too busy to empty its buffer.
+    """
+
+    def __init__(self, dirname, loop, callback):
+        self.dirname = dirname
+        self.loop = loop
+        self._callback = callback
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+        _check_private_dir(dirname)
+        self.path = os.path.join(dirname, f"{os.getpid()}-{id(self)}.sock")
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(self.path)
+        loop.add_reader(self._sock.fileno(), self._receive)
+
+    def close(self):
+        try:
+            if not self.loop.is_closed():
+                self.loop.remove_reader(self._sock.fileno())
+        finally:
+            self._sock.close()
+            _remove(self.path)
+
+    def send(self, message):
+        """Send the given message (a str) to the other processes."""
+        data = message.encode()
+        try:
+            names = os.listdir(self.dirname)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.dirname, name)
+            if path == self.path or not name.endswith(".sock"):
+                continue
+            try:
+                self._sock.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                _remove(path)  # the process is gone
+            except OSError as err:
+                logger.warning(f"Could not notify worker via {path}: {err}")
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except OSError:  # incl. BlockingIOError when there's no more data
+                break
+            self._callback(data.decode(errors="replace"))
+
+
+def _check_private_dir(dirname):
+    """Check that the given directory is owned by us, and not accessible
+    by others. Otherwise another user could have created it (the name is
+    predictable) to send us messages, or to receive them.
+    """
+    st = os.lstat(dirname)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f"Channel dir {dirname} is not a directory.")
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise PermissionError(f"Channel dir {dirname} is owned by another user.")
+    if st.st_mode & 0o077:
+        raise PermissionError(f"Channel dir {dirname} is accessible by others.")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,590 @@
+"""
+A process-wide pool of open user databases.
+
+Opening a user database means starting a thread, opening a connection,
+and checking the schema. Doing that on every request is wasteful, so we
+keep the most recently used databases open, up to a maximum number, and
+close databases that have not been used for a while.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+import sqlite3
+import contextvars
+from collections import OrderedDict
+
+import itemdb
+
+from .. import config
+from . import _metrics
+from ._utils import filename2user
+
+logger = logging.getLogger("asgineer")
+
+
+class _NoResult:
+    """Stands in for the future of a job of which nobody needs the result.
+    The thread of an AsyncItemDB gives the result to the loop of the future,
+    which fails if that loop is closed.
+    """
+
+    def get_loop(self):
+        return self
+
+    def call_soon_threadsafe(self, callback, *args):
+        pass
+
+
+_NO_RESULT = _NoResult()
+
+
+class PooledItemDB(itemdb.AsyncItemDB):
+    """An AsyncItemDB that can be shared between concurrent requests.
+
+    Transactions are serialized with a lock. Operations by other tasks
+    wait while a transaction is in progress, so they only see committed
+    data, just like they would with their own connection.
+    """
+
+    _tx_owner = None  # the task that is in a transaction
+    _removed = False  # whether it was removed from the pool
+    _closed = False
+    filename = ""  # set after opening
+
+    async def __new__(cls, filename):
+        self = await super().__new__(cls, filename)
+        self.filename = filename
+        self.last_used = 0
+        self._mtime = -1
+        self._stat_key = None
+        self._file_state = None  # as it was when obtained from the pool
+        self._written_file_state = None  # as it was after our last write
+        self._last_st = None
+        self._tx_lock = asyncio.Lock()
+        self._users = set()  # the tasks that obtained this db from the pool
+        return self
+
+    @property
+    def mtime(self):
+        """The modification time of the database file, as it was when the
+        database was obtained from the pool. Is -1 if the file did not exist.
+        """
+        return self._mtime
+
+    @property
+    def last_st(self):
+        """The largest st of the records and settings (and the reset time),
+        as known from the writes in this process. Is None if unknown, e.g.
+        if the database was changed by another process. Getting it needs
+        no syscall or query.
+        """
+        if self._file_state is None or self._file_state != self._written_file_state:
+            return None
+        return self._last_st
+
+    async def mark_written(self):
+        """Update ``last_st`` after a write. Call this after the commit."""
+        try:
+            state, last_st = await self.run_in_thread(_get_last_st, self.filename)
+        except Exception:
+            state = last_st = None  # e.g. the file was removed
+        self._file_state = self._written_file_state = state
+        self._last_st = last_st
+
+    async def _handle(self, function, *args, **kwargs):
+        function = _measure(self.filename, function, _db_timing.get())
+        owner = self._tx_owner
+        if owner is None or owner is asyncio.current_task():
+            return await self._submit(function, *args, **kwargs)
+        async with self._tx_lock:
+            return await self._submit(function, *args, **kwargs)
+
+    async def _submit(self, function, *args, **kwargs):
+        # The thread is gone after closing, so we'd wait forever
+        if self._closed:
+            raise IOError(f"Database {self.filename} is closed.")
+        return await super()._handle(function, *args, **kwargs)
+
+    async def run_in_thread(self, function, *args):
+        """Call ``function(connection, *args)`` in the thread of this
+        database, with the underlying sqlite3 connection. This is for
+        things that itemdb does not support, like schema migrations.
+        """
+        # The thread keeps a reference to the last function, so it must
+        # not reference self, or we'd never be deleted.
+        return await self._handle(functools.partial(function, self.db._conn, *args))
+
+    async def close(self):
+        """Close the database, and wait for it."""
+        if self._closed:
+            return
+        self._closed = True
+        await super().close()
+
+    def close_soon(self):
+        """Close the database without waiting for it. Operations that
+        were already submitted are done first.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put_nowait((_NO_RESULT, self.db.close, (), {}))
+        self._queue.put_nowait((None, None, None, None))
+
+    def __del__(self):
+        # Like AsyncItemDB.__del__, but it's fine if the loop is closed
+        if "db" in self.__dict__:
+            self.close_soon()
+
+    async def __aenter__(self):
+        if self._tx_owner is asyncio.current_task():
+            raise IOError("Already in a transaction")
+        await self._tx_lock.acquire()
+        self._tx_owner = asyncio.current_task()
+        try:
+            return await self._handle(self.db.__enter__)
+        except BaseException:
+            self._tx_owner = None
+            self._tx_lock.release()
+            raise
+
+    async def __aexit__(self, type, value, traceback):
+        try:
+            return await self._handle(self.db.__exit__, type, value, traceback)
+        finally:
+            self._tx_owner = None
+            self._tx_lock.release()
+
+
+def _get_file_state(filename, st):
+    # The mtime and size of the database file and the WAL file. In WAL
+    # mode, commits modify the WAL file, and the database file is only
+    # modified by a checkpoint. A commit changes the mtime, and usually
+    # the size, which helps when two commits happen within one tick.
+    try:
+        wal_st = os.stat(filename + "-wal")
+    except OSError:
+        wal_st = None
+    return tuple(
+        (x.st_mtime_ns, x.st_size) if x is not None else None for x in (st, wal_st)
+    )
+
+
+def _get_last_st(conn, filename):
+    # Get the file state before querying. If another process writes after
+    # the query, the file state changes, so we won't trust last_st. If it
+    # writes before, the query includes it. Retry if it writes in between.
+    state = None
+    for _ in range(10):
+        st = os.stat(filename)
+        state = _get_file_state(filename, st)
+        last_st = -1
+        for table in ("records", "settings"):
+            value = conn.execute(f"SELECT max(st) FROM {table}").fetchone()[0]
+            last_st = max(last_st, value or -1)
+        query = "SELECT _ob FROM userinfo WHERE key == 'reset_time'"
+        row = conn.execute(query).fetchone()
+        if row is not None:
+            last_st = max(last_st, float(json.loads(row[0]).get("value", -1)))
+        if _get_file_state(filename, os.stat(filename)) == state:
+            return state, last_st
+    return None, None
+
+
+# %% Pragmas
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+
+
+def apply_pragmas(conn):
+    """Apply the storage settings from the config (``config.db_journal_mode``
+    etc.) to the given sqlite3 connection. Must be called outside of a
+    transaction. The journal mode is stored in the database file; the
+    other settings are per connection.
+    """
+    journal_mode = config.db_journal_mode.lower()
+    synchronous = config.db_synchronous.lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Invalid db_journal_mode {config.db_journal_mode!r}")
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Invalid db_synchronous {config.db_synchronous!r}")
+    conn.execute(f"PRAGMA busy_timeout = {int(config.db_busy_timeout * 1000)}")
+    try:
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    except sqlite3.OperationalError as err:
+        # Leaving WAL mode needs exclusive access. Try again next time.
+        logger.warning(f"Could not set journal_mode to {journal_mode}: {err}")
+    conn.execute(f"PRAGMA synchronous = {synchronous}")
+    conn.execute(f"PRAGMA cache_size = {-int(config.db_cache_size)}")
+    conn.execute(f"PRAGMA mmap_size = {int(config.db_mmap_size)}")
+    conn.execute(f"PRAGMA wal_autocheckpoint = {int(config.db_wal_autocheckpoint)}")
+    conn.execute(f"PRAGMA journal_size_limit = {int(config.db_journal_size_limit)}")
+
+
+# %% Moving
+#
+# A user db can be moved (e.g. to the sharded layout) while the server is
+# running. The copy is made while holding the write lock of the db, so it
+# is complete. Before the lock is released, triggers are added to the old
+# db that make writes to it fail, so that nothing is written to the old
+# db after the copy was made. Requests that have the old db open can still
+# read it, and new requests use the new db (see user2filename()).
+
+MOVED_TRIGGER_PREFIX = "timetagger_moved_"
+
+
+def move_user_db(src, dst):
+    """Copy the user db at src to dst, and make writes to src fail from
+    then on, see above. The file at src can be removed when the server no
+    longer uses it. Returns False if src was already moved.
+    """
+    if os.path.exists(dst):
+        raise FileExistsError(f"Cannot move user db, {dst} already exists.")
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_filename = dst + ".tmp"
+    conn = sqlite3.connect(src, isolation_level=None)
+    try:
+        conn.execute(f"PRAGMA busy_timeout = {int(config.db_busy_timeout * 1000)}")
+        if is_moved_user_db(conn):
+            return False
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # The copy is made with another connection, which can read
+            # while we hold the lock. The last committed state is copied.
+            reader = sqlite3.connect(src)
+            target = sqlite3.connect(tmp_filename)
+            try:
+                reader.backup(target)
+            finally:
+                target.close()
+                reader.close()
+            query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            for (table,) in conn.execute(query).fetchall():
+                for op in ("INSERT", "UPDATE", "DELETE"):
+                    conn.execute(
+                        f"CREATE TRIGGER [{MOVED_TRIGGER_PREFIX}{table}_{op.lower()}] "
+                        f"BEFORE {op} ON [{table}] "
+                        "BEGIN SELECT RAISE(ABORT, 'user db was moved'); END"
+                    )
+            os.replace(tmp_filename, dst)
+            try:
+                conn.execute("COMMIT")
+            except Exception:
+                os.remove(dst)
+                raise
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            if os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+    finally:
+        conn.close()
+    return True
+
+
+def is_moved_user_db(conn):
+    """Get whether the db of the given sqlite3 connection was moved."""
+    query = "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE ?"
+    return conn.execute(query, (MOVED_TRIGGER_PREFIX + "%",)).fetchone() is not None
+
+
+# %% Timing
+
+# The DBTiming of the current request, see start_db_timing()
+_db_timing = contextvars.ContextVar("db_timing", default=None)
+
+
+class DBTiming:
+    """The time spent in the database, the number of operations, and the
+    number of rows that they returned or wrote, during a request.
+    """
+
+    def __init__(self):
+        self.time = 0.0
+        self.count = 0
+        self.rows = 0
+        self.shared_time = 0.0  # the part of the time shared with other requests
+
+    def add(self, other, shared=False):
+        """Add the given timing, e.g. of work that another task did for
+        this request. If shared, the work was also for other requests.
+        """
+        self.time += other.time
+        self.count += other.count
+        self.rows += other.rows
+        if shared:
+            self.shared_time += other.time
+
+    def get_server_timing(self, **durations):
+        """Get the value for a Server-Timing header, with the db time,
+        followed by the given durations (in seconds).
+        """
+        desc = f"{self.count} queries, {self.rows} rows"
+        if self.shared_time:
+            desc += f", {self.shared_time * 1000:.1f} ms shared with other requests"
+        parts = [f'db;dur={self.time * 1000:.1f};desc="{desc}"']
+        parts += [f"{name};dur={t * 1000:.1f}" for name, t in durations.items()]
+        return ", ".join(parts)
+
+
+def start_db_timing():
+    """Start measuring the database operations of the current task, e.g.
+    a request. Returns a DBTiming object.
+    """
+    timing = DBTiming()
+    _db_timing.set(timing)
+    return timing
+
+
+def get_db_timing():
+    """Get the DBTiming of the current task, or None."""
+    return _db_timing.get()
+
+
+def _measure(filename, function, timing):
+    # Wrap the function so that it measures the time spent in the db
+    # thread, per kind of operation (select, put, commit, etc.).
+    name = getattr(function, "__name__", "")
+    kind = DB_OPERATION_KINDS.get(name, name if name.isidentifier() else "other")
+
+    def measured_function(*args, **kwargs):
+        t0 = time.perf_counter()
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        finally:
+            t = time.perf_counter() - t0
+            _metrics.db_query_duration.observe(kind, value=t)
+            if timing is not None:
+                timing.time += t
+                timing.count += 1
+                timing.rows += _count_rows(kind, args, result)
+            threshold = config.slow_query_threshold
+            if threshold > 0 and t > threshold:
+                _log_slow_query(filename, function, kind, args, t)
+
+    return measured_function
+
+
+def _count_rows(kind, args, result):
+    if kind in ("put", "put_one"):
+        return len(args) - 1 if kind == "put" else 1
+    elif isinstance(result, list):
+        return len(result)
+    elif isinstance(result, dict):
+        return 1
+    return 0
+
+
+def _log_slow_query(filename, function, kind, args, t):
+    try:
+        user = filename2user(filename)
+    except Exception:
+        user = os.path.basename(filename)
+    msg = f"Slow db operation for {user!r}: {kind} took {t:.3f}s"
+    sql = params = None
+    if kind in ("select", "select_one", "count") and len(args) >= 2:
+        sql = f"SELECT _ob FROM {args[0]} WHERE {args[1]}"
+        params = args[2:]
+    elif kind == "select_all" and args:
+        sql, params = f"SELECT _ob FROM {args[0]}", ()
+    elif args and isinstance(args[0], str):
+        msg += f" on {args[0]}"
+    if sql is not None:
+        msg += f"\n  SQL: {sql}\n  params: {params!r}"
+        try:
+            # We are in the db thread, so we can use the connection
+            cur = function.__self__._conn.execute("EXPLAIN QUERY PLAN " + sql, params)
+            for row in cur.fetchall():
+                msg += f"\n  plan: {row[-1]}"
+        except Exception as err:
+            msg += f"\n  plan: not available ({err})"
+    logger.warning(msg)
+
+
+DB_OPERATION_KINDS = {
+    "ItemDB": "open",
+    "__enter__": "begin",
+    "__exit__": "commit",
+}
+
+
+class UserDBPool:
+    """A size-bounded LRU pool of open user databases.
+
+    The given ``setup`` coroutine function is called once for each
+    database that is opened, e.g. to ensure the tables. The maximum
+    number of open databases and the idle time after which a database
+    is closed are taken from ``config.db_pool_size`` and
+    ``config.db_pool_idle``.
+
+    The pool keeps track of the tasks (e.g. requests) that use a database.
+    A database that is removed from the pool is closed when no task uses
+    it anymore, so that the number of open files and threads is bounded.
+    A task stops using a database when it is done, or when it gets a newer
+    database for the same file from the pool.
+    """
+
+    def __init__(self, setup):
+        self._setup = setup
+        self._dbs = OrderedDict()
+        self._opening = {}  # filename -> task
+        self._removed = {}  # filename -> set of removed dbs that are in use
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._dbs)
+
+    def stats(self):
+        """Get a dict with statistics, e.g. for monitoring."""
+        return dict(
+            size=len(self._dbs),
+            maxsize=config.db_pool_size,
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+        )
+
+    def clear(self):
+        """Remove all databases from the pool."""
+        while self._dbs:
+            self._remove(self._dbs.popitem()[1])
+
+    def discard(self, filename):
+        """Remove the database for the given filename from the pool, e.g.
+        because the file is about to be moved or removed.
+        """
+        db = self._dbs.pop(filename, None)
+        if db is not None:
+            self._remove(db)
+
+    async def get(self, filename):
+        """Get the (pooled) AsyncItemDB for the given filename. The
+        database is created if it does not yet exist.
+        """
+        now = time.time()
+        self._evict_idle(now)
+
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            st = None
+
+        db = self._dbs.get(filename, None)
+        if db is not None and not self._is_valid(db, st):
+            self._remove(self._dbs.pop(filename))
+            db = None
+
+        if db is not None:
+            self._hits += 1
+            self._dbs.move_to_end(filename)
+        else:
+            self._misses += 1
+            db = await self._open_once(filename)
+            # Other opens may have removed (and closed) it in the meantime
+            while db._closed:
+                db = await self._open_once(filename)
+        self._use(db)
+
+        if st is None:
+            db._mtime = -1
+            db._file_state = None
+        else:
+            db._file_state = _get_file_state(filename, st)
+            mtimes = [x[0] for x in db._file_state if x is not None]
+            db._mtime = max(mtimes) / 1e9
+        db.last_used = now
+        return db
+
+    async def _open_once(self, filename):
+        # Requests that need the same db at the same time wait for one
+        # open, so that the setup (which may migrate the db) runs only once.
+        # The open is a task, so it's not cancelled with the first request.
+        loop = asyncio.get_running_loop()
+        task = self._opening.get(filename, None)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(self._open(filename))
+            self._opening[filename] = task
+
+            def done_callback(task):
+                if self._opening.get(filename, None) is task:
+                    self._opening.pop(filename)
+
+            task.add_done_callback(done_callback)
+        return await asyncio.shield(task)
+
+    async def _open(self, filename):
+        db = await PooledItemDB(filename)
+        await db.run_in_thread(apply_pragmas)
+        await self._setup(db)
+        st = os.stat(filename)
+        db._stat_key = st.st_dev, st.st_ino
+        # Another request may have opened the same db in the meantime
+        other = self._dbs.get(filename, None)
+        if other is not None and self._is_valid(other, st):
+            self._dbs.move_to_end(filename)
+            db.close_soon()
+            return other
+        self._dbs[filename] = db
+        self._dbs.move_to_end(filename)
+        while len(self._dbs) > max(1, config.db_pool_size):
+            self._remove(self._dbs.popitem(last=False)[1])
+            self._evictions += 1
+        return db
+
+    def _is_valid(self, db, st):
+        # The db must belong to the current event loop, and the file must
+        # not have been removed or replaced since we opened it.
+        if st is None or db._loop is not asyncio.get_running_loop():
+            return False
+        return db._stat_key == (st.st_dev, st.st_ino)
+
+    def _evict_idle(self, now):
+        idle_time = config.db_pool_idle
+        while self._dbs:
+            db = next(iter(self._dbs.values()))
+            if now - db.last_used <= idle_time:
+                break
+            self._remove(self._dbs.popitem(last=False)[1])
+            self._evictions += 1
+
+    def _use(self, db):
+        # Register the current task as a user of the db. It no longer uses
+        # removed dbs for the same file.
+        task = asyncio.current_task()
+        for other in list(self._removed.get(db.filename, ())):
+            if other is not db:
+                self._release(other, task)
+        if task is not None and task not in db._users:
+            db._users.add(task)
+            task.add_done_callback(lambda task: self._release(db, task))
+
+    def _release(self, db, task):
+        db._users.discard(task)
+        if db._removed and not db._users:
+            self._close(db)
+
+    def _remove(self, db):
+        # Called when a db is removed from the pool. Close it when unused.
+        db._removed = True
+        if db._users:
+            self._removed.setdefault(db.filename, set()).add(db)
+        else:
+            self._close(db)
+
+    def _close(self, db):
+        removed = self._removed.get(db.filename, None)
+        if removed is not None:
+            removed.discard(db)
+            if not removed:
+                self._removed.pop(db.filename)
+        db.close_soon()
@@ -0,0 +1,236 @@
+"""
+Process-wide metrics, exposed in the Prometheus text exposition format.
+
+This is a small implementation of counters, gauges and histograms, so
+that we don't need an extra dependency. The metrics are per process.
+Observations can be made from any thread (e.g. the database threads).
+"""
+
+import time
+import asyncio
+import threading
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+SIZE_BUCKETS = tuple(2**i for i in range(8, 25, 2))  # 256 B - 16 MiB
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    parts = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class for metrics. A metric has a value per combination of
+    label values, e.g. ``metric.inc("records", 200)``.
+    """
+
+    kind = ""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Reset all values."""
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        """Get the lines for this metric in the text exposition format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines += self._render_value(label_values, value)
+        return lines
+
+    def _render_value(self, label_values, value):
+        labels = _format_labels(self.labels, label_values)
+        return [f"{self.name}{labels} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+
+class Gauge(Metric):
+    """A value that can go up and down. If a callback is given, it is
+    called to obtain the value when rendering.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super().__init__(name, help, labels)
+        self._callback = callback
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        if self._callback is not None:
+            self.set(value=self._callback())
+        return super().render()
+
+
+class Histogram(Metric):
+    """Counts observations in buckets, and keeps their sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, *label_values, value):
+        with self._lock:
+            entry = self._values.get(label_values, None)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+
+    def get_count(self, *label_values):
+        entry = self._values.get(label_values, None)
+        return sum(entry[0]) if entry else 0
+
+    def _render_value(self, label_values, value):
+        counts, total = value
+        names = self.labels + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            labels = _format_labels(names, label_values + (_format_value(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labels, label_values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(float(total))}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """A collection of metrics that can be rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        """Add a metric. Replaces a metric with the same name, if any."""
+        self._metrics = [m for m in self._metrics if m.name != metric.name]
+        self._metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self._metrics:
+            metric.clear()
+
+    def render(self):
+        """Get all metrics in the text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.add(
+    Counter(
+        "timetagger_requests_total",
+        "Number of API requests.",
+        ("path", "method", "status"),
+    )
+)
+request_duration = registry.add(
+    Histogram(
+        "timetagger_request_duration_seconds",
+        "Time to handle an API request (excluding streaming the body).",
+        ("path", "method"),
+    )
+)
+db_query_duration = registry.add(
+    Histogram(
+        "timetagger_db_query_duration_seconds",
+        "Time spent in SQLite per kind of operation.",
+        ("kind",),
+    )
+)
+auth_failures_total = registry.add(
+    Counter(
+        "timetagger_auth_failures_total",
+        "Number of failed authentications.",
+        ("reason",),
+    )
+)
+payload_size = registry.add(
+    Histogram(
+        "timetagger_payload_bytes",
+        "Size of request bodies of PUT requests and of response bodies of GET updates.",
+        ("path", "direction"),
+        SIZE_BUCKETS,
+    )
+)
+event_loop_lag = registry.add(
+    Histogram(
+        "timetagger_event_loop_lag_seconds",
+        "Delay of a periodic callback on the event loop.",
+    )
+)
+
+
+# %% Event loop lag
+
+EVENT_LOOP_LAG_INTERVAL = 1.0
+
+_lag_monitors = {}  # loop -> task
+
+
+def ensure_event_loop_monitor():
+    """Start measuring the lag of the running event loop, if this was not
+    done yet. This is called when the metrics are requested, because
+    there is no hook for when the loop starts. Lag is thus measured from
+    the first scrape onwards.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _lag_monitors:
+        for other in list(_lag_monitors):
+            if other.is_closed():
+                _lag_monitors.pop(other)
+        _lag_monitors[loop] = loop.create_task(_monitor_event_loop())
+
+
+async def _monitor_event_loop():
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = time.perf_counter() - t0 - EVENT_LOOP_LAG_INTERVAL
+        event_loop_lag.observe(value=max(0, lag))
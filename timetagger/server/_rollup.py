@@ -0,0 +1,246 @@
+"""
+A per-day rollup of the records of a user.
+
+The daily_rollup table has an item per (day, tagz), with the number of
+seconds, and the number of records that contribute to it. Records are
+split at the day boundaries in the timezone given by
+``config.rollup_timezone``. A record that spans multiple days counts
+for each of these days. Like in the stats, hidden records are not
+included, and neither are running records and outliers.
+
+The rollup is updated in the transaction that puts the records, so that
+a report over a long period only needs to read one item per day and
+tag combination. Items that drop to zero are kept until a rebuild,
+because itemdb cannot delete items halfway a transaction.
+"""
+
+import time
+import datetime
+import zoneinfo
+
+from .. import config
+from . import _stats
+from ._stats import is_hidden, is_outlier, get_tagz
+
+
+def get_timezone():
+    # UTC does not need the tz database, which may not be available (e.g.
+    # on Windows without the tzdata package)
+    if config.rollup_timezone.upper() == "UTC":
+        return datetime.timezone.utc
+    return zoneinfo.ZoneInfo(config.rollup_timezone)
+
+
+def iter_days(t1, t2, tz):
+    """Iterate over the days that overlap with the range t1-t2, in the
+    given timezone. Yields (day, d1, d2) tuples, with day an ISO date
+    string, and d1 and d2 the timestamps of its start and end.
+    """
+    day = datetime.datetime.fromtimestamp(t1, tz).date()
+    d1 = datetime.datetime(day.year, day.month, day.day, tzinfo=tz).timestamp()
+    while d1 < t2:
+        next_day = day + datetime.timedelta(days=1)
+        d2 = datetime.datetime(
+            next_day.year, next_day.month, next_day.day, tzinfo=tz
+        ).timestamp()
+        yield day.isoformat(), d1, d2
+        day, d1 = next_day, d2
+
+
+def split_by_day(t1, t2, tz):
+    """Split the range t1-t2 at the day boundaries in the given timezone.
+    Returns a list of (day, seconds) tuples, with day an ISO date string.
+    """
+    result = []
+    for day, d1, d2 in iter_days(t1, t2, tz):
+        seconds = min(t2, d2) - max(t1, d1)
+        if seconds > 0:
+            result.append((day, int(seconds)))
+    return result
+
+
+def add_record_to_rollup(rollup, record, sign, tz):
+    """Add (sign=1) or subtract (sign=-1) the contribution of the given
+    record to the rollup, a dict (day, tagz) -> [seconds, count].
+    """
+    if record is None or is_hidden(record):
+        return
+    t1, t2 = record["t1"], record["t2"]
+    if t2 <= t1 or is_outlier(record):
+        return  # running or outlier
+    tagz = get_tagz(record)
+    for day, seconds in split_by_day(t1, t2, tz):
+        entry = rollup.setdefault((day, tagz), [0, 0])
+        entry[0] += sign * seconds
+        entry[1] += sign
+
+
+def _rollup_key(day, tagz):
+    return day + " " + tagz
+
+
+async def update_daily_rollup(db, old_records, new_records):
+    """Update the rollup for the given records that replace the given old
+    records (dicts key -> record). Must be called in a transaction.
+    """
+    tz = get_timezone()
+    deltas = {}
+    for key, record in new_records.items():
+        add_record_to_rollup(deltas, old_records.get(key, None), -1, tz)
+        add_record_to_rollup(deltas, record, 1, tz)
+    deltas = {k: v for k, v in deltas.items() if v != [0, 0]}
+    if not deltas:
+        return
+
+    keys = [_rollup_key(day, tagz) for day, tagz in deltas.keys()]
+    items = {}
+    for i in range(0, len(keys), 500):
+        chunk = keys[i : i + 500]
+        query = "key IN (" + ", ".join("?" for _ in chunk) + ")"
+        for item in await db.select("daily_rollup", query, *chunk):
+            items[item["key"]] = item
+
+    to_put = []
+    for (day, tagz), (seconds, count) in deltas.items():
+        key = _rollup_key(day, tagz)
+        item = items.get(key, None) or dict(
+            key=key, day=day, tagz=tagz, seconds=0, count=0
+        )
+        item["seconds"] += seconds
+        item["count"] += count
+        to_put.append(item)
+    await db.put("daily_rollup", *to_put)
+
+
+async def compute_daily_rollup(db):
+    """Compute the rollup from the records. Returns a dict (day, tagz) -> [seconds, count]."""
+    tz = get_timezone()
+    rollup = {}
+    for record in await db.select_all("records"):
+        add_record_to_rollup(rollup, record, 1, tz)
+    return rollup
+
+
+async def ensure_daily_rollup(db):
+    """Rebuild the rollup if it was never built, or if it was built for
+    another timezone. This only does work once per database (and timezone).
+    """
+    if await _rollup_is_current(db):
+        return
+    async with db:
+        # Check again, now that we have the write lock
+        if not await _rollup_is_current(db):
+            await _rebuild_daily_rollup(db)
+
+
+async def _rollup_is_current(db):
+    ob = await db.select_one("userinfo", "key == 'daily_rollup'")
+    return ob is not None and ob.get("value", None) == config.rollup_timezone
+
+
+async def rebuild_daily_rollup(db):
+    """Rebuild the rollup from the records."""
+    async with db:
+        await _rebuild_daily_rollup(db)
+
+
+async def _rebuild_daily_rollup(db):
+    rollup = await compute_daily_rollup(db)
+    to_put = {}
+    for item in await db.select_all("daily_rollup"):
+        item.update(seconds=0, count=0)
+        to_put[item["key"]] = item
+    for (day, tagz), (seconds, count) in rollup.items():
+        key = _rollup_key(day, tagz)
+        to_put[key] = dict(key=key, day=day, tagz=tagz, seconds=seconds, count=count)
+    if to_put:
+        await db.put("daily_rollup", *to_put.values())
+    st = time.time()
+    value = config.rollup_timezone
+    await db.put_one("userinfo", key="daily_rollup", st=st, mt=st, value=value)
+    # Must be last, because itemdb closes the cursor on delete()
+    await db.delete("daily_rollup", "count == 0")
+
+
+async def check_daily_rollup(db):
+    """Check the rollup against the records. Returns a list of strings
+    describing the differences, which is empty if the rollup is correct.
+    """
+    rollup = await compute_daily_rollup(db)
+    problems = []
+    for item in await db.select_all("daily_rollup"):
+        expected = rollup.pop((item["day"], item["tagz"]), [0, 0])
+        actual = [item["seconds"], item["count"]]
+        if actual != expected:
+            problems.append(f"{item['key']}: expected {expected}, got {actual}")
+    for (day, tagz), expected in sorted(rollup.items()):
+        problems.append(f"{_rollup_key(day, tagz)}: expected {expected}, got nothing")
+    return problems
+
+
+async def select_daily_rollup(db, day1, day2):
+    """Get the rollup items for the days day1 up to and including day2
+    (ISO date strings). This uses the index on day.
+    """
+    items = await db.select("daily_rollup", "day >= ? AND day <= ?", day1, day2)
+    return [item for item in items if item["count"] > 0]
+
+
+async def get_stats_per_period(db, periods, now=None):
+    """Get the stats (like _stats.get_stats()) for each of the given
+    consecutive periods, a list of (t1, t2) tuples. The whole days in a
+    period are taken from the rollup, so that e.g. grouping ten years by
+    day needs only a few queries. This only helps if the periods start
+    and end at the day boundaries of the rollup timezone. The rest of a
+    period, and the running records and outliers, are obtained as for
+    get_stats().
+    """
+    now = time.time() if now is None else now
+    if not periods:
+        return []
+    t1, t2 = periods[0][0], periods[-1][1]
+    tz = get_timezone()
+    # The rollup has no days outside the range of the stats (which is
+    # also well within the range of datetime)
+    d1, d2 = max(t1, _stats.STATS_MIN_TIME), min(t2, _stats.STATS_MAX_TIME)
+    days = []
+    if d2 > d1:
+        days = [x for x in iter_days(d1, d2, tz) if x[1] >= d1 and x[2] <= d2]
+
+    rollup = {}  # day -> stats
+    if days:
+        for item in await select_daily_rollup(db, days[0][0], days[-1][0]):
+            stats = rollup.setdefault(item["day"], {})
+            stats[item["tagz"]] = stats.get(item["tagz"], 0) + item["seconds"]
+    query = "outlier == 1 AND t1 < ? AND t2 > ?"
+    outliers = await db.select("records", query, t2, t1)
+    running = []
+    if now > t1:
+        running = await db.select("records", "running == 1 AND t1 < ?", t2)
+
+    result = []
+    i = 0
+    for p1, p2 in periods:
+        # Select the whole days in this period
+        while i < len(days) and days[i][1] < p1:
+            i += 1
+        j = i
+        while j < len(days) and days[j][2] <= p2:
+            j += 1
+        if j == i:
+            result.append(await _stats.get_stats(db, p1, p2, now))
+            continue
+        w1, w2 = int(days[i][1]), int(days[j - 1][2])
+        stats = {}
+        for day, _, _ in days[i:j]:
+            for tagz, seconds in rollup.get(day, {}).items():
+                stats[tagz] = stats.get(tagz, 0) + seconds
+        _stats.add_records(stats, outliers, w1, w2)
+        _stats.add_running_records(stats, running, w1, w2, now)
+        for a, b in [(p1, w1), (w2, p2)]:
+            if b > a:
+                for tagz, seconds in (await _stats.get_stats(db, a, b, now)).items():
+                    stats[tagz] = stats.get(tagz, 0) + seconds
+        result.append(stats)
+        i = j
+    return result
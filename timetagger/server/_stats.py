@@ -0,0 +1,264 @@
+"""
+Server-side aggregation of records into stats (tags -> seconds).
+
+This mirrors the heap of the RecordStore in the client: level 0 has
+bins of STATS_BIN_SIZE seconds, and each next level has bins that are
+twice as large. Each bin holds the stats of the (parts of the) records
+in it. The bins are stored in the stat_bins table of the user db, and
+are updated incrementally when records are put.
+
+Stats for a time range are obtained by combining the largest bins that
+fit in the range, and querying the records for the parts at the edges
+that are smaller than a bin. Like in the client, hidden records are not
+counted, and running records are counted up to the current time.
+
+Records that are very long, or that are outside the range of times that
+we expect, are "outliers". A record from 1970 to 2100 would be in tens of
+thousands of bins, so outliers are not in the bins (nor in the daily
+rollup). Like running records, they are added when querying.
+"""
+
+import time
+import datetime
+
+from timetagger.app.utils import get_tags_and_parts_from_string
+
+STATS_BIN_SIZE = 2**17  # about 1.5 day, the same as in the client
+STATS_LEVELS = 14  # the largest bins are about 34 years
+
+# Records outside this range, or longer than the max duration, are outliers
+STATS_MIN_TIME = 0
+STATS_MAX_TIME = 2**32  # in 2106
+STATS_MAX_DURATION = 2**25  # about a year
+
+# For the generated column in the records table
+OUTLIER_EXPRESSION = (
+    f"t2 > t1 AND (t1 < {STATS_MIN_TIME} OR t2 > {STATS_MAX_TIME} "
+    f"OR t2 - t1 > {STATS_MAX_DURATION})"
+)
+
+
+def is_hidden(record):
+    return record.get("ds", "").startswith("HIDDEN")
+
+
+def is_outlier(record):
+    """Get whether the given record is an outlier, see above."""
+    t1, t2 = record["t1"], record["t2"]
+    return t2 > t1 and (
+        t1 < STATS_MIN_TIME or t2 > STATS_MAX_TIME or t2 - t1 > STATS_MAX_DURATION
+    )
+
+
+def get_tagz(record):
+    """Get the tags of a record as a string, like the client does."""
+    tags, _ = get_tags_and_parts_from_string(record.get("ds", ""))
+    return " ".join(tags or ["#untagged"])
+
+
+def add_record_to_deltas(deltas, record, sign):
+    """Add (sign=1) or subtract (sign=-1) the contribution of the given
+    record to the deltas, a dict (level, nr) -> stats.
+    """
+    if record is None or is_hidden(record):
+        return
+    t1, t2 = record["t1"], record["t2"]
+    if t2 <= t1 or is_outlier(record):
+        return  # running records and outliers are not in the bins
+    tagz = get_tagz(record)
+    for level in range(STATS_LEVELS):
+        binsize = STATS_BIN_SIZE * 2**level
+        for nr in range(t1 // binsize, (t2 - 1) // binsize + 1):
+            overlap = min(t2, (nr + 1) * binsize) - max(t1, nr * binsize)
+            stats = deltas.setdefault((level, nr), {})
+            stats[tagz] = stats.get(tagz, 0) + sign * overlap
+
+
+def _bin_key(level, nr):
+    return f"{level}/{nr}"
+
+
+async def update_stat_bins(db, old_records, new_records):
+    """Update the bins for the given records that replace the given old
+    records (dicts key -> record). Must be called in a transaction.
+    """
+    deltas = {}
+    for key, record in new_records.items():
+        add_record_to_deltas(deltas, old_records.get(key, None), -1)
+        add_record_to_deltas(deltas, record, 1)
+    await _apply_deltas(db, deltas)
+
+
+async def backfill_stat_bins(db):
+    """Fill the stat_bins table for a database that was created before
+    it existed. This only does work once per database.
+    """
+    if await db.select_one("userinfo", "key == 'stat_bins'"):
+        return
+    # The marker may have been removed to have the bins rebuilt (see
+    # invalidate_derived_tables()), so first clear them. In each step,
+    # check again, now that we have the write lock. Another process may
+    # have done it in the meantime, and the deltas add up.
+    async with db:
+        if await db.select_one("userinfo", "key == 'stat_bins'"):
+            return
+        await db.delete("stat_bins", "key IS NOT NULL")
+    async with db:
+        if await db.select_one("userinfo", "key == 'stat_bins'"):
+            return
+        deltas = {}
+        for record in await db.select_all("records"):
+            add_record_to_deltas(deltas, record, 1)
+        await _apply_deltas(db, deltas)
+        st = time.time()
+        await db.put_one("userinfo", key="stat_bins", st=st, mt=st, value=1)
+
+
+async def _apply_deltas(db, deltas):
+    if not deltas:
+        return
+    bins = await _select_bins(db, deltas.keys())
+    to_put = []
+    for (level, nr), delta in deltas.items():
+        key = _bin_key(level, nr)
+        stats = bins.get(key, {}).get("stats", {})
+        for tagz, seconds in delta.items():
+            seconds += stats.get(tagz, 0)
+            if seconds:
+                stats[tagz] = seconds
+            else:
+                stats.pop(tagz, None)
+        to_put.append(dict(key=key, level=level, nr=nr, stats=stats))
+    await db.put("stat_bins", *to_put)
+
+
+async def _select_bins(db, levels_and_nrs, chunk_size=500):
+    keys = [_bin_key(level, nr) for level, nr in levels_and_nrs]
+    bins = {}
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i : i + chunk_size]
+        query = "key IN (" + ", ".join("?" for _ in chunk) + ")"
+        for item in await db.select("stat_bins", query, *chunk):
+            bins[item["key"]] = item
+    return bins
+
+
+def split_range(t1, t2):
+    """Split the range t1-t2 into the largest bins that fit inside it, and
+    the parts at the edges that are smaller than a bin. Returns a list of
+    (level, nr) tuples, and a list of (t1, t2) tuples.
+    """
+    n1 = -(-t1 // STATS_BIN_SIZE)  # ceil
+    n2 = t2 // STATS_BIN_SIZE
+    if n1 >= n2:
+        return [], [(t1, t2)] if t2 > t1 else []
+    bins = []
+    nr = n1
+    while nr < n2:
+        level = 0
+        while (
+            level + 1 < STATS_LEVELS
+            and nr % 2 ** (level + 1) == 0
+            and nr + 2 ** (level + 1) <= n2
+        ):
+            level += 1
+        bins.append((level, nr // 2**level))
+        nr += 2**level
+    edges = [(t1, n1 * STATS_BIN_SIZE), (n2 * STATS_BIN_SIZE, t2)]
+    return bins, [(a, b) for a, b in edges if b > a]
+
+
+async def get_stats(db, t1, t2, now=None):
+    """Get the stats for the range t1-t2, as a dict tagz -> seconds."""
+    now = time.time() if now is None else now
+    stats = {}
+    if t2 <= t1:
+        return stats
+
+    # Combine the bins
+    bins, edges = split_range(t1, t2)
+    for item in (await _select_bins(db, bins)).values():
+        for tagz, seconds in item["stats"].items():
+            stats[tagz] = stats.get(tagz, 0) + seconds
+
+    # Add the parts of records at the edges
+    for a, b in edges:
+        query = "t2 > ? AND t1 < ? AND running == 0 AND outlier == 0"
+        add_records(stats, await db.select("records", query, a, b), a, b)
+
+    # Add outliers
+    records = await db.select("records", "outlier == 1 AND t1 < ? AND t2 > ?", t2, t1)
+    add_records(stats, records, t1, t2)
+
+    # Add running records, up to now
+    if now > t1:
+        records = await db.select("records", "running == 1 AND t1 < ?", t2)
+        add_running_records(stats, records, t1, t2, now)
+
+    return stats
+
+
+def add_records(stats, records, t1, t2):
+    """Add the parts of the given (not running) records that are in the
+    range t1-t2 to the stats.
+    """
+    for record in records:
+        deltat = min(t2, record["t2"]) - max(t1, record["t1"])
+        if deltat > 0 and not is_hidden(record):
+            tagz = get_tagz(record)
+            stats[tagz] = stats.get(tagz, 0) + deltat
+
+
+def add_running_records(stats, records, t1, t2, now):
+    """Add the given running records to the stats for the range t1-t2,
+    counting them up to now.
+    """
+    for record in records:
+        if not is_hidden(record) and record["t1"] < t2:
+            deltat = max(0, min(t2, now) - max(t1, record["t1"]))
+            tagz = get_tagz(record)
+            stats[tagz] = stats.get(tagz, 0) + deltat
+
+
+def filter_stats(stats, tags):
+    """Select the stats for the tagz that contain all of the given tags."""
+    if not tags:
+        return stats
+    tags = set(tags)
+    return {
+        tagz: seconds
+        for tagz, seconds in stats.items()
+        if tags.issubset(tagz.split(" "))
+    }
+
+
+GROUPBY_OPTIONS = ("day", "week", "month")
+GROUPBY_SECONDS = dict(day=86400, week=7 * 86400, month=28 * 86400)  # at least
+MAX_GROUPS = 10000  # more than 27 years by day
+
+
+def get_periods(t1, t2, groupby, tzoffset=0):
+    """Split the range t1-t2 into days, weeks (starting on monday), or
+    months. The tzoffset is the offset from UTC in seconds, that determines
+    where a day starts. Returns a list of (t1, t2) tuples.
+    """
+    tz = datetime.timezone(datetime.timedelta(seconds=tzoffset))
+    d = datetime.datetime.fromtimestamp(t1, tz)
+    d = d.replace(hour=0, minute=0, second=0, microsecond=0)
+    if groupby == "week":
+        d -= datetime.timedelta(days=d.weekday())
+    elif groupby == "month":
+        d = d.replace(day=1)
+    periods = []
+    while d.timestamp() < t2:
+        if groupby == "day":
+            d_next = d + datetime.timedelta(days=1)
+        elif groupby == "week":
+            d_next = d + datetime.timedelta(days=7)
+        else:
+            year, month = divmod(d.month, 12)
+            d_next = d.replace(year=d.year + year, month=month + 1)
+        p1, p2 = max(t1, int(d.timestamp())), min(t2, int(d_next.timestamp()))
+        periods.append((p1, p2))
+        d = d_next
+    return periods
@@ -3,9 +3,13 @@ Misc utils.
 """
 
 import os
+import glob
 import json
+import time
+import hashlib
 import logging
 import secrets
+from collections import OrderedDict
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 import jwt
@@ -28,8 +32,19 @@ logger.setLevel(config.log_level.upper())
 ok_chars = frozenset("-_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
 
 
-def user2filename(username):
-    """Convert a username (e.g. email address) to the corresponding absolute filename."""
+USER_DIR_LAYOUTS = "flat", "sharded"
+
+
+def user2filename(username, layout=None):
+    """Convert a username (e.g. email address) to the corresponding absolute filename.
+
+    In the "flat" layout, all user db's are in the same directory. In the
+    "sharded" layout, they are in subdirectories based on a hash of the
+    username, e.g. ``users/ab/cd/name.db``. If no layout is given, the
+    configured layout (``config.user_dir_layout``) is used. For the sharded
+    layout, the filename in the flat layout is returned if the db has not
+    been moved yet, so that the server can be switched before migrating.
+    """
     # The rules for characters in email addresses are quite complex,
     # but can at least contain !#$%&'*+-/=?^_`{|}~. Therefore we
     # agressively create a clean representation (for recognizability)
@@ -39,7 +54,21 @@ def user2filename(username):
     encoded = urlsafe_b64encode(username.encode()).decode()
     fname = clean + "~" + encoded + ".db"
 
-    return os.path.join(ROOT_USER_DIR, fname)
+    lookup = layout is None
+    layout = (config.user_dir_layout if lookup else layout).lower()
+    if layout not in USER_DIR_LAYOUTS:
+        raise ValueError(f"Invalid user_dir_layout {layout!r}")
+    flat_filename = os.path.join(ROOT_USER_DIR, fname)
+    if layout == "flat":
+        return flat_filename
+
+    h = hashlib.sha1(username.encode()).hexdigest()
+    filename = os.path.join(ROOT_USER_DIR, h[:2], h[2:4], fname)
+    if lookup and not os.path.isfile(filename):
+        if os.path.isfile(flat_filename):
+            return flat_filename
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    return filename
 
 
 def filename2user(filename):
@@ -49,6 +78,19 @@ def filename2user(filename):
     return urlsafe_b64decode(encoded.encode()).decode()
 
 
+def list_user_filenames():
+    """Get the sorted filenames of all user db's, in both layouts. If a db
+    exists in both layouts (i.e. it was moved, but the old file was not yet
+    removed), only the one in the sharded layout is included.
+    """
+    filenames = {}
+    for filename in glob.glob(os.path.join(ROOT_USER_DIR, "*.db")):
+        filenames[os.path.basename(filename)] = filename
+    for filename in glob.glob(os.path.join(ROOT_USER_DIR, "??", "??", "*.db")):
+        filenames[os.path.basename(filename)] = filename
+    return [filenames[fname] for fname in sorted(filenames)]
+
+
 # %% JWT
 
 
@@ -101,6 +143,179 @@ def decode_jwt_nocheck(token):
     return json.loads(payload_s)
 
 
+# %% Caching
+
+
+class TTLCache:
+    """A size-bounded mapping in which entries expire after ttl seconds.
+    When the cache is full, the oldest entries are dropped.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._d = OrderedDict()  # key -> (expires, value)
+
+    def __len__(self):
+        return len(self._d)
+
+    def get(self, key, default=None):
+        """Get the value for the given key, or default if the key is
+        missing or has expired.
+        """
+        try:
+            expires, value = self._d[key]
+        except KeyError:
+            return default
+        if expires < time.time():
+            self._d.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value):
+        """Set the value for the given key. Resets its expiration."""
+        self._d.pop(key, None)
+        self._d[key] = time.time() + self.ttl, value
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+
+    def discard(self, key):
+        """Remove the given key, if present."""
+        self._d.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        self._d.clear()
+
+
+class TokenBucketLimiter:
+    """Rate limiter with a token bucket per key. Each bucket holds up to
+    burst tokens, and is refilled at rate tokens per second. A bucket that
+    has refilled completely is the same as a new one, so it is dropped;
+    only the buckets of keys that were recently active are kept.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._d = OrderedDict()  # key -> (tokens, time), least recent first
+
+    def __len__(self):
+        return len(self._d)
+
+    def consume(self, key, cost, rate, burst):
+        """Take cost tokens from the bucket for the given key. Returns 0 if
+        the tokens were available, or the number of seconds until they are.
+        A cost larger than burst is allowed when the bucket is full, so that
+        expensive requests are possible, but it leaves the bucket in debt.
+        """
+        now = time.monotonic()
+        self._prune(now, rate, burst)
+        tokens, t = self._d.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - t) * rate)
+        if tokens >= min(cost, burst):
+            tokens -= cost
+            retry_after = 0
+        else:
+            retry_after = (min(cost, burst) - tokens) / rate
+        self._d[key] = tokens, now
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+        return retry_after
+
+    def _prune(self, now, rate, burst):
+        while self._d:
+            tokens, t = next(iter(self._d.values()))
+            if tokens + (now - t) * rate < burst:
+                break
+            self._d.popitem(last=False)
+
+    def clear(self):
+        """Remove all buckets."""
+        self._d.clear()
+
+
+# %% Incremental JSON parsing
+
+
+class JSONListParser:
+    """Incremental parser for a JSON encoded list. Feed it text as it
+    arrives, and it returns the elements of the list that are complete.
+    Only the text of the current (incomplete) element is kept, and this
+    is limited by max_element_size (in characters).
+    """
+
+    def __init__(self, max_element_size=2**16):
+        self._decoder = json.JSONDecoder()
+        self._max_element_size = max_element_size
+        self._buf = ""
+        # 0: expect "[", 1: expect element or "]", 2: expect "," or "]",
+        # 3: expect element, 4: done
+        self._state = 0
+
+    def feed(self, text, final=False):
+        """Feed text to the parser. Returns a list of the elements that
+        were completed. Set final to True for the last piece of text.
+        Raises TypeError if the text is not a list, and ValueError for
+        invalid or incomplete JSON.
+        """
+        buf = self._buf + text
+        n = len(buf)
+        pos = 0
+        state = self._state
+        elements = []
+
+        while True:
+            # Skip whitespace
+            while pos < n and buf[pos] in " \t\n\r":
+                pos += 1
+            if pos >= n:
+                break
+            c = buf[pos]
+            if state == 0:
+                if c != "[":
+                    raise TypeError("Expected a JSON list.")
+                state = 1
+                pos += 1
+            elif state == 1 and c == "]":
+                state = 4
+                pos += 1
+            elif state in (1, 3):
+                # An element is complete if it's followed by a "," or "]".
+                # Otherwise, e.g. a number may be continued in the next text.
+                try:
+                    element, end = self._decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    end = n
+                i = end
+                while i < n and buf[i] in " \t\n\r":
+                    i += 1
+                if not final and (i >= n or buf[i] not in ",]"):
+                    if n - pos > self._max_element_size:
+                        raise ValueError("JSON list element is too large.")
+                    break
+                elif end >= n:
+                    raise ValueError(f"Invalid JSON at position {pos}.")
+                elements.append(element)
+                state = 2
+                pos = end
+            elif state == 2:
+                if c == ",":
+                    state = 3
+                elif c == "]":
+                    state = 4
+                else:
+                    raise ValueError(f"Invalid JSON at position {pos}.")
+                pos += 1
+            else:
+                raise ValueError("Extra data after JSON list.")
+
+        if final and state != 4:
+            raise ValueError("Incomplete JSON list.")
+        self._buf = buf[pos:]
+        self._state = state
+        return elements
+
+
 # %% Very basic SCSS parser
 
 